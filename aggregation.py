@@ -0,0 +1,225 @@
+import torch
+from torch.func import functional_call, vmap
+import numpy as np
+
+from profiling import profiler
+
+
+def flatten_state(state, keys=None, out=None):
+    """
+    state - model state dict
+    keys - order in which the state entries are concatenated (state order by default)
+    out - optional preallocated flat tensor to write into
+
+    returns all entries of the state dict concatenated into one flat vector
+    """
+    if keys is None:
+        keys = list(state.keys())
+    if out is None:
+        return torch.cat([state[key].reshape(-1) for key in keys])
+    offset = 0
+    for key in keys:
+        numel = state[key].numel()
+        out[offset : offset + numel].copy_(state[key].reshape(-1))
+        offset += numel
+    return out
+
+
+class FlatUpdates:
+    """
+    stores every client update as one row of a contiguous (num_clients, num_params)
+    matrix so that a weighted average of updates is a single matrix-vector product
+    only floating point entries are averaged, the other entries of the state (e.g. the
+    num_batches_tracked counters of BatchNorm) are copied from the reference state
+    """
+
+    def __init__(self, client_states, reference_state, device):
+        """
+        client_states - list of client states
+        reference_state - state dict that fixes the parameter layout (server model state)
+        """
+        self.keys = [
+            key
+            for key, value in reference_state.items()
+            if torch.is_floating_point(value)
+        ]
+        self.fixed = {
+            key: value.detach().clone()
+            for key, value in reference_state.items()
+            if not torch.is_floating_point(value)
+        }
+        self.shapes = [reference_state[key].shape for key in self.keys]
+        self.numels = [reference_state[key].numel() for key in self.keys]
+        self.num_params = sum(self.numels)
+        self.num_clients = len(client_states)
+        self.dtype = reference_state[self.keys[0]].dtype
+        self.device = device
+
+        self.matrix = torch.empty(
+            (self.num_clients, self.num_params), dtype=self.dtype, device=device
+        )
+        for idx, client_state in enumerate(client_states):
+            flatten_state(client_state, self.keys, out=self.matrix[idx])
+        profiler.count_bytes("aggregation.update_bytes", self.matrix)
+
+    def __len__(self):
+        return self.num_clients
+
+    def weight_tensor(self, weights):
+        """
+        weights - array of shape (num_clients,) or (K, num_clients)
+        """
+        return torch.as_tensor(weights, dtype=self.dtype, device=self.device)
+
+    def combine(self, weights, out=None):
+        """
+        weights - tensor of shape (num_clients,) or (K, num_clients)
+        out - optional preallocated buffer of shape (num_params,) or (K, num_params)
+
+        returns weights @ matrix, the weighted sum of client updates
+        """
+        if weights.dim() == 1:
+            return torch.mv(self.matrix.t(), weights, out=out)
+        return torch.mm(weights, self.matrix, out=out)
+
+    def unflatten(self, flat):
+        """
+        returns a state dict of views into the flat vector (and the non floating point
+        entries of the reference state)
+        """
+        views = flat.split(self.numels)
+        state = {
+            key: view.view(shape)
+            for key, view, shape in zip(self.keys, views, self.shapes)
+        }
+        state.update(self.fixed)
+        return state
+
+    def bind(self, model, flat):
+        """
+        points the model parameters and buffers at views of flat (no copy)
+        the model changes whenever flat is overwritten
+        """
+        model_state = model.state_dict(keep_vars=True)
+        views = flat.split(self.numels)
+        for key, view, shape in zip(self.keys, views, self.shapes):
+            model_state[key].data = view.view(shape)
+        for key, value in self.fixed.items():
+            model_state[key].data.copy_(value)
+        return model
+
+
+class CriterionModule(torch.nn.Module):
+    """
+    wraps criterion(model, data, targets) as a module so that it can be
+    called with substituted parameters through torch.func.functional_call
+    """
+
+    def __init__(self, model, criterion):
+        super().__init__()
+        self.model = model
+        self.criterion = criterion
+
+    def forward(self, data, targets):
+        return self.criterion(self.model, data, targets)
+
+
+def stacked_losses(model, criterion, updates, params, data, targets):
+    """
+    model - module with the parameter layout of updates
+    criterion - loss function (model, data, targets)
+    params - (K, num_params) flat parameters of K models
+
+    returns the K losses of criterion, computed in one vmapped forward pass
+    """
+    module = CriterionModule(model, criterion)
+
+    def loss(flat):
+        state = {
+            "model." + key: value for key, value in updates.unflatten(flat).items()
+        }
+        return functional_call(module, state, (data, targets))
+
+    return vmap(loss)(params)
+
+
+class PermutationPrefixes:
+    """
+    running weighted sums of the prefixes of K client permutations, every step adds
+    the next client update to the selected permutations
+    """
+
+    def __init__(self, updates, weights, permutations):
+        """
+        updates - FlatUpdates
+        weights - normalized client weights, array of shape (num_clients,)
+        permutations - (K, num_clients) array of client permutations
+        """
+        self.updates = updates
+        self.weights = np.asarray(weights, dtype=float)
+        self.permutations = np.asarray(permutations, dtype=int)
+        self.running_sum = torch.zeros(
+            (len(self.permutations), updates.num_params),
+            dtype=updates.dtype,
+            device=updates.device,
+        )
+        self.running_weight = np.zeros(len(self.permutations))
+
+    def step(self, j, rows):
+        """
+        j - position, called once for every j in increasing order
+        rows - permutations whose prefix is extended with their j-th client (the
+        prefixes of the other permutations are not needed any more)
+
+        returns the (len(rows), num_params) weighted averages of permutations[rows][: j + 1]
+        """
+        clients = self.permutations[rows, j]
+        index = torch.as_tensor(rows, device=self.updates.device)
+        client_weights = self.updates.weight_tensor(self.weights[clients])
+        self.running_sum[index] += (
+            self.updates.matrix[torch.as_tensor(clients, device=self.updates.device)]
+            * client_weights[:, None]
+        )
+        self.running_weight[rows] += self.weights[clients]
+        totals = self.updates.weight_tensor(self.running_weight[rows])
+        return self.running_sum[index] / totals[:, None]
+
+
+def gray_code_last(num_clients):
+    """
+    returns the bitmask of the last subset visited by gray_code_subsets
+    """
+    step = 2**num_clients - 1
+    return step ^ (step >> 1)
+
+
+def gray_code_subsets(updates, weights):
+    """
+    updates - FlatUpdates
+    weights - normalized client weights, array of shape (num_clients,)
+
+    yields (mask, average) for every subset of clients in Gray-code order, where bit i
+    of mask marks client i and average is the weighted average of the subset's updates
+    (None for the empty subset). consecutive subsets differ by exactly one client, so
+    every step adds or removes a single update from a running sum.
+    the yielded average tensor is overwritten by the next step
+    """
+    weights = np.asarray(weights, dtype=float)
+    # accumulate in double precision so that repeated add/remove does not drift
+    running_sum = torch.zeros(
+        updates.num_params, dtype=torch.float64, device=updates.device
+    )
+    running_weight = 0
+    average = torch.empty(
+        updates.num_params, dtype=updates.dtype, device=updates.device
+    )
+
+    yield 0, None
+    for step in range(1, 2**updates.num_clients):
+        client = (step & -step).bit_length() - 1  # bit flipped at this step
+        mask = step ^ (step >> 1)
+        sign = 1 if (mask >> client) & 1 else -1
+        running_sum.add_(updates.matrix[client], alpha=sign * weights[client])
+        running_weight += sign * weights[client]
+        average.copy_(running_sum / running_weight)
+        yield mask, average
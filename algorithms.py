@@ -6,40 +6,224 @@ import wandb
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
 
-from utils import topk
+from client import ClientMetrics
+from executors import make_executor
+from profiling import profiler
+from sinks import SinkGroup, WandbSink
+from utils import client_seed, concatenate, topk
+
+
+class RunContext:
+    """
+    per-run mutable state: copies of the clients and the server and the run's seeds
+    copies share the dataset store with the caller, so creating one copies O(N)
+    client metadata and the server model, not the data
+    """
+
+    def __init__(self, clients, server, random_seed, sink=None, logging=False):
+        """
+        sink - metrics sink shared with other runs (sinks.py), flushed when the run ends
+        logging - also log the rounds to the current W&B run
+        """
+        self.clients = deepcopy(clients)
+        self.server = deepcopy(server)
+        self.random_seed = random_seed
+        self.sinks = SinkGroup([sink], [WandbSink()] if logging == True else [])
+        torch.manual_seed(random_seed)
+        np.random.seed(random_seed)
+        # the first round's profiling record starts with the run
+        profiler.reset()
+
+    def client_seed(self, t, idx):
+        """
+        seed for training client idx in round t
+        """
+        return client_seed(self.random_seed, t, idx)
+
+    def log(self, t, log_dict):
+        """
+        queues the metrics of round t for the run's sinks (written in the background)
+        """
+        with profiler.timer("logging"):
+            self.sinks.log({"round": t, **log_dict})
+
+    def close(self):
+        """
+        waits until every logged round is written, the run loops call it before
+        wandb.finish() so that the W&B sink has logged every round to the run
+        """
+        self.sinks.close()
+
+
+class RoundMetrics:
+    """
+    evaluates the server model after every round (test accuracy and loss, validation
+    loss, train accuracy and loss every eval_every rounds) and logs the rounds
+    with asynchronous=True the evaluation and logging of round t run on a background
+    thread, on a copy of the aggregated server model, while the run loop goes on with
+    round t + 1, rounds are still evaluated and logged in order
+    """
+
+    def __init__(
+        self,
+        server,
+        client_metrics,
+        client_weights,
+        T,
+        eval_every=1,
+        log=None,
+        asynchronous=False,
+    ):
+        """
+        client_weights - weights of the clients in the train accuracy and loss
+        log - function (t, log_dict) that logs a round (RunContext.log)
+        """
+        self.server = server
+        self.client_metrics = client_metrics
+        self.client_weights = client_weights
+        self.T = T
+        self.eval_every = eval_every
+        self.log_function = log
+        self.pool = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self.futures = []
+        self.log_futures = []
+
+    def submit(self, t):
+        """
+        starts evaluating the current server model as the model of round t
+        """
+        if self.pool is None:
+            future = Future()
+            future.set_result(self.evaluate(t))
+        else:
+            model = deepcopy(self.server.model)
+            future = self.pool.submit(self.evaluate, t, model)
+        self.futures.append(future)
+
+    def evaluate(self, t, model=None):
+        """
+        model - copy of the server model (the server model itself if None)
+        """
+        test_acc, test_loss, val_loss = self.server.evaluate(fed_avg_criterion(), model)
+        if (t + 1) % self.eval_every == 0 or t == self.T - 1:
+            train_acc, train_loss = self.client_metrics.weighted(
+                self.server.model if model is None else model, self.client_weights
+            )
+        else:
+            train_acc, train_loss = np.nan, np.nan
+        return {
+            "train_accuracy": train_acc,
+            "test_accuracy": test_acc,
+            "train_loss": train_loss,
+            "val_loss": val_loss,
+            "test_loss": test_loss,
+        }
+
+    def result(self, t):
+        """
+        returns the metrics of round t, waiting for its evaluation
+        """
+        return self.futures[t].result()
+
+    def val_losses(self):
+        """
+        returns the validation losses of all submitted rounds, waiting for them
+        """
+        return [future.result()["val_loss"] for future in self.futures]
+
+    def log(self, t, log_dict):
+        """
+        logs log_dict, preceded by the metrics of round t, once round t is evaluated
+        """
+        if self.pool is None:
+            self.log_round(t, log_dict)
+        else:
+            self.log_futures.append(self.pool.submit(self.log_round, t, log_dict))
+
+    def log_round(self, t, log_dict):
+        if self.log_function is not None:
+            self.log_function(t, {**self.result(t), **log_dict})
+
+    def close(self):
+        """
+        waits for all rounds to be evaluated and logged
+
+        returns the test_acc, train_acc, train_loss, val_loss and test_loss lists
+        """
+        for future in self.log_futures:
+            future.result()
+        metrics = [future.result() for future in self.futures]
+        if self.pool is not None:
+            self.pool.shutdown()
+        return tuple(
+            [round_metrics[key] for round_metrics in metrics]
+            for key in [
+                "test_accuracy",
+                "train_accuracy",
+                "train_loss",
+                "val_loss",
+                "test_loss",
+            ]
+        )
+
+
+def uniform_selection(num_clients, num_selected):
+    """
+    returns the selected status of num_selected clients drawn uniformly at random
+    """
+    all_clients = [i for i in range(num_clients)]
+    np.random.shuffle(all_clients)
+    selected_client_indices = all_clients[0:num_selected]
+    selected_status = [False for i in range(num_clients)]
+    for i in range(num_clients):
+        if i in selected_client_indices:
+            selected_status[i] = True
+    return selected_status
+
+
+def stage_round(client_executor, run, t, selected_indices, E, B):
+    """
+    starts staging the minibatches of the clients selected for round t in the
+    background (no-op unless the executor was created with prefetch)
+    """
+    client_executor.stage(
+        selected_indices, E, B, [run.client_seed(t, idx) for idx in selected_indices]
+    )
+
+
+def fed_prox_loss(model, data, targets, model_reference, mu):
+    criterion = torch.nn.CrossEntropyLoss()
+    scores = model(data)
+    loss_value = criterion(scores, targets)
+    for param, param_reference in zip(model.parameters(), model_reference.parameters()):
+        loss_value += (
+            0.5 * mu * torch.square(torch.linalg.norm((param - param_reference)))
+        )
+    return loss_value
 
 
 def fed_prox_criterion(model_reference, mu):
     """
     returns the required function when called
     loss function for FedProx with chosen mu parameter
+    (a partial of a module level function, so it can be sent to worker processes)
     """
     model_reference = deepcopy(model_reference)
+    return partial(fed_prox_loss, model_reference=model_reference, mu=mu)
 
-    def loss(model, data, targets):
-        criterion = torch.nn.CrossEntropyLoss()
-        scores = model(data)
-        loss_value = criterion(scores, targets)
-        for param, param_reference in zip(
-            model.parameters(), model_reference.parameters()
-        ):
-            loss_value += (
-                0.5 * mu * torch.square(torch.linalg.norm((param - param_reference)))
-            )
-        return loss_value
 
-    return loss
+def fed_avg_loss(model, data, targets):
+    criterion = torch.nn.CrossEntropyLoss()
+    scores = model(data)
+    return criterion(scores, targets)
 
 
 def fed_avg_criterion():
-    def loss(model, data, targets):
-        criterion = torch.nn.CrossEntropyLoss()
-        scores = model(data)
-        return criterion(scores, targets)
-
-    return loss
+    return fed_avg_loss
 
 
 def centralised_run(
@@ -53,18 +237,12 @@ def centralised_run(
     learning_rate=0.01,
     momentum=0.5,
     logging=False,
+    sink=None,
 ):
-    clients = deepcopy(clients)
-    server = deepcopy(server)
-    torch.manual_seed(random_seed)
-    np.random.seed(random_seed)
-    data = []
-    targets = []
-    for client in clients:
-        data.append(client.data)
-        targets.append(client.targets)
-    data = torch.cat(data)
-    targets = torch.cat(targets)
+    run = RunContext(clients, server, random_seed, sink, logging)
+    clients, server = run.clients, run.server
+    data = concatenate([client.data for client in clients])
+    targets = concatenate([client.targets for client in clients])
     num_datapoints = len(data)
     print(num_datapoints)
     num_selected = int(np.floor(select_fraction * num_datapoints))
@@ -83,28 +261,21 @@ def centralised_run(
     E = np.max(E)
     for t in tqdm(range(T)):
         for iteration in range(E * B):
-            all_indices = np.random.permutation(list(range(num_datapoints)))
-            indices = all_indices[:num_selected]
-            data_raw = [data[j] for j in indices]
-            targets_raw = [int(targets[j]) for j in indices]
-            # prepare data and targets for training
-            data_batch = (
-                torch.stack(data_raw, 0).to(device=server.device).to(torch.float32)
-            )
-            targets_batch = torch.tensor(targets_raw).to(device=server.device)
+            indices = torch.randperm(num_datapoints, device=data.device)
+            indices = indices[:num_selected]
+            data_batch = data[indices].to(device=server.device)
+            targets_batch = targets[indices].to(device=server.device)
             optimiser.zero_grad()
             loss = fed_avg_criterion()(server.model, data_batch, targets_batch)
             loss.backward()
             optimiser.step()
 
-        test_acc_now = server.accuracy()
-        train_acc_now = server.accuracy()
+        test_acc_now, test_loss_now, val_loss_now = server.evaluate(fed_avg_criterion())
+        train_acc_now = test_acc_now
         with torch.no_grad():
             train_loss_now = float(
                 fed_avg_criterion()(server.model, data, targets).cpu()
             )
-        val_loss_now = server.val_loss(server.model, fed_avg_criterion())
-        test_loss_now = server.test_loss(fed_avg_criterion())
 
         train_acc.append(train_acc_now)
         test_acc.append(test_acc_now)
@@ -119,8 +290,10 @@ def centralised_run(
             "val_loss": val_loss_now,
             "test_loss": test_loss_now,
         }
-        if logging == True:
-            wandb.log(log_dict)
+        run.log(t, log_dict)
+        profiler.end_round(t, algorithm="centralised", random_seed=random_seed)
+
+    run.close()
 
     if logging == True:
         print("finishing")
@@ -140,17 +313,22 @@ def fed_avg_run(
     learning_rate=0.01,
     momentum=0.5,
     logging=False,
+    sink=None,
+    executor="sequential",
+    num_workers=1,
+    eval_every=1,
+    prefetch=0,
 ):
-    clients = deepcopy(clients)
+    run = RunContext(clients, server, random_seed, sink, logging)
+    clients, server = run.clients, run.server
     client_weights = np.array([client.length for client in clients])
     client_weights = client_weights / np.sum(client_weights)
-    server = deepcopy(server)
-    torch.manual_seed(random_seed)
-    np.random.seed(random_seed)
     num_clients = len(clients)
     if type(E) == int:
         E = [E for _ in range(num_clients)]
     num_selected = int(np.ceil(select_fraction * num_clients))
+    client_executor = make_executor(executor, clients, num_workers, prefetch)
+    client_metrics = ClientMetrics(clients)
 
     test_acc = []
     train_acc = []
@@ -159,54 +337,47 @@ def fed_avg_run(
     test_loss = []
 
     selections = []
+    # clients are drawn one round ahead (same draws as drawing them every round) so
+    # that their minibatches can be staged while the server aggregates and evaluates
+    next_selected_status = uniform_selection(num_clients, num_selected)
     for t in tqdm(range(T)):
         # select clients to transmit weights to
 
         # uniform random
-        all_clients = [i for i in range(num_clients)]
-        np.random.shuffle(all_clients)
-        selected_client_indices = all_clients[0:num_selected]
-        selected_status = [False for i in range(num_clients)]
-        for i in range(num_clients):
-            if i in selected_client_indices:
-                selected_status[i] = True
+        selected_status = next_selected_status
 
         selections.append(np.array(selected_status).astype(int))
 
-        client_states = []
-        weights = []
-        for idx, client in enumerate(clients):
-            if selected_status[idx]:
-                # perform descent at client
-                client_state = client.train(
-                    server.model,
-                    criterion=fed_avg_criterion(),
-                    E=E[idx],
-                    B=B,
-                    learning_rate=learning_rate,
-                    momentum=momentum,
-                )
-                weight = client.length  # number of data points at client
-                client_states.append(client_state)
-                weights.append(weight)
+        # perform descent at the selected clients
+        selected_indices = [idx for idx in range(num_clients) if selected_status[idx]]
+        client_states = client_executor.train(
+            selected_indices,
+            server.model,
+            criterion=fed_avg_criterion(),
+            E=E,
+            B=B,
+            learning_rate=learning_rate,
+            momentum=momentum,
+            seeds=[run.client_seed(t, idx) for idx in selected_indices],
+        )
+        if t + 1 < T:
+            next_selected_status = uniform_selection(num_clients, num_selected)
+            next_indices = [
+                idx for idx in range(num_clients) if next_selected_status[idx]
+            ]
+            stage_round(client_executor, run, t + 1, next_indices, E, B)
+        # number of data points at client
+        weights = [clients[idx].length for idx in selected_indices]
 
         server.aggregate(client_states, weights)
 
-        test_acc_now = server.accuracy()
-        train_acc_now = np.sum(
-            [
-                client_weights[i] * clients[i].accuracy_(server.model)
-                for i in range(num_clients)
-            ]
-        )
-        train_loss_now = np.sum(
-            [
-                client_weights[i] * clients[i].loss(server.model, fed_avg_criterion())
-                for i in range(num_clients)
-            ]
-        )
-        val_loss_now = server.val_loss(server.model, fed_avg_criterion())
-        test_loss_now = server.test_loss(fed_avg_criterion())
+        test_acc_now, test_loss_now, val_loss_now = server.evaluate(fed_avg_criterion())
+        if (t + 1) % eval_every == 0 or t == T - 1:
+            train_acc_now, train_loss_now = client_metrics.weighted(
+                server.model, client_weights
+            )
+        else:
+            train_acc_now, train_loss_now = np.nan, np.nan
 
         train_acc.append(train_acc_now)
         test_acc.append(test_acc_now)
@@ -221,8 +392,12 @@ def fed_avg_run(
             "val_loss": val_loss_now,
             "test_loss": test_loss_now,
         }
-        if logging == True:
-            wandb.log(log_dict)
+        log_dict.update(client_executor.prefetch_timings())
+        run.log(t, log_dict)
+        profiler.end_round(t, algorithm="fedavg", random_seed=random_seed)
+
+    client_executor.close()
+    run.close()
 
     if logging == True:
         print("finishing")
@@ -243,17 +418,22 @@ def fed_prox_run(
     learning_rate=0.01,
     momentum=0.5,
     logging=False,
+    sink=None,
+    executor="sequential",
+    num_workers=1,
+    eval_every=1,
+    prefetch=0,
 ):
-    clients = deepcopy(clients)
+    run = RunContext(clients, server, random_seed, sink, logging)
+    clients, server = run.clients, run.server
     client_weights = np.array([client.length for client in clients])
     client_weights = client_weights / np.sum(client_weights)
-    server = deepcopy(server)
-    torch.manual_seed(random_seed)
-    np.random.seed(random_seed)
     num_clients = len(clients)
     if type(E) == int:
         E = [E for _ in range(num_clients)]
     num_selected = int(np.ceil(select_fraction * num_clients))
+    client_executor = make_executor(executor, clients, num_workers, prefetch)
+    client_metrics = ClientMetrics(clients)
 
     test_acc = []
     train_acc = []
@@ -262,53 +442,46 @@ def fed_prox_run(
     test_loss = []
 
     selections = []
+    # clients are drawn one round ahead (same draws as drawing them every round) so
+    # that their minibatches can be staged while the server aggregates and evaluates
+    next_selected_status = uniform_selection(num_clients, num_selected)
     for t in tqdm(range(T)):
         # select clients to transmit weights to
 
         # uniform random
-        all_clients = [i for i in range(num_clients)]
-        np.random.shuffle(all_clients)
-        selected_client_indices = all_clients[0:num_selected]
-        selected_status = [False for i in range(num_clients)]
-        for i in range(num_clients):
-            if i in selected_client_indices:
-                selected_status[i] = True
+        selected_status = next_selected_status
 
         selections.append(np.array(selected_status).astype(int))
 
-        client_states = []
-        weights = []
-        for idx, client in enumerate(clients):
-            if selected_status[idx]:
-                # perform descent at client
-                client_state = client.train(
-                    server.model,
-                    criterion=fed_prox_criterion(server.model, mu=mu),
-                    E=E[idx],
-                    B=B,
-                    learning_rate=learning_rate,
-                    momentum=momentum,
-                )
-                weight = client.length  # number of data points at client
-                client_states.append(client_state)
-                weights.append(weight)
-
-        server.aggregate(client_states, weights)
-        test_acc_now = server.accuracy()
-        train_acc_now = np.sum(
-            [
-                client_weights[i] * clients[i].accuracy_(server.model)
-                for i in range(num_clients)
-            ]
+        # perform descent at the selected clients
+        selected_indices = [idx for idx in range(num_clients) if selected_status[idx]]
+        client_states = client_executor.train(
+            selected_indices,
+            server.model,
+            criterion=fed_prox_criterion(server.model, mu=mu),
+            E=E,
+            B=B,
+            learning_rate=learning_rate,
+            momentum=momentum,
+            seeds=[run.client_seed(t, idx) for idx in selected_indices],
         )
-        train_loss_now = np.sum(
-            [
-                client_weights[i] * clients[i].loss(server.model, fed_avg_criterion())
-                for i in range(num_clients)
+        if t + 1 < T:
+            next_selected_status = uniform_selection(num_clients, num_selected)
+            next_indices = [
+                idx for idx in range(num_clients) if next_selected_status[idx]
             ]
-        )
-        val_loss_now = server.val_loss(server.model, fed_avg_criterion())
-        test_loss_now = server.test_loss(fed_avg_criterion())
+            stage_round(client_executor, run, t + 1, next_indices, E, B)
+        # number of data points at client
+        weights = [clients[idx].length for idx in selected_indices]
+
+        server.aggregate(client_states, weights)
+        test_acc_now, test_loss_now, val_loss_now = server.evaluate(fed_avg_criterion())
+        if (t + 1) % eval_every == 0 or t == T - 1:
+            train_acc_now, train_loss_now = client_metrics.weighted(
+                server.model, client_weights
+            )
+        else:
+            train_acc_now, train_loss_now = np.nan, np.nan
 
         train_acc.append(train_acc_now)
         test_acc.append(test_acc_now)
@@ -334,8 +507,12 @@ def fed_prox_run(
             "val_loss": val_loss_now,
             "test_loss": test_loss_now,
         }
-        if logging == True:
-            wandb.log(log_dict)
+        log_dict.update(client_executor.prefetch_timings())
+        run.log(t, log_dict)
+        profiler.end_round(t, algorithm="fedprox", random_seed=random_seed)
+
+    client_executor.close()
+    run.close()
 
     if logging == True:
         wandb.finish()
@@ -355,22 +532,27 @@ def power_of_choice_run(
     learning_rate=0.01,
     momentum=0.5,
     logging=False,
+    sink=None,
+    executor="sequential",
+    num_workers=1,
+    eval_every=1,
+    prefetch=0,
 ):
     """
     Power of Choice
     decay_factor (default = 1, no decay)
         determines the decay rate of number of clients to transmit the server model to (choose_from)
     """
-    clients = deepcopy(clients)
+    run = RunContext(clients, server, random_seed, sink, logging)
+    clients, server = run.clients, run.server
     client_weights = np.array([client.length for client in clients])
     client_weights = client_weights / np.sum(client_weights)
-    server = deepcopy(server)
-    torch.manual_seed(random_seed)
-    np.random.seed(random_seed)
     num_clients = len(clients)
     if type(E) == int:
         E = [E for _ in range(num_clients)]
     num_selected = int(np.ceil(select_fraction * num_clients))
+    client_executor = make_executor(executor, clients, num_workers, prefetch)
+    client_metrics = ClientMetrics(clients)
 
     test_acc = []
     train_acc = []
@@ -397,12 +579,10 @@ def power_of_choice_run(
 
         selections.append(np.array(selected_status).astype(int))
 
-        client_losses = []  # will store array of size choose_from
-        for idx, client in enumerate(clients):
-            if selected_status[idx]:
-                # query selected clients for loss
-                client_loss = client.loss(server.model, fed_avg_criterion())
-                client_losses.append(client_loss)
+        # query selected clients for loss (array of size choose_from), only their data
+        # is read
+        candidates = [idx for idx in range(num_clients) if selected_status[idx]]
+        _, client_losses = client_metrics.evaluate(server.model, candidates)
         # find indices of largest num_selected values in client_losses
         indices = topk(client_losses, num_selected)
         selected_client_indices_2 = []  # will store array of size num_selected
@@ -414,39 +594,29 @@ def power_of_choice_run(
             if i in selected_client_indices_2:
                 selected_status[i] = True
 
-        client_states = []
-        weights = []
-        for idx, client in enumerate(clients):
-            if selected_status[idx]:
-                # perform descent at client
-                client_state = client.train(
-                    server.model,
-                    criterion=fed_avg_criterion(),
-                    E=E[idx],
-                    B=B,
-                    learning_rate=learning_rate,
-                    momentum=momentum,
-                )
-                weight = client.length  # number of data points at client
-                client_states.append(client_state)
-                weights.append(weight)
+        # perform descent at the selected clients
+        selected_indices = [idx for idx in range(num_clients) if selected_status[idx]]
+        client_states = client_executor.train(
+            selected_indices,
+            server.model,
+            criterion=fed_avg_criterion(),
+            E=E,
+            B=B,
+            learning_rate=learning_rate,
+            momentum=momentum,
+            seeds=[run.client_seed(t, idx) for idx in selected_indices],
+        )
+        # number of data points at client
+        weights = [clients[idx].length for idx in selected_indices]
 
         server.aggregate(client_states, weights)
-        test_acc_now = server.accuracy()
-        train_acc_now = np.sum(
-            [
-                client_weights[i] * clients[i].accuracy_(server.model)
-                for i in range(num_clients)
-            ]
-        )
-        train_loss_now = np.sum(
-            [
-                client_weights[i] * clients[i].loss(server.model, fed_avg_criterion())
-                for i in range(num_clients)
-            ]
-        )
-        val_loss_now = server.val_loss(server.model, fed_avg_criterion())
-        test_loss_now = server.test_loss(fed_avg_criterion())
+        test_acc_now, test_loss_now, val_loss_now = server.evaluate(fed_avg_criterion())
+        if (t + 1) % eval_every == 0 or t == T - 1:
+            train_acc_now, train_loss_now = client_metrics.weighted(
+                server.model, client_weights
+            )
+        else:
+            train_acc_now, train_loss_now = np.nan, np.nan
 
         train_acc.append(train_acc_now)
         test_acc.append(test_acc_now)
@@ -461,8 +631,12 @@ def power_of_choice_run(
             "val_loss": val_loss_now,
             "test_loss": test_loss_now,
         }
-        if logging == True:
-            wandb.log(log_dict)
+        log_dict.update(client_executor.prefetch_timings())
+        run.log(t, log_dict)
+        profiler.end_round(t, algorithm="poc", random_seed=random_seed)
+
+    client_executor.close()
+    run.close()
 
     if logging == True:
         wandb.finish()
@@ -587,24 +761,26 @@ def ucb_run(
     learning_rate=0.01,
     momentum=0.5,
     logging=False,
+    sink=None,
+    executor="sequential",
+    num_workers=1,
+    eval_every=1,
+    prefetch=0,
+    async_metrics=False,
 ):
-    clients = deepcopy(clients)
+    run = RunContext(clients, server, random_seed, sink, logging)
+    clients, server = run.clients, run.server
     client_weights = np.array([client.length for client in clients])
     client_weights = client_weights / np.sum(client_weights)
-    server = deepcopy(server)
-    torch.manual_seed(random_seed)
-    np.random.seed(random_seed)
     num_clients = len(clients)
     if type(E) == int:
         E = [E for _ in range(num_clients)]
     num_selected = int(np.ceil(select_fraction * num_clients))
-
-    test_acc = []
-    train_acc = []
-    train_loss = []
-    val_loss = []
-    val_loss_0 = server.val_loss(server.model, fed_avg_criterion())
-    test_loss = []
+    client_executor = make_executor(executor, clients, num_workers, prefetch)
+    client_metrics = ClientMetrics(clients)
+    round_metrics = RoundMetrics(
+        server, client_metrics, client_weights, T, eval_every, run.log, async_metrics
+    )
 
     shapley_values_T = []
     shapley_values_curr_T = []
@@ -613,6 +789,7 @@ def ucb_run(
     draws_T = []
     sv_rounds = {"gtg": [], "tmc": [], "true": []}
     num_model_evaluations = {"gtg": [], "tmc": [], "true": []}
+    cache_hit_rates = {"gtg": [], "tmc": [], "true": []}
 
     N_t = [0 for i in range(num_clients)]
     UCB = [0 for i in range(num_clients)]
@@ -640,29 +817,31 @@ def ucb_run(
                     selected_status[idx] = True
                     N_t[idx] += 1
         else:
-            # do UCB selection
-            selected_indices = topk(UCB, num_selected)
+            # do UCB selection (drawn at the end of the previous round)
+            selected_indices = next_ucb_selection
             for idx in selected_indices:
                 selected_status[idx] = True
                 N_t[idx] += 1
         # uniform random
-        client_states = []
-        weights = []
-
-        for idx, client in enumerate(clients):
-            if selected_status[idx]:
-                # perform descent at client
-                client_state = client.train(
-                    server.model,
-                    criterion=fed_avg_criterion(),
-                    E=E[idx],
-                    B=B,
-                    learning_rate=learning_rate,
-                    momentum=momentum,
-                )
-                weight = client.length  # number of data points at client
-                client_states.append(client_state)
-                weights.append(weight)
+        # perform descent at the selected clients
+        selected_indices = [idx for idx in range(num_clients) if selected_status[idx]]
+        client_states = client_executor.train(
+            selected_indices,
+            server.model,
+            criterion=fed_avg_criterion(),
+            E=E,
+            B=B,
+            learning_rate=learning_rate,
+            momentum=momentum,
+            seeds=[run.client_seed(t, idx) for idx in selected_indices],
+        )
+        # the first rounds select clients in a fixed order, so the next round's
+        # minibatches can be staged while the Shapley values are computed
+        if t + 1 < np.floor(num_clients / num_selected):
+            next_indices = list(range((t + 1) * num_selected, (t + 2) * num_selected))
+            stage_round(client_executor, run, t + 1, next_indices, E, B)
+        # number of data points at client
+        weights = [clients[idx].length for idx in selected_indices]
 
         # compute shapley values for each client BEFORE updating server model
 
@@ -682,6 +861,7 @@ def ucb_run(
         # print(f"server evaluations = {server.model_evaluations}")
         # # print(f"SV = {shapley_values_tmc}")
         # num_model_evaluations["tmc"].append(server.model_evaluations)
+        # cache_hit_rates["tmc"].append(server.cache_hit_rate())
 
         # print("starting GTG")
         server.model_evaluations = 0
@@ -691,6 +871,7 @@ def ucb_run(
         # print(f"server evaluations = {server.model_evaluations}")
         # print(f"SV = {shapley_values_gtg}")
         num_model_evaluations["gtg"].append(server.model_evaluations)
+        cache_hit_rates["gtg"].append(server.cache_hit_rate())
 
         # print("starting True")
         # server.model_evaluations = 0
@@ -700,6 +881,7 @@ def ucb_run(
         # print(f"server evaluations = {server.model_evaluations}")
         # # print(f"SV = {shapley_values_true}")
         # num_model_evaluations["true"].append(server.model_evaluations)
+        # cache_hit_rates["true"].append(server.cache_hit_rate())
 
         sv_rounds["gtg"].append(shapley_values_gtg)
         # sv_rounds["tmc"].append(shapley_values_tmc)
@@ -710,38 +892,13 @@ def ucb_run(
 
         # update server model
         server.aggregate(client_states, weights)
-        test_acc_now = server.accuracy()
-        train_acc_now = np.sum(
-            [
-                client_weights[i] * clients[i].accuracy_(server.model)
-                for i in range(num_clients)
-            ]
-        )
-        train_loss_now = np.sum(
-            [
-                client_weights[i] * clients[i].loss(server.model, fed_avg_criterion())
-                for i in range(num_clients)
-            ]
-        )
-        val_loss_now = server.val_loss(server.model, fed_avg_criterion())
-        test_loss_now = server.test_loss(fed_avg_criterion())
-
-        train_acc.append(train_acc_now)
-        test_acc.append(test_acc_now)
-        train_loss.append(train_loss_now)
-        val_loss.append(val_loss_now)
-        test_loss.append(test_loss_now)
+        # test and train metrics of this round do not affect the next selection, with
+        # async_metrics they are computed while the next round trains
+        round_metrics.submit(t)
 
         # compute UCB for next round of selections
         selections = [0 for i in range(num_clients)]
         counter = 0
-        if t == 0:
-            val_loss_diff = np.abs(np.diff([val_loss_0] + val_loss)[-1])
-        else:
-            curr_val_loss_diff = np.diff(val_loss)[-1]
-            if curr_val_loss_diff < 0:
-                # if val loss decreased
-                val_loss_diff = -1 * curr_val_loss_diff  # else stick to previous value
         for i in range(num_clients):
             if selected_status[i]:
                 SV_curr[i] = shapley_values[counter]
@@ -755,26 +912,27 @@ def ucb_run(
             else:
                 SV_curr[i] = 0
             UCB[i] = SV[i] + beta * np.sqrt(np.log(t + 1) / N_t[i])
+        if t + 1 > np.floor(num_clients / num_selected) and t + 1 < T:
+            next_ucb_selection = topk(UCB, num_selected)
+            stage_round(client_executor, run, t + 1, next_ucb_selection, E, B)
         shapley_values_T.append(deepcopy(SV))
         shapley_values_curr_T.append(deepcopy(SV_curr))
         ucb_values_T.append(deepcopy(UCB))
         selections_T.append(deepcopy(selections))
         draws_T.append(deepcopy(N_t))
         log_dict = {
-            "train_accuracy": train_acc_now,
-            "test_accuracy": test_acc_now,
-            "train_loss": train_loss_now,
-            "val_loss": val_loss_now,
-            "test_loss": test_loss_now,
+            "model_evaluations": num_model_evaluations["gtg"][-1],
+            "cache_hit_rate": cache_hit_rates["gtg"][-1],
         }
 
-        for i in range(num_clients):
-            log_dict[f"shapley_value_{i}"] = SV[i]
-            log_dict[f"shapley_value_{i}_curr"] = SV_curr[i]
-            log_dict[f"selection_{i}"] = selections[i]
+        # per-client values are logged as arrays
+        log_dict["shapley_values"] = np.array(SV)
+        log_dict["shapley_values_curr"] = np.array(SV_curr)
+        log_dict["selections"] = np.array(selections)
 
-        if logging == True:
-            wandb.log(log_dict)
+        log_dict.update(client_executor.prefetch_timings())
+        round_metrics.log(t, log_dict)
+        profiler.end_round(t, algorithm="ucb", random_seed=random_seed)
 
         # if t % 10 == 0:
         #     sns.heatmap(selections_T).set(title="selections")
@@ -782,6 +940,10 @@ def ucb_run(
         #     sns.heatmap(shapley_values_T).set(title="SV")
         #     plt.show()
 
+    client_executor.close()
+    test_acc, train_acc, train_loss, val_loss, test_loss = round_metrics.close()
+    run.close()
+
     if logging == True:
         wandb.finish()
 
@@ -809,25 +971,29 @@ def greedy_shap_run(
     learning_rate=0.01,
     momentum=0.5,
     logging=False,
+    sink=None,
     shap_memory=0.8,
+    executor="sequential",
+    num_workers=1,
+    eval_every=1,
+    prefetch=0,
+    async_metrics=False,
 ):
-    clients = deepcopy(clients)
+    run = RunContext(clients, server, random_seed, sink, logging)
+    clients, server = run.clients, run.server
     client_weights = np.array([client.length for client in clients])
     client_weights = client_weights / np.sum(client_weights)
-    server = deepcopy(server)
-    torch.manual_seed(random_seed)
-    np.random.seed(random_seed)
     num_clients = len(clients)
     if type(E) == int:
         E = [E for _ in range(num_clients)]
     num_selected = int(np.ceil(select_fraction * num_clients))
+    client_executor = make_executor(executor, clients, num_workers, prefetch)
+    client_metrics = ClientMetrics(clients)
+    round_metrics = RoundMetrics(
+        server, client_metrics, client_weights, T, eval_every, run.log, async_metrics
+    )
 
-    test_acc = []
-    train_acc = []
-    train_loss = []
-    val_loss = []
     val_loss_0 = server.val_loss(server.model, fed_avg_criterion())
-    test_loss = []
 
     shapley_values_T = []
     shapley_values_curr_T = []
@@ -836,6 +1002,7 @@ def greedy_shap_run(
     draws_T = []
     sv_rounds = {"gtg": [], "tmc": [], "true": []}
     num_model_evaluations = {"gtg": [], "tmc": [], "true": []}
+    cache_hit_rates = {"gtg": [], "tmc": [], "true": []}
 
     N_t = [0 for i in range(num_clients)]
     UCB = [0 for i in range(num_clients)]
@@ -863,29 +1030,31 @@ def greedy_shap_run(
                     selected_status[idx] = True
                     N_t[idx] += 1
         else:
-            # do UCB selection
-            selected_indices = topk(UCB, num_selected)
+            # do UCB selection (drawn at the end of the previous round)
+            selected_indices = next_ucb_selection
             for idx in selected_indices:
                 selected_status[idx] = True
                 N_t[idx] += 1
         # uniform random
-        client_states = []
-        weights = []
-
-        for idx, client in enumerate(clients):
-            if selected_status[idx]:
-                # perform descent at client
-                client_state = client.train(
-                    server.model,
-                    criterion=fed_avg_criterion(),
-                    E=E[idx],
-                    B=B,
-                    learning_rate=learning_rate,
-                    momentum=momentum,
-                )
-                weight = client.length  # number of data points at client
-                client_states.append(client_state)
-                weights.append(weight)
+        # perform descent at the selected clients
+        selected_indices = [idx for idx in range(num_clients) if selected_status[idx]]
+        client_states = client_executor.train(
+            selected_indices,
+            server.model,
+            criterion=fed_avg_criterion(),
+            E=E,
+            B=B,
+            learning_rate=learning_rate,
+            momentum=momentum,
+            seeds=[run.client_seed(t, idx) for idx in selected_indices],
+        )
+        # the first rounds select clients in a fixed order, so the next round's
+        # minibatches can be staged while the Shapley values are computed
+        if t + 1 < np.floor(num_clients / num_selected):
+            next_indices = list(range((t + 1) * num_selected, (t + 2) * num_selected))
+            stage_round(client_executor, run, t + 1, next_indices, E, B)
+        # number of data points at client
+        weights = [clients[idx].length for idx in selected_indices]
 
         # compute shapley values for each client BEFORE updating server model
 
@@ -905,6 +1074,7 @@ def greedy_shap_run(
         # print(f"server evaluations = {server.model_evaluations}")
         # # print(f"SV = {shapley_values_tmc}")
         # num_model_evaluations["tmc"].append(server.model_evaluations)
+        # cache_hit_rates["tmc"].append(server.cache_hit_rate())
 
         # print("starting GTG")
         server.model_evaluations = 0
@@ -914,6 +1084,7 @@ def greedy_shap_run(
         # print(f"server evaluations = {server.model_evaluations}")
         # print(f"SV = {shapley_values_gtg}")
         num_model_evaluations["gtg"].append(server.model_evaluations)
+        cache_hit_rates["gtg"].append(server.cache_hit_rate())
 
         # print("starting True")
         # server.model_evaluations = 0
@@ -923,6 +1094,7 @@ def greedy_shap_run(
         # print(f"server evaluations = {server.model_evaluations}")
         # # print(f"SV = {shapley_values_true}")
         # num_model_evaluations["true"].append(server.model_evaluations)
+        # cache_hit_rates["true"].append(server.cache_hit_rate())
 
         sv_rounds["gtg"].append(shapley_values_gtg)
         # sv_rounds["tmc"].append(shapley_values_tmc)
@@ -933,38 +1105,23 @@ def greedy_shap_run(
 
         # update server model
         server.aggregate(client_states, weights)
-        test_acc_now = server.accuracy()
-        train_acc_now = np.sum(
-            [
-                client_weights[i] * clients[i].accuracy_(server.model)
-                for i in range(num_clients)
-            ]
-        )
-        train_loss_now = np.sum(
-            [
-                client_weights[i] * clients[i].loss(server.model, fed_avg_criterion())
-                for i in range(num_clients)
-            ]
-        )
-        val_loss_now = server.val_loss(server.model, fed_avg_criterion())
-        test_loss_now = server.test_loss(fed_avg_criterion())
-
-        train_acc.append(train_acc_now)
-        test_acc.append(test_acc_now)
-        train_loss.append(train_loss_now)
-        val_loss.append(val_loss_now)
-        test_loss.append(test_loss_now)
+        # test and train metrics of this round do not affect the next selection, with
+        # async_metrics they are computed while the next round trains
+        round_metrics.submit(t)
 
         # compute UCB for next round of selections
         selections = [0 for i in range(num_clients)]
         counter = 0
-        if t == 0:
-            val_loss_diff = np.abs(np.diff([val_loss_0] + val_loss)[-1])
-        else:
-            curr_val_loss_diff = np.diff(val_loss)[-1]
-            if curr_val_loss_diff < 0:
-                # if val loss decreased
-                val_loss_diff = -1 * curr_val_loss_diff  # else stick to previous value
+        if shap_memory == "mean-norm":
+            # normalising by the decrease in validation loss waits for this round
+            val_loss = round_metrics.val_losses()
+            if t == 0:
+                val_loss_diff = np.abs(np.diff([val_loss_0] + val_loss)[-1])
+            else:
+                curr_val_loss_diff = np.diff(val_loss)[-1]
+                if curr_val_loss_diff < 0:
+                    # if val loss decreased
+                    val_loss_diff = -1 * curr_val_loss_diff  # else stick to previous
         for i in range(num_clients):
             if selected_status[i]:
                 SV_curr[i] = shapley_values[counter]
@@ -985,26 +1142,27 @@ def greedy_shap_run(
             else:
                 SV_curr[i] = 0
             UCB[i] = SV[i]
+        if t + 1 > np.floor(num_clients / num_selected) and t + 1 < T:
+            next_ucb_selection = topk(UCB, num_selected)
+            stage_round(client_executor, run, t + 1, next_ucb_selection, E, B)
         shapley_values_T.append(deepcopy(SV))
         shapley_values_curr_T.append(deepcopy(SV_curr))
         ucb_values_T.append(deepcopy(UCB))
         selections_T.append(deepcopy(selections))
         draws_T.append(deepcopy(N_t))
         log_dict = {
-            "train_accuracy": train_acc_now,
-            "test_accuracy": test_acc_now,
-            "train_loss": train_loss_now,
-            "val_loss": val_loss_now,
-            "test_loss": test_loss_now,
+            "model_evaluations": num_model_evaluations["gtg"][-1],
+            "cache_hit_rate": cache_hit_rates["gtg"][-1],
         }
 
-        for i in range(num_clients):
-            log_dict[f"shapley_value_{i}"] = SV[i]
-            log_dict[f"shapley_value_{i}_curr"] = SV_curr[i]
-            log_dict[f"selection_{i}"] = selections[i]
+        # per-client values are logged as arrays
+        log_dict["shapley_values"] = np.array(SV)
+        log_dict["shapley_values_curr"] = np.array(SV_curr)
+        log_dict["selections"] = np.array(selections)
 
-        if logging == True:
-            wandb.log(log_dict)
+        log_dict.update(client_executor.prefetch_timings())
+        round_metrics.log(t, log_dict)
+        profiler.end_round(t, algorithm="greedyfed", random_seed=random_seed)
 
         # if t % 10 == 0:
         #     sns.heatmap(selections_T).set(title="selections")
@@ -1012,6 +1170,10 @@ def greedy_shap_run(
         #     sns.heatmap(shapley_values_T).set(title="SV")
         #     plt.show()
 
+    client_executor.close()
+    test_acc, train_acc, train_loss, val_loss, test_loss = round_metrics.close()
+    run.close()
+
     if logging == True:
         wandb.finish()
 
@@ -1042,19 +1204,24 @@ def sfedavg_run(
     learning_rate=0.01,
     momentum=0.5,
     logging=False,
+    sink=None,
     temperature=1e2,
     alpha_init=3e-2,
+    executor="sequential",
+    num_workers=1,
+    eval_every=1,
+    prefetch=0,
 ):
-    clients = deepcopy(clients)
+    run = RunContext(clients, server, random_seed, sink, logging)
+    clients, server = run.clients, run.server
     client_weights = np.array([client.length for client in clients])
     client_weights = client_weights / np.sum(client_weights)
-    server = deepcopy(server)
-    torch.manual_seed(random_seed)
-    np.random.seed(random_seed)
     num_clients = len(clients)
     if type(E) == int:
         E = [E for _ in range(num_clients)]
     num_selected = int(np.ceil(select_fraction * num_clients))
+    client_executor = make_executor(executor, clients, num_workers, prefetch)
+    client_metrics = ClientMetrics(clients)
 
     test_acc = []
     train_acc = []
@@ -1085,24 +1252,20 @@ def sfedavg_run(
             selected_status[idx] = True
             N_t[idx] += 1
         # uniform random
-        client_states = []
-        weights = []
-
-        for idx, client in enumerate(clients):
-            if selected_status[idx]:
-                # perform descent at client
-                client_state = client.train(
-                    server.model,
-                    criterion=fed_avg_criterion(),
-                    E=E[idx],
-                    B=B,
-                    learning_rate=learning_rate,
-                    momentum=momentum,
-                )
-                weight = client.length  # number of data points at client
-                weight /= probs[idx]  # for unbiased averaging
-                client_states.append(client_state)
-                weights.append(weight)
+        # perform descent at the selected clients
+        selected_indices = [idx for idx in range(num_clients) if selected_status[idx]]
+        client_states = client_executor.train(
+            selected_indices,
+            server.model,
+            criterion=fed_avg_criterion(),
+            E=E,
+            B=B,
+            learning_rate=learning_rate,
+            momentum=momentum,
+            seeds=[run.client_seed(t, idx) for idx in selected_indices],
+        )
+        # number of data points at client, reweighted for unbiased averaging
+        weights = [clients[idx].length / probs[idx] for idx in selected_indices]
 
         # compute shapley values for each client BEFORE updating server model
         # shapley_values = server.shapley_values_mc(
@@ -1111,26 +1274,21 @@ def sfedavg_run(
         # shapley_values = server.shapley_values_tmc(
         #     fed_avg_criterion(), client_states, weights
         # )
+        server.model_evaluations = 0
         shapley_values = server.shapley_values_gtg(
             fed_avg_criterion(), client_states, weights
         )
+        model_evaluations = server.model_evaluations
+        cache_hit_rate = server.cache_hit_rate()
         # update server model
         server.aggregate(client_states, weights)
-        test_acc_now = server.accuracy()
-        train_acc_now = np.sum(
-            [
-                client_weights[i] * clients[i].accuracy_(server.model)
-                for i in range(num_clients)
-            ]
-        )
-        train_loss_now = np.sum(
-            [
-                client_weights[i] * clients[i].loss(server.model, fed_avg_criterion())
-                for i in range(num_clients)
-            ]
-        )
-        val_loss_now = server.val_loss(server.model, fed_avg_criterion())
-        test_loss_now = server.test_loss(fed_avg_criterion())
+        test_acc_now, test_loss_now, val_loss_now = server.evaluate(fed_avg_criterion())
+        if (t + 1) % eval_every == 0 or t == T - 1:
+            train_acc_now, train_loss_now = client_metrics.weighted(
+                server.model, client_weights
+            )
+        else:
+            train_acc_now, train_loss_now = np.nan, np.nan
 
         train_acc.append(train_acc_now)
         test_acc.append(test_acc_now)
@@ -1161,13 +1319,19 @@ def sfedavg_run(
             "train_loss": train_loss_now,
             "val_loss": val_loss_now,
             "test_loss": test_loss_now,
+            "model_evaluations": model_evaluations,
+            "cache_hit_rate": cache_hit_rate,
         }
 
-        for i in range(num_clients):
-            log_dict[f"shapley_value_{i}"] = SV[i]
-            log_dict[f"selection_{i}"] = selections[i]
-        if logging == True:
-            wandb.log(log_dict)
+        # per-client values are logged as arrays
+        log_dict["shapley_values"] = np.array(SV)
+        log_dict["selections"] = np.array(selections)
+        log_dict.update(client_executor.prefetch_timings())
+        run.log(t, log_dict)
+        profiler.end_round(t, algorithm="sfedavg", random_seed=random_seed)
+
+    client_executor.close()
+    run.close()
 
     if logging == True:
         wandb.finish()
@@ -0,0 +1,398 @@
+import torch
+import numpy as np
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from datetime import datetime
+
+from algorithms import (
+    centralised_run,
+    fed_avg_criterion,
+    fed_avg_run,
+    fed_prox_run,
+    greedy_shap_run,
+    power_of_choice_run,
+    sfedavg_run,
+    ucb_run,
+)
+from client import Client
+from data_preprocess import CachedDataset, DatasetStore, load_processed
+from initialise import device, initNetworkData
+from model import NN
+from server import Server
+
+SIZES = [3, 6, 10, 15]
+ESTIMATORS = ["mc", "tmc", "gtg", "true"]
+ALGORITHMS = [
+    "fedavg",
+    "fedprox",
+    "poc",
+    "sfedavg",
+    "ucb",
+    "greedyfed",
+    "centralised",
+]
+
+
+def tiny_mnist(num_clients, samples_per_client=100, num_eval=1000, seed=0):
+    """
+    returns (clients, server) on MNIST-shaped random tensors (784 features, 10 classes)
+    drawn from a fixed seed, so the benchmark needs no downloaded data
+    the tensors are cached in processed_data/ like the preprocessed datasets
+    """
+    num_samples = num_clients * samples_per_client
+
+    def generate():
+        generator = torch.Generator().manual_seed(seed)
+        return tuple(
+            CachedDataset(
+                torch.rand((size, 784), generator=generator),
+                torch.randint(0, 10, (size,), generator=generator),
+            )
+            for size in [num_samples, num_eval, num_eval]
+        )
+
+    train_dataset, val_dataset, test_dataset = load_processed(
+        f"tiny_mnist_{num_samples}_{num_eval}_{seed}", generate
+    )
+    store = DatasetStore(
+        train_dataset.data,
+        train_dataset.targets,
+        [samples_per_client] * num_clients,
+        device,
+    )
+    clients = [
+        Client(store, store.offsets[i], store.lengths[i], device)
+        for i in range(num_clients)
+    ]
+    server = Server(
+        NN(input_dim=784, output_dim=10),
+        val_dataset.data,
+        val_dataset.targets,
+        test_dataset.data,
+        test_dataset.targets,
+        device,
+    )
+    return clients, server
+
+
+def make_network(dataset, num_clients, seed):
+    """
+    dataset - one of ["synthetic", "tiny-mnist"]
+    """
+    if dataset == "synthetic":
+        return initNetworkData(
+            "synthetic", num_clients, seed, 1, 1, update_noise_level=0
+        )
+    elif dataset == "tiny-mnist":
+        return tiny_mnist(num_clients, seed=seed)
+    raise Exception("Invalid benchmark dataset")
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def reset_peak_memory():
+    """
+    resets the peak reported by peak_memory(), on CPU this needs Linux
+    (/proc/self/clear_refs resets the peak resident set size)
+    """
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        return
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def resident_memory_mb(name):
+    """
+    name - "VmRSS" (current) or "VmHWM" (peak since reset) resident set size
+
+    returns the value from /proc/self/status, None if it cannot be read
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith(name + ":"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def peak_memory():
+    """
+    returns (peak_memory_mb, kind) of the benchmark since reset_peak_memory()
+    kind is "cuda_allocated" (peak tensor memory on the device), "rss" (peak resident
+    set size of the process, including the data loaded before the benchmark) or
+    "process_rss" where the peak cannot be reset (peak of the whole process so far,
+    never decreases between benchmarks)
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20, "cuda_allocated"
+    peak = resident_memory_mb("VmHWM")
+    if peak is not None and os.access("/proc/self/clear_refs", os.W_OK):
+        return peak, "rss"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, "process_rss"
+
+
+def measure(function, repeats, warmup=1):
+    """
+    returns the wall times of repeats calls of function after warmup calls
+    """
+    for _ in range(warmup):
+        function()
+    synchronize()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        synchronize()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def record(name, times, work, unit, **fields):
+    """
+    work - amount of work (in unit) done by one call
+
+    returns the result entry of one benchmark with the median time per call
+    """
+    median = float(np.median(times))
+    peak_memory_mb, peak_memory_kind = peak_memory()
+    return {
+        "benchmark": name,
+        **fields,
+        "time": median,
+        "times": times,
+        "throughput": work / median if median > 0 else None,
+        "throughput_unit": unit,
+        "peak_memory_mb": peak_memory_mb,
+        "peak_memory_kind": peak_memory_kind,
+        # resident set size when the benchmark ended, the peak above it is the
+        # benchmark's own transient memory
+        "resident_memory_mb": resident_memory_mb("VmRSS"),
+    }
+
+
+def bench_client_train(clients, server, E, B, repeats):
+    client = max(clients, key=lambda client: client.length)
+    samples = E * B * client.batch_size(B)
+    reset_peak_memory()
+    times = measure(
+        lambda: client.train(
+            server.model, fed_avg_criterion(), E, B, 0.01, 0.5, seed=0
+        ),
+        repeats,
+    )
+    return record(
+        "client_train", times, samples, "samples/s", E=E, B=B, samples=samples
+    )
+
+
+def trained_states(clients, server, M, E, B):
+    """
+    returns the trained states and data sizes of the first M clients
+    """
+    states = [
+        client.train(server.model, fed_avg_criterion(), E, B, 0.01, 0.5, seed=idx)
+        for idx, client in enumerate(clients[:M])
+    ]
+    weights = [client.length for client in clients[:M]]
+    return states, weights
+
+
+def bench_aggregate(server, states, weights, M, repeats):
+    reset_peak_memory()
+    times = measure(
+        lambda: server.aggregate_(states[:M], weights[:M]), repeats, warmup=2
+    )
+    return record("aggregate_", times, 1, "aggregations/s", M=M)
+
+
+def bench_shapley(server, states, weights, M, estimator, repeats):
+    shapley_values = getattr(server, "shapley_values_" + estimator)
+    evaluations = []
+
+    def call():
+        # every call starts from an empty coalition cache
+        server.utility_cache.clear()
+        np.random.seed(0)
+        shapley_values(fed_avg_criterion(), states[:M], weights[:M])
+        evaluations.append(server.model_evaluations)
+
+    reset_peak_memory()
+    # no warmup call, the true Shapley value at M = 15 takes minutes on a CPU
+    times = measure(call, repeats, warmup=0)
+    model_evaluations = evaluations[-1]
+    return record(
+        "shapley_values_" + estimator,
+        times,
+        model_evaluations,
+        "coalition evals/s",
+        M=M,
+        model_evaluations=model_evaluations,
+    )
+
+
+def run_algorithm(algorithm, clients, server, select_fraction, rounds, E, B):
+    kwargs = dict(random_seed=0, E=E, B=B, logging=False)
+    if algorithm == "fedavg":
+        fed_avg_run(clients, server, select_fraction, rounds, **kwargs)
+    elif algorithm == "fedprox":
+        fed_prox_run(clients, server, select_fraction, rounds, 0.1, **kwargs)
+    elif algorithm == "poc":
+        power_of_choice_run(
+            clients, server, select_fraction, rounds, decay_factor=0.9, **kwargs
+        )
+    elif algorithm == "sfedavg":
+        sfedavg_run(clients, server, select_fraction, rounds, 0.5, 0.5, **kwargs)
+    elif algorithm == "ucb":
+        ucb_run(clients, server, select_fraction, rounds, 0.1, **kwargs)
+    elif algorithm == "greedyfed":
+        greedy_shap_run(
+            clients, server, select_fraction, rounds, shap_memory=0.5, **kwargs
+        )
+    elif algorithm == "centralised":
+        centralised_run(clients, server, select_fraction, rounds, **kwargs)
+    else:
+        raise Exception("Invalid algorithm")
+
+
+def bench_round(algorithm, clients, server, select_fraction, rounds, E, B, repeats):
+    reset_peak_memory()
+    times = measure(
+        lambda: run_algorithm(
+            algorithm, clients, server, select_fraction, rounds, E, B
+        ),
+        repeats,
+        warmup=0,
+    )
+    # includes creating the run (RunContext, ClientMetrics) once per call
+    return record(
+        "round", times, rounds, "rounds/s", algorithm=algorithm, rounds=rounds
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    clients, server = make_network(args.dataset, args.num_clients, args.seed)
+    results = []
+
+    if "train" in args.benchmarks:
+        results.append(
+            bench_client_train(clients, server, args.epochs, args.batches, args.repeats)
+        )
+
+    if "aggregate" in args.benchmarks or "shapley" in args.benchmarks:
+        states, weights = trained_states(
+            clients, server, max(args.sizes), args.epochs, args.batches
+        )
+        for M in args.sizes:
+            if "aggregate" in args.benchmarks:
+                results.append(
+                    bench_aggregate(server, states, weights, M, args.repeats)
+                )
+            if "shapley" not in args.benchmarks:
+                continue
+            for estimator in args.estimators:
+                results.append(
+                    bench_shapley(
+                        server, states, weights, M, estimator, args.shapley_repeats
+                    )
+                )
+                print(estimator, M, results[-1]["time"])
+
+    if "rounds" in args.benchmarks:
+        for algorithm in args.algorithms:
+            results.append(
+                bench_round(
+                    algorithm,
+                    clients,
+                    server,
+                    args.select_fraction,
+                    args.rounds,
+                    args.epochs,
+                    args.batches,
+                    args.repeats,
+                )
+            )
+            print(algorithm, results[-1]["time"])
+
+    output = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "device": str(device),
+            "num_threads": torch.get_num_threads(),
+        },
+        "config": vars(args),
+        "results": results,
+    }
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=2)
+    print(f"results written to {args.output}")
+    return output
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the federated round")
+    parser.add_argument(
+        "--dataset", default="synthetic", choices=["synthetic", "tiny-mnist"]
+    )
+    parser.add_argument("--num-clients", type=int, default=100)
+    parser.add_argument("--select-fraction", type=float, default=0.03)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--shapley-repeats", type=int, default=1)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--estimators", nargs="+", default=ESTIMATORS)
+    parser.add_argument("--algorithms", nargs="+", default=ALGORITHMS)
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        default=["train", "aggregate", "shapley", "rounds"],
+        choices=["train", "aggregate", "shapley", "rounds"],
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(
+            "benchmarks", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+        ),
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,59 +1,136 @@
 import torch
 import torch.optim as optim
+import torch.nn.functional as F
+import numpy as np
 
 from copy import deepcopy
 
-import numpy as np
+from profiling import profiler, timed
+from utils import concatenate, prefetch
 
 
 class Client:
-    def __init__(self, data, targets, device, noise_level=0):
-        self.data = data.to(device)
-        self.targets = targets.to(device)
+    """
+    a client owns the range [offset, offset + length) of a shared DatasetStore
+    the trained model is only kept (in self.model) when keep_model is True
+    """
+
+    __slots__ = (
+        "store",
+        "offset",
+        "length",
+        "device",
+        "noise_level",
+        "keep_model",
+        "model",
+    )
+
+    def __init__(self, store, offset, length, device, noise_level=0, keep_model=False):
+        """
+        store - DatasetStore with the (contiguous float32) data of all clients
+        offset, length - range of this client's samples in the store
+        keep_model - keep a copy of the trained model after every call to train
+        """
+        self.store = store
+        self.offset = offset
+        self.length = length
         self.device = device
-        self.length = len(self.data)
         if noise_level is None:
             noise_level = 0
         self.noise_level = noise_level
+        self.keep_model = keep_model
+        self.model = None
+
+    @property
+    def data(self):
+        return self.store.data[self.offset : self.offset + self.length]
 
-    def train(self, serverModel, criterion, E, B, learning_rate, momentum):
+    @property
+    def targets(self):
+        return self.store.targets[self.offset : self.offset + self.length]
+
+    def __deepcopy__(self, memo):
+        """
+        copies share the (read-only) store, only per-run state is copied
+        """
+        memo[id(self.store)] = self.store
+        client = Client.__new__(Client)
+        memo[id(self)] = client
+        for name in Client.__slots__:
+            setattr(client, name, deepcopy(getattr(self, name), memo))
+        return client
+
+    @timed("client.train")
+    def train(
+        self,
+        serverModel,
+        criterion,
+        E,
+        B,
+        learning_rate,
+        momentum,
+        seed=None,
+        staged=None,
+    ):
         """
         serverModel - server model
         criterion - loss function (model, data, targets)
         E - number of epochs
         B - number of batches
+        seed - seed for minibatch shuffling and update noise (global RNG if None)
+        staged - (batches, generator) returned by stage(E, B, seed), used instead
+        of drawing the minibatches here
 
         returns clientModel.state_dict() after training
         """
+        if staged is None:
+            generator = self.generator(seed)
+            batches = self.batches(E, B, generator)
+        else:
+            batches, generator = staged
         clientModel = deepcopy(serverModel)
         clientModel = clientModel.to(self.device)
         clientModel.load_state_dict(serverModel.state_dict())
+        if profiler.enabled:
+            profiler.count_bytes(
+                "client.model_bytes", *clientModel.state_dict().values()
+            )
         clientOptimiser = optim.SGD(
             clientModel.parameters(), lr=learning_rate, momentum=momentum
         )
 
-        for epoch in range(E):
-            batch_indices = self.split_indices(B)
-            for batch in range(B):
-                data_batch, targets_batch = self.get_subset(batch_indices[batch])
-                clientOptimiser.zero_grad()
-                loss = criterion(clientModel, data_batch, targets_batch)
-                loss.backward()
-                clientOptimiser.step()
+        for data_batch, targets_batch in batches:
+            clientOptimiser.zero_grad()
+            loss = criterion(clientModel, data_batch, targets_batch)
+            loss.backward()
+            clientOptimiser.step()
 
-        self.model = deepcopy(clientModel)
+        if self.keep_model:
+            self.model = deepcopy(clientModel)
         if self.noise_level > 0:
-            clientModel = self.add_noise(clientModel, self.noise_level)
+            clientModel = self.add_noise(clientModel, self.noise_level, generator)
         return clientModel.state_dict()
 
-    def add_noise(self, model, noise_level):
+    def generator(self, seed):
+        """
+        returns a torch.Generator seeded with seed (None to use the global RNG)
+        """
+        if seed is None:
+            return None
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(int(seed))
+        return generator
+
+    def add_noise(self, model, noise_level, generator=None):
         """
         add noise to all model parameters with given noise_level
         """
         model_state = model.state_dict()
         for key in model_state.keys():
             model_state[key] += torch.normal(
-                mean=torch.zeros_like(model_state[key]), std=noise_level
+                mean=torch.zeros_like(model_state[key]),
+                std=noise_level,
+                generator=generator,
             )
         model.load_state_dict(model_state)
         return model
@@ -69,6 +146,9 @@ class Client:
         return float(loss.cpu())
 
     def accuracy(self):
+        """
+        accuracy of the last trained model (requires keep_model)
+        """
         return self.accuracy_(self.model)
 
     def accuracy_(self, model):
@@ -85,26 +165,183 @@ class Client:
         model.train()
         return float(accuracy.cpu())
 
+    def batches(self, E, B, generator=None):
+        """
+        yields the (data, targets) minibatches of E epochs with B batches each
+        for a lazy store the minibatch indices of all epochs are drawn first and the
+        minibatches are read by a background thread into a bounded prefetch queue
+        """
+        if not self.store.lazy:
+            for epoch in range(E):
+                batch_indices = self.split_indices(B, generator)
+                for batch in range(B):
+                    yield self.get_subset(batch_indices[batch])
+            return
+        batch_indices = [self.split_indices(B, generator) for epoch in range(E)]
+        yield from prefetch(
+            self.get_subset,
+            (indices for epoch_indices in batch_indices for indices in epoch_indices),
+            self.store.prefetch,
+        )
+
+    @timed("client.stage")
+    def stage(self, E, B, seed=None):
+        """
+        draws and gathers all minibatches of a call to train(E, B, seed) ahead of time
+
+        returns (batches, generator), a list of the E * B (data, targets) minibatches
+        and the generator in the state train leaves it in after drawing them
+        """
+        generator = self.generator(seed)
+        batch_indices = [self.split_indices(B, generator) for epoch in range(E)]
+        batches = [
+            self.get_subset(indices)
+            for epoch_indices in batch_indices
+            for indices in epoch_indices
+        ]
+        return batches, generator
+
     def get_subset(self, indices):
         """
         return a subset of client data and targets with the given indices
+        (read from the memory-mapped store and moved to device for a lazy store)
         """
-        data_raw = [self.data[j] for j in indices]
-        targets_raw = [int(self.targets[j]) for j in indices]
-        # prepare data and targets for training
-        data = torch.stack(data_raw, 0).to(device=self.device).to(torch.float32)
-        targets = torch.tensor(targets_raw).to(device=self.device)
+        if self.store.lazy:
+            indices = indices.cpu()
+            data, targets = self.data[indices], self.targets[indices]
+            if torch.device(self.device).type == "cuda":
+                # pinned host memory lets the copy run asynchronously
+                data, targets = data.pin_memory(), targets.pin_memory()
+            data = data.to(self.device, non_blocking=True)
+            targets = targets.to(self.device, non_blocking=True)
+        else:
+            data, targets = self.data[indices], self.targets[indices]
+        profiler.count_bytes("client.batch_bytes", data, targets)
         return data, targets
 
-    def split_indices(self, B):
+    def split_indices(self, B, generator=None):
+        """
+        return a (B, batch size) tensor of indices for B batches
         """
-        return a list of indices for B batches
+        indices = torch.randperm(self.length, generator=generator, device=self.device)
+        k = self.batch_size(B)
+        if k == self.length:
+            return indices.expand(B, k)
+        return indices[: k * B].view(B, k)
+
+    def batch_size(self, B):
         """
-        length = self.length
-        indices = list(range(length))
-        np.random.shuffle(indices)
-        k = int(np.floor(length / B))
+        return the size of each of the B batches
+        """
+        k = self.length // B
         # drops the last few datapoints, if needed, to keep batch size fixed
         if k == 0:
-            return [indices for _ in range(B)]  # use all datapoints in each batch
-        return [indices[i : i + k] for i in range(0, len(indices), k)]
+            return self.length  # use all datapoints in each batch
+        return k
+
+
+class ClientMetrics:
+    """
+    evaluates a model on the training data of all clients at once
+    client data is concatenated into one tensor and segment[s] is the client of sample s,
+    so per-client accuracy and cross-entropy loss come from forward passes over chunks
+    of chunk_size samples, which bound the activation memory
+    evaluating all clients reads the whole training set (on a lazy store the whole
+    memory-mapped file), pass indices to read only the clients that are needed
+    """
+
+    def __init__(self, clients, chunk_size=4096):
+        """
+        clients - list of clients
+        chunk_size - number of samples per forward pass (all at once if None), the
+        default matches the server's eval_chunk_size
+        """
+        device = clients[0].device
+        self.data = concatenate([client.data for client in clients])
+        self.targets = concatenate([client.targets for client in clients])
+        self.lengths = torch.tensor(
+            [client.length for client in clients], dtype=torch.float32, device=device
+        )
+        self.segment = torch.repeat_interleave(
+            torch.arange(len(clients), device=device),
+            self.lengths.long(),
+        )
+        # client i owns the samples offsets[i]:offsets[i + 1]
+        self.offsets = np.cumsum([0] + [client.length for client in clients])
+        self.num_clients = len(clients)
+        self.chunk_size = chunk_size or len(self.data)
+        self.device = device
+
+    def chunks(self, indices=None):
+        """
+        indices - clients to read (all clients if None)
+
+        yields (data, targets, segment) with at most chunk_size samples of the clients
+        in indices, segment[s] is the position in indices of the client of sample s
+        """
+        if indices is None:
+            for start in range(0, len(self.data), self.chunk_size):
+                end = start + self.chunk_size
+                yield (
+                    self.data[start:end],
+                    self.targets[start:end],
+                    self.segment[start:end],
+                )
+            return
+        pieces = []  # (start, end, position) sample ranges of the next chunk
+        size = 0
+        for position, idx in enumerate(indices):
+            start, end = self.offsets[idx], self.offsets[idx + 1]
+            while start < end:
+                stop = min(end, start + self.chunk_size - size)
+                pieces.append((start, stop, position))
+                size += stop - start
+                start = stop
+                if size == self.chunk_size:
+                    yield self.gather(pieces)
+                    pieces, size = [], 0
+        if pieces:
+            yield self.gather(pieces)
+
+    def gather(self, pieces):
+        data = torch.cat([self.data[start:end] for start, end, _ in pieces])
+        targets = torch.cat([self.targets[start:end] for start, end, _ in pieces])
+        segment = torch.repeat_interleave(
+            torch.tensor([position for _, _, position in pieces], device=self.device),
+            torch.tensor([end - start for start, end, _ in pieces], device=self.device),
+        )
+        return data, targets, segment
+
+    @timed("metrics.evaluate")
+    def evaluate(self, model, indices=None):
+        """
+        indices - clients to evaluate (all clients if None)
+
+        returns (accuracies, losses), numpy arrays with the accuracy and cross-entropy
+        loss of model on the training data of every client in indices
+        """
+        lengths = self.lengths if indices is None else self.lengths[list(indices)]
+        correct = torch.zeros_like(lengths)
+        losses = torch.zeros_like(lengths)
+        model.eval()
+        with torch.no_grad():
+            for data, targets, segment in self.chunks(indices):
+                targets = targets.to(self.device)
+                scores = model(data.to(self.device))
+                _, predictions = scores.max(1)
+                correct.index_add_(0, segment, (predictions == targets).float())
+                losses.index_add_(
+                    0, segment, F.cross_entropy(scores, targets, reduction="none")
+                )
+        model.train()
+        metrics = (torch.stack([correct, losses]) / lengths).cpu().numpy()
+        return metrics[0], metrics[1]
+
+    def weighted(self, model, weights):
+        """
+        weights - client weights, array of shape (num_clients,)
+
+        returns the weighted train accuracy and train loss of model
+        """
+        accuracies, losses = self.evaluate(model)
+        return np.sum(weights * accuracies), np.sum(weights * losses)
@@ -1,303 +1,297 @@
 import torch
-from torch.utils.data import DataLoader
 import torchvision.datasets as datasets
-import torchvision.transforms as transforms
 from torch.distributions.dirichlet import Dirichlet
-from torch.distributions.multivariate_normal import MultivariateNormal
 import numpy as np
 
+import json
 import os
+from functools import partial
+from itertools import accumulate
 from os.path import exists
 
+# splits stored in every preprocessed-data cache, in the order returned by load_*
+SPLITS = ["train", "val", "test"]
 
-def data_transform_images(x):
-    to_tensor = transforms.ToTensor()
-    x = to_tensor(x)
-    x = torch.flatten(x)
-    return x
+# torchvision datasets that can be loaded
+DATASETS = {
+    "mnist": datasets.MNIST,
+    "fmnist": datasets.FashionMNIST,
+    "cifar10": datasets.CIFAR10,
+}
 
+# cache directory suffix of every data layout
+LAYOUTS = {"image": "", "flat": "_flat"}
 
-def download_mnist():
+
+class CachedDataset:
     """
-    returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    data and targets of one split loaded from the preprocessed-data cache
     """
-    train_data_global = datasets.MNIST(
-        root="dataset/", train=True, transform=transforms.ToTensor(), download=True
-    )  # 60000 samples
-    test_val_data_global = datasets.MNIST(
-        root="dataset/", train=False, transform=transforms.ToTensor(), download=True
-    )  # 10000 samples
-    val_data_global, test_data_global = torch.utils.data.random_split(
-        test_val_data_global, [0.5, 0.5]
-    )
 
-    num_train_points = train_data_global.__len__()
-    num_val_points = val_data_global.__len__()
-    num_test_points = test_data_global.__len__()
-
-    # random permutation of train indices
-    indices = np.random.permutation(num_train_points)
-    # shuffle the data
-    train_data_global.data = train_data_global.data[indices]
-    train_data_global.targets = train_data_global.targets[indices]
-    # apply transforms through DataLoader (cheap trick)
-    train_dataloader = DataLoader(train_data_global, batch_size=num_train_points)
-    train_data_global.data, train_data_global.targets = next(iter(train_dataloader))
+    def __init__(self, data, targets):
+        self.data = data
+        self.targets = targets
 
-    val_dataloader = DataLoader(val_data_global, batch_size=num_val_points)
-    val_data_global.data, val_data_global.targets = next(iter(val_dataloader))
+    def __len__(self):
+        return len(self.data)
 
-    test_dataloader = DataLoader(test_data_global, batch_size=num_test_points)
-    test_data_global.data, test_data_global.targets = next(iter(test_dataloader))
+    def __getitem__(self, idx):
+        return self.data[idx], self.targets[idx]
 
-    return train_data_global, val_data_global, test_data_global
 
+def save_cache(path, datasets):
+    """
+    path - cache directory
+    datasets - (train_dataset, validation_dataset, test_dataset)
 
-def load_mnist():
+    writes the data of every split as a raw float32 array and the targets as a raw
+    uint8 array, described by manifest.json (written last, marks a complete cache)
     """
-    returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    os.makedirs(path, exist_ok=True)
+    manifest = {}
+    for split, dataset in zip(SPLITS, datasets):
+        arrays = {
+            "data": np.ascontiguousarray(dataset.data, dtype=np.float32),
+            "targets": np.ascontiguousarray(dataset.targets, dtype=np.uint8),
+        }
+        manifest[split] = {}
+        for name, array in arrays.items():
+            filename = f"{split}_{name}.bin"
+            array.tofile(os.path.join(path, filename))
+            manifest[split][name] = {
+                "file": filename,
+                "dtype": str(array.dtype),
+                "shape": list(array.shape),
+            }
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_array(path, entry):
     """
-    if not exists("processed_data/mnist/test_data_global.pt"):
-        train_data_global, val_data_global, test_data_global = download_mnist()
-        os.makedirs("./processed_data/mnist/", exist_ok=True)
-        torch.save(train_data_global, "processed_data/mnist/train_data_global.pt")
-        torch.save(val_data_global, "processed_data/mnist/val_data_global.pt")
-        torch.save(test_data_global, "processed_data/mnist/test_data_global.pt")
-    else:
-        print("files already downloaded")
-        train_data_global = torch.load("processed_data/mnist/train_data_global.pt")
-        val_data_global = torch.load("processed_data/mnist/val_data_global.pt")
-        test_data_global = torch.load("processed_data/mnist/test_data_global.pt")
-
-    return train_data_global, val_data_global, test_data_global
+    memory-maps one array of the cache (copy-on-write, pages are shared between
+    processes reading the same file)
+    """
+    dtype = getattr(torch, entry["dtype"])
+    size = int(np.prod(entry["shape"]))
+    tensor = torch.from_file(
+        os.path.join(path, entry["file"]), shared=False, size=size, dtype=dtype
+    )
+    return tensor.view(entry["shape"])
 
 
-def download_cifar10():
+def load_cache(path):
     """
     returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    data is memory-mapped, targets are converted to int64
     """
-    train_data_global = datasets.CIFAR10(
-        root="dataset/", train=True, transform=transforms.ToTensor(), download=True
-    )  # 50000 samples
-    test_val_data_global = datasets.CIFAR10(
-        root="dataset/", train=False, transform=transforms.ToTensor(), download=True
-    )  # 10000 samples
-    val_data_global, test_data_global = torch.utils.data.random_split(
-        test_val_data_global, [0.5, 0.5]
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    return tuple(
+        CachedDataset(
+            load_array(path, manifest[split]["data"]),
+            load_array(path, manifest[split]["targets"]).long(),
+        )
+        for split in SPLITS
     )
 
-    num_train_points = train_data_global.__len__()
-    num_val_points = val_data_global.__len__()
-    num_test_points = test_data_global.__len__()
-
-    # apply transforms through DataLoader (cheap trick)
-
-    train_dataloader = DataLoader(train_data_global, batch_size=num_train_points)
-    train_data_global.data, train_data_global.targets = next(iter(train_dataloader))
-    ### random permutation of train indices
-    indices = torch.Tensor(np.random.permutation(num_train_points)).int()
-    ### shuffle the data
-    train_data_global.data = train_data_global.data[indices]
-    train_data_global.targets = train_data_global.targets[indices]
-
-    val_dataloader = DataLoader(val_data_global, batch_size=num_val_points)
-    val_data_global.data, val_data_global.targets = next(iter(val_dataloader))
-
-    test_dataloader = DataLoader(test_data_global, batch_size=num_test_points)
-    test_data_global.data, test_data_global.targets = next(iter(test_dataloader))
-
-    return train_data_global, val_data_global, test_data_global
-
 
-def load_cifar10():
+def load_processed(name, download):
     """
-    returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    name - cache directory in processed_data/
+    download - function returning (train_dataset, validation_dataset, test_dataset)
+
+    returns a tuple of (train_dataset, validation_dataset, test_dataset), downloading
+    and preprocessing them into the cache on first use
     """
-    if not exists("processed_data/cifar10/test_data_global.pt"):
-        train_data_global, val_data_global, test_data_global = download_cifar10()
-        os.makedirs("./processed_data/cifar10/", exist_ok=True)
-        torch.save(train_data_global, "processed_data/cifar10/train_data_global.pt")
-        torch.save(val_data_global, "processed_data/cifar10/val_data_global.pt")
-        torch.save(test_data_global, "processed_data/cifar10/test_data_global.pt")
-    else:
+    path = os.path.join("processed_data", name)
+    if exists(os.path.join(path, "manifest.json")):
         print("files already downloaded")
-        train_data_global = torch.load("processed_data/cifar10/train_data_global.pt")
-        val_data_global = torch.load("processed_data/cifar10/val_data_global.pt")
-        test_data_global = torch.load("processed_data/cifar10/test_data_global.pt")
-
-    return train_data_global, val_data_global, test_data_global
+    elif exists(os.path.join(path, "test_data_global.pt")):
+        # convert a cache of torch.save'd Dataset objects, keeping its splits
+        save_cache(
+            path,
+            [
+                torch.load(
+                    os.path.join(path, f"{split}_data_global.pt"), weights_only=False
+                )
+                for split in SPLITS
+            ],
+        )
+    else:
+        save_cache(path, download())
+    return load_cache(path)
 
 
-def download_mnist_flat():
-    """
-    returns a tuple of (train_dataset, validation_dataset, test_dataset)
+def raw_dataset(dataset, root="dataset/"):
     """
-    train_data_global = datasets.MNIST(
-        root="dataset/", train=True, transform=data_transform_images, download=True
-    )  # 60000 samples
-    test_val_data_global = datasets.MNIST(
-        root="dataset/", train=False, transform=data_transform_images, download=True
-    )  # 10000 samples
-    val_data_global, test_data_global = torch.utils.data.random_split(
-        test_val_data_global, [0.5, 0.5]
-    )
+    returns ((train_images, train_targets), (test_images, test_targets)) with uint8
+    images of shape (N, H, W) or (N, H, W, C) and int64 targets
 
-    num_train_points = train_data_global.__len__()
-    num_val_points = val_data_global.__len__()
-    num_test_points = test_data_global.__len__()
-
-    # random permutation of train indices
-    indices = np.random.permutation(num_train_points)
-    # shuffle the data
-    train_data_global.data = train_data_global.data[indices]
-    train_data_global.targets = train_data_global.targets[indices]
-    # apply transforms through DataLoader (cheap trick)
-    train_dataloader = DataLoader(train_data_global, batch_size=num_train_points)
-    train_data_global.data, train_data_global.targets = next(iter(train_dataloader))
-
-    val_dataloader = DataLoader(val_data_global, batch_size=num_val_points)
-    val_data_global.data, val_data_global.targets = next(iter(val_dataloader))
-
-    test_dataloader = DataLoader(test_data_global, batch_size=num_test_points)
-    test_data_global.data, test_data_global.targets = next(iter(test_dataloader))
-
-    return train_data_global, val_data_global, test_data_global
+    reads root/<dataset>.npz (arrays x_train, y_train, x_test, y_test) when it exists,
+    so data supplied ahead of time is preprocessed without network access, otherwise
+    uses torchvision (files already in root are not downloaded again)
+    """
+    local_file = os.path.join(root, f"{dataset}.npz")
+    if exists(local_file):
+        with np.load(local_file) as arrays:
+            return tuple(
+                (
+                    torch.as_tensor(arrays[f"x_{split}"]),
+                    torch.as_tensor(arrays[f"y_{split}"]).long(),
+                )
+                for split in ["train", "test"]
+            )
+    splits = []
+    for train in [True, False]:
+        data = DATASETS[dataset](root=root, train=train, download=True)
+        splits.append(
+            (torch.as_tensor(data.data), torch.as_tensor(data.targets).long())
+        )
+    return tuple(splits)
 
 
-def load_mnist_flat():
+def transform_images(images, layout, chunk_size=10000):
     """
-    returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    images - uint8 images of shape (N, H, W) or (N, H, W, C)
+    layout - "image" for (N, C, H, W) or "flat" for (N, C * H * W) outputs
+
+    returns float32 images scaled to [0, 1] (as transforms.ToTensor, flattened for the
+    flat layout), converted chunk_size images at a time
     """
-    if not exists("processed_data/mnist_flat/test_data_global.pt"):
-        train_data_global, val_data_global, test_data_global = download_mnist_flat()
-        os.makedirs("./processed_data/mnist_flat/", exist_ok=True)
-        torch.save(train_data_global, "processed_data/mnist_flat/train_data_global.pt")
-        torch.save(val_data_global, "processed_data/mnist_flat/val_data_global.pt")
-        torch.save(test_data_global, "processed_data/mnist_flat/test_data_global.pt")
+    if images.dim() == 3:
+        images = images.unsqueeze(-1)
+    num_images, height, width, channels = images.shape
+    if layout == "image":
+        shape = (num_images, channels, height, width)
     else:
-        print("files already downloaded")
-        train_data_global = torch.load("processed_data/mnist_flat/train_data_global.pt")
-        val_data_global = torch.load("processed_data/mnist_flat/val_data_global.pt")
-        test_data_global = torch.load("processed_data/mnist_flat/test_data_global.pt")
-
-    return train_data_global, val_data_global, test_data_global
+        shape = (num_images, channels * height * width)
+    output = torch.empty(shape, dtype=torch.float32)
+    for start in range(0, num_images, chunk_size):
+        chunk = output[start : start + chunk_size]
+        channels_first = images[start : start + chunk_size].permute(0, 3, 1, 2)
+        chunk.copy_(channels_first.reshape(chunk.shape))
+        chunk.div_(255)
+    return output
 
 
-def download_fmnist_flat():
+def download_dataset(dataset, layout, root="dataset/"):
     """
     returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    the test set is split 50:50 into validation and test sets and the train set is shuffled
     """
-    train_data_global = datasets.FashionMNIST(
-        root="dataset/", train=True, transform=data_transform_images, download=True
-    )  # 60000 samples
-    test_val_data_global = datasets.FashionMNIST(
-        root="dataset/", train=False, transform=data_transform_images, download=True
-    )  # 10000 samples
-    val_data_global, test_data_global = torch.utils.data.random_split(
-        test_val_data_global, [0.5, 0.5]
+    (train_images, train_targets), (test_images, test_targets) = raw_dataset(
+        dataset, root
+    )
+    val_split, test_split = torch.utils.data.random_split(
+        range(len(test_images)), [0.5, 0.5]
     )
-
-    num_train_points = train_data_global.__len__()
-    num_val_points = val_data_global.__len__()
-    num_test_points = test_data_global.__len__()
-
     # random permutation of train indices
-    indices = np.random.permutation(num_train_points)
-    # shuffle the data
-    train_data_global.data = train_data_global.data[indices]
-    train_data_global.targets = train_data_global.targets[indices]
-    # apply transforms through DataLoader (cheap trick)
-    train_dataloader = DataLoader(train_data_global, batch_size=num_train_points)
-    train_data_global.data, train_data_global.targets = next(iter(train_dataloader))
+    indices = torch.from_numpy(np.random.permutation(len(train_images)))
 
-    val_dataloader = DataLoader(val_data_global, batch_size=num_val_points)
-    val_data_global.data, val_data_global.targets = next(iter(val_dataloader))
+    datasets_global = []
+    for images, targets in [
+        (train_images[indices], train_targets[indices]),
+        (test_images[val_split.indices], test_targets[val_split.indices]),
+        (test_images[test_split.indices], test_targets[test_split.indices]),
+    ]:
+        datasets_global.append(CachedDataset(transform_images(images, layout), targets))
+    return tuple(datasets_global)
 
-    test_dataloader = DataLoader(test_data_global, batch_size=num_test_points)
-    test_data_global.data, test_data_global.targets = next(iter(test_dataloader))
 
-    return train_data_global, val_data_global, test_data_global
-
-
-def load_fmnist_flat():
-    """
-    returns a tuple of (train_dataset, validation_dataset, test_dataset)
+def load_dataset(dataset, layout, root="dataset/"):
     """
-    if not exists("processed_data/fmnist_flat/test_data_global.pt"):
-        train_data_global, val_data_global, test_data_global = download_fmnist_flat()
-        os.makedirs("./processed_data/fmnist_flat/", exist_ok=True)
-        torch.save(train_data_global, "processed_data/fmnist_flat/train_data_global.pt")
-        torch.save(val_data_global, "processed_data/fmnist_flat/val_data_global.pt")
-        torch.save(test_data_global, "processed_data/fmnist_flat/test_data_global.pt")
-    else:
-        print("files already downloaded")
-        train_data_global = torch.load(
-            "processed_data/fmnist_flat/train_data_global.pt"
-        )
-        val_data_global = torch.load("processed_data/fmnist_flat/val_data_global.pt")
-        test_data_global = torch.load("processed_data/fmnist_flat/test_data_global.pt")
-
-    return train_data_global, val_data_global, test_data_global
-
+    dataset - one of DATASETS
+    layout - one of LAYOUTS
 
-def download_cifar10_flat():
-    """
     returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    every (dataset, layout) is preprocessed once and then read from its cache
     """
-    train_data_global = datasets.CIFAR10(
-        root="dataset/", train=True, transform=data_transform_images, download=True
-    )  # 50000 samples
-    test_val_data_global = datasets.CIFAR10(
-        root="dataset/", train=False, transform=data_transform_images, download=True
-    )  # 10000 samples
-    val_data_global, test_data_global = torch.utils.data.random_split(
-        test_val_data_global, [0.5, 0.5]
+    if dataset not in DATASETS or layout not in LAYOUTS:
+        raise Exception("Invalid dataset")
+    return load_processed(
+        dataset + LAYOUTS[layout], partial(download_dataset, dataset, layout, root)
     )
 
-    num_train_points = train_data_global.__len__()
-    num_val_points = val_data_global.__len__()
-    num_test_points = test_data_global.__len__()
-
-    # apply transforms through DataLoader (cheap trick)
-
-    train_dataloader = DataLoader(train_data_global, batch_size=num_train_points)
-    train_data_global.data, train_data_global.targets = next(iter(train_dataloader))
-    ### random permutation of train indices
-    indices = torch.Tensor(np.random.permutation(num_train_points)).int()
-    ### shuffle the data
-    train_data_global.data = train_data_global.data[indices]
-    train_data_global.targets = train_data_global.targets[indices]
-
-    val_dataloader = DataLoader(val_data_global, batch_size=num_val_points)
-    val_data_global.data, val_data_global.targets = next(iter(val_dataloader))
-
-    test_dataloader = DataLoader(test_data_global, batch_size=num_test_points)
-    test_data_global.data, test_data_global.targets = next(iter(test_dataloader))
-
-    return train_data_global, val_data_global, test_data_global
 
+class DatasetStore:
+    """
+    immutable training set shared by all clients and runs
+    the samples of every client are stored back to back in one contiguous tensor, so
+    client data is a view into it and copying a client copies no data
+    the tensors are never written to after construction
+
+    a lazy store keeps the data memory-mapped from a file on the host: clients read
+    their minibatches on demand (through a prefetch queue of prefetch minibatches)
+    and move them to device, so only the clients being trained hold data in memory
+    """
 
-def load_cifar10_flat():
+    def __init__(self, data, targets, lengths, device, path=None, prefetch=4):
+        """
+        data, targets - samples of all clients concatenated in client order
+        lengths - number of samples of every client
+        path - raw float32 file that data is memory-mapped from (lazy store)
+        prefetch - number of minibatches read ahead per client (lazy store)
+        """
+        self.lazy = path is not None
+        self.path = path
+        self.prefetch = prefetch
+        self.device = device
+        if self.lazy:
+            self.data = data
+            self.targets = targets.to(dtype=torch.long).contiguous()
+        else:
+            self.data = data.to(device=device, dtype=torch.float32).contiguous()
+            self.targets = targets.to(device=device, dtype=torch.long).contiguous()
+        self.lengths = [int(length) for length in lengths]
+        self.offsets = [0] + list(accumulate(self.lengths))[:-1]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getstate__(self):
+        # a lazy store is sent to other processes as its file, not its contents
+        state = self.__dict__.copy()
+        if self.lazy:
+            state["data"] = list(self.data.shape)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.lazy:
+            directory, filename = os.path.split(self.path)
+            entry = {"file": filename, "dtype": "float32", "shape": self.data}
+            self.data = load_array(directory, entry)
+
+
+def client_store(train_data, partition, device, path=None, chunk_size=8192):
     """
-    returns a tuple of (train_dataset, validation_dataset, test_dataset)
+    train_data: torch.utils.data.Dataset object
+    partition: (offsets, indices) of every client in train_data (from NIIDClientSplit)
+    path: file for a lazy store (None to keep the data in memory on device)
+
+    gathers the data of all clients into one DatasetStore (a single copy), for a lazy
+    store the data is written to path chunk_size samples at a time and memory-mapped
     """
-    if not exists("processed_data/cifar10_flat/test_data_global.pt"):
-        train_data_global, val_data_global, test_data_global = download_cifar10_flat()
-        os.makedirs("./processed_data/cifar10_flat/", exist_ok=True)
-        torch.save(
-            train_data_global, "processed_data/cifar10_flat/train_data_global.pt"
-        )
-        torch.save(val_data_global, "processed_data/cifar10_flat/val_data_global.pt")
-        torch.save(test_data_global, "processed_data/cifar10_flat/test_data_global.pt")
-    else:
-        print("files already downloaded")
-        train_data_global = torch.load(
-            "processed_data/cifar10_flat/train_data_global.pt"
+    offsets, indices = partition
+    order = torch.from_numpy(indices)
+    if path is None:
+        return DatasetStore(
+            train_data.data[order], train_data.targets[order], np.diff(offsets), device
         )
-        val_data_global = torch.load("processed_data/cifar10_flat/val_data_global.pt")
-        test_data_global = torch.load("processed_data/cifar10_flat/test_data_global.pt")
 
-    return train_data_global, val_data_global, test_data_global
+    if not exists(path):
+        with open(path + ".tmp", "wb") as f:
+            for start in range(0, len(order), chunk_size):
+                chunk = train_data.data[order[start : start + chunk_size]]
+                chunk.numpy().astype(np.float32).tofile(f)
+        os.replace(path + ".tmp", path)
+    directory, filename = os.path.split(path)
+    shape = [len(order)] + list(train_data.data.shape[1:])
+    data = load_array(directory, {"file": filename, "dtype": "float32", "shape": shape})
+    return DatasetStore(
+        data, train_data.targets[order], np.diff(offsets), device, path=path
+    )
 
 
 def NIIDClientSplit(train_data, num_clients, alpha):
@@ -310,13 +304,15 @@ def NIIDClientSplit(train_data, num_clients, alpha):
     different schemes for distributing data between these clients
     1. diff distribution, same number of points (implemented)
     2. same distribution, diff number of points (not implemented)
+
+    returns (offsets, indices), a CSR partition where client i is allocated the
+    datapoints indices[offsets[i] : offsets[i + 1]] of train_data
+    the same numpy and torch seeds give the same partition
     """
-    unique_targets, target_counts_global = train_data.targets.unique(return_counts=True)
-    num_targets = len(unique_targets)
-    target_indices = {int(key): [] for key in unique_targets}
-    # first separate data indices by targets
-    for idx, target in enumerate(train_data.targets):
-        target_indices[int(target)].append(idx)
+    targets = np.asarray(train_data.targets)
+    target_counts = np.bincount(targets)
+    num_targets = len(target_counts)
+    target_counts_global = torch.from_numpy(target_counts)
 
     # split targets across each client using the dirichlet distribution
     # let client i have labels distributed with proportions [p0-i, p1-i, ..., pM-i] where M is the number of targets
@@ -366,24 +362,29 @@ def NIIDClientSplit(train_data, num_clients, alpha):
     client_num_datapoints = torch.floor(
         client_proportions * torch.t(datapoints_allocated.repeat(num_targets, 1))
     ).int()
+    client_num_datapoints = client_num_datapoints.numpy().astype(np.int64)
 
-    client_num_datapoints_sum = torch.cumsum(client_num_datapoints, axis=0)
+    # first separate data indices by targets (stable, each bucket in increasing order)
+    target_offsets = np.concatenate([[0], np.cumsum(target_counts)])
+    target_indices = np.argsort(targets, kind="stable")
     # shuffle target indices again before assigning them to clients
-    for key in target_indices.keys():
-        np.random.shuffle(target_indices[key])
-
-    # to store the indices of datapoints that are allocated to each client from train_data
-    client_indices = {i: [] for i in range(num_clients)}
-    for i in range(num_clients):
-        for j in range(num_targets):
-            lsplit = client_num_datapoints_sum[i - 1][j]
-            usplit = client_num_datapoints_sum[i][j]
-            if i > 0:
-                client_indices[i].extend(target_indices[j][lsplit:usplit])
-            else:
-                client_indices[i].extend(target_indices[j][0:usplit])
+    for j in range(num_targets):
+        np.random.shuffle(target_indices[target_offsets[j] : target_offsets[j + 1]])
 
-    return client_indices
+    # client i takes the next client_num_datapoints[i][j] indices of target j, i.e. one
+    # segment of target_indices per (client, target) pair in client-major order
+    segment_starts = target_offsets[:-1] + (
+        np.cumsum(client_num_datapoints, axis=0) - client_num_datapoints
+    )
+    segment_lengths = client_num_datapoints.reshape(-1)
+    segment_offsets = np.concatenate([[0], np.cumsum(segment_lengths)])
+    positions = np.arange(segment_offsets[-1])
+    segment = np.searchsorted(segment_offsets, positions, side="right") - 1
+    indices = target_indices[
+        segment_starts.reshape(-1)[segment] + positions - segment_offsets[segment]
+    ]
+    offsets = np.concatenate([[0], np.cumsum(client_num_datapoints.sum(axis=1))])
+    return offsets, indices
 
 
 def DivideIntoBatches(client_indices, num_batches):
@@ -405,36 +406,47 @@ def DivideIntoBatches(client_indices, num_batches):
     return client_indices_batched
 
 
-def synthetic_samples(alpha, beta, N_i):
-    ## create data distribution
-    # sample 1 Bk from normal(0, beta)
-    B_k = torch.normal(torch.zeros(1), torch.sqrt(torch.ones(1) * beta))
-    # sample 60 v from normal(Bk, 1)
-    v = torch.normal(B_k, torch.ones(60))
-    # construct 60x60 sigma with diag(j,j) = j^(-1.2)
-    Sigma = torch.eye(60)
-    for i in range(1, 61):
-        Sigma[i - 1, i - 1] = i ** (-1.2)
-    data_distribution = MultivariateNormal(loc=v, covariance_matrix=Sigma)
-    # sample 2*N_i datapoints from data_distribution
-    x_train = data_distribution.sample(torch.Size([N_i]))
-    x_test = data_distribution.sample(torch.Size([N_i]))
-
-    ## create model distribution
-    # sample 1 u_k from normal(0, alpha)
-    u_k = torch.normal(torch.zeros(1), torch.sqrt(torch.ones(1) * alpha))
-    # sample 10 b_k from normal(u_k, 1)
-    b_k = torch.normal(u_k, torch.ones(10))
-    # sample 10x60 W_k from normal(u_k, 1)
-    W_k = torch.normal(u_k, torch.ones((10, 60)))
-    # evaluate targets = argmax(softmax(Wx + b))
-    y_train = torch.argmax(torch.matmul(x_train, W_k.t()) + b_k, dim=1)
-    y_test = torch.argmax(torch.matmul(x_test, W_k.t()) + b_k, dim=1)
+def synthetic_samples(alpha, beta, num_datapoints, chunk_size=8192):
+    """
+    alpha - variance of the model distribution means u_k
+    beta - variance of the data distribution means B_k
+    num_datapoints - number of train (and of test/val) datapoints of every client k
+
+    samples the data and model distributions of all clients at once and returns
+    (train, test_val) dicts of data and targets, with the datapoints of every client
+    stored back to back in client order
+    """
+    num_clients = len(num_datapoints)
+    lengths = torch.as_tensor(np.asarray(num_datapoints), dtype=torch.long)
+    client = torch.repeat_interleave(torch.arange(num_clients), lengths)
+    total = int(lengths.sum())
+
+    ## create data distributions
+    # sample B_k from normal(0, beta) and 60 v from normal(B_k, 1) for every client
+    B = torch.randn(num_clients, 1) * np.sqrt(beta)
+    v = B + torch.randn(num_clients, 60)
+    # covariance is diagonal with Sigma(j,j) = j^(-1.2), so x = v + eps * sqrt(Sigma)
+    scale = torch.arange(1, 61, dtype=torch.float32) ** (-0.6)
+
+    ## create model distributions
+    # sample u_k from normal(0, alpha), 10 b_k and 10x60 W_k from normal(u_k, 1)
+    u = torch.randn(num_clients, 1) * np.sqrt(alpha)
+    b = u + torch.randn(num_clients, 10)
+    W = u[:, :, None] + torch.randn(num_clients, 10, 60)
 
     train = {}
     test_val = {}
-    train["data"] = x_train
-    train["targets"] = y_train
-    test_val["data"] = x_test
-    test_val["targets"] = y_test
+    for samples in [train, test_val]:
+        data = torch.empty((total, 60))
+        targets = torch.empty(total, dtype=torch.long)
+        torch.randn((total, 60), out=data)
+        data.mul_(scale).add_(v[client])
+        # evaluate targets = argmax(softmax(Wx + b)) in chunks of datapoints
+        for start in range(0, total, chunk_size):
+            end = start + chunk_size
+            chunk_client = client[start:end]
+            scores = torch.einsum("nd,ncd->nc", data[start:end], W[chunk_client])
+            targets[start:end] = torch.argmax(scores + b[chunk_client], dim=1)
+        samples["data"] = data
+        samples["targets"] = targets
     return train, test_val
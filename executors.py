@@ -0,0 +1,437 @@
+import torch
+import torch.multiprocessing as mp
+from torch.func import functional_call, grad, vmap
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from time import perf_counter
+
+from aggregation import CriterionModule
+from profiling import timed
+
+
+class BatchStager:
+    """
+    stages the minibatches of upcoming client trainings on a background thread
+    (index draws, gathers from the store and host to device copies), so that a run
+    loop can prepare the next round's clients while the server is still busy
+    at most size clients are staged and not yet taken at any time
+    """
+
+    def __init__(self, clients, size):
+        """
+        clients - list of clients
+        size - maximum number of staged clients waiting to be trained
+        """
+        self.clients = clients
+        self.size = size
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.staged = {}
+        self.reset_timings()
+
+    def key(self, idx, E, B, seed):
+        return (idx, E, B, seed)
+
+    def stage(self, selected, E, B, seeds):
+        """
+        selected - indices of the clients to stage
+        E - list of epochs for every client
+        seeds - training seed of every selected client
+        """
+        for idx, seed in zip(selected, seeds):
+            key = self.key(idx, E[idx], B, seed)
+            if key in self.staged or len(self.staged) >= self.size:
+                continue
+            self.staged[key] = self.pool.submit(self.stage_client, idx, E[idx], B, seed)
+
+    def stage_client(self, idx, E, B, seed):
+        start = perf_counter()
+        staged = self.clients[idx].stage(E, B, seed)
+        return staged, perf_counter() - start
+
+    def take(self, idx, E, B, seed):
+        """
+        returns the (batches, generator) staged for this training, None if not staged
+        """
+        future = self.staged.pop(self.key(idx, E, B, seed), None)
+        if future is None:
+            self.timings["prefetch_misses"] += 1
+            return None
+        start = perf_counter()
+        staged, staging_time = future.result()
+        self.timings["prefetch_wait_time"] += perf_counter() - start
+        self.timings["prefetch_staging_time"] += staging_time
+        self.timings["prefetch_hits"] += 1
+        return staged
+
+    def reset_timings(self):
+        self.timings = {
+            "prefetch_hits": 0,
+            "prefetch_misses": 0,
+            "prefetch_staging_time": 0.0,
+            "prefetch_wait_time": 0.0,
+        }
+
+    def round_timings(self):
+        """
+        returns the staging statistics since the last call
+        prefetch_overlap is the fraction of staging time hidden behind other work
+        """
+        timings = self.timings
+        staging_time = timings["prefetch_staging_time"]
+        hidden_time = max(0.0, staging_time - timings["prefetch_wait_time"])
+        timings["prefetch_overlap"] = (
+            hidden_time / staging_time if staging_time else 0.0
+        )
+        self.reset_timings()
+        return timings
+
+    def close(self):
+        for future in self.staged.values():
+            future.cancel()
+        self.staged = {}
+        self.pool.shutdown()
+
+
+class SequentialExecutor:
+    """
+    trains the selected clients one after another in the calling process
+    with prefetch > 0 the minibatches of clients passed to stage() are prepared on a
+    background thread (BatchStager) and used when those clients are trained
+    """
+
+    def __init__(self, clients, prefetch=0):
+        """
+        prefetch - maximum number of clients staged ahead of training (0 to disable)
+        """
+        self.clients = clients
+        self.stager = BatchStager(clients, prefetch) if prefetch > 0 else None
+
+    def stage(self, selected, E, B, seeds):
+        """
+        starts staging the minibatches of clients that will be trained next with
+        these arguments (no-op without prefetch)
+        """
+        if self.stager is not None:
+            self.stager.stage(selected, E, B, seeds)
+
+    def take(self, idx, E, B, seed):
+        """
+        returns the staged minibatches of a client training, None if not staged
+        """
+        if self.stager is None:
+            return None
+        return self.stager.take(idx, E, B, seed)
+
+    def prefetch_timings(self):
+        """
+        returns the staging statistics since the last call ({} without prefetch)
+        """
+        if self.stager is None:
+            return {}
+        return self.stager.round_timings()
+
+    @timed("executor.train")
+    def train(
+        self, selected, serverModel, criterion, E, B, learning_rate, momentum, seeds
+    ):
+        """
+        selected - indices of the clients to train
+        E - list of epochs for every client
+        seeds - one training seed per selected client
+
+        returns the client states in the order of selected
+        """
+        return [
+            self.clients[idx].train(
+                serverModel,
+                criterion=criterion,
+                E=E[idx],
+                B=B,
+                learning_rate=learning_rate,
+                momentum=momentum,
+                seed=seed,
+                staged=self.take(idx, E[idx], B, seed),
+            )
+            for idx, seed in zip(selected, seeds)
+        ]
+
+    def close(self):
+        if self.stager is not None:
+            self.stager.close()
+
+
+class ThreadExecutor(SequentialExecutor):
+    """
+    trains the selected clients concurrently on a thread pool
+    torch intra-op threads are split between the workers while the pool is open
+    """
+
+    def __init__(self, clients, num_workers, prefetch=0):
+        super().__init__(clients, prefetch)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.num_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, self.num_threads // num_workers))
+
+    @timed("executor.train")
+    def train(
+        self, selected, serverModel, criterion, E, B, learning_rate, momentum, seeds
+    ):
+        futures = [
+            self.pool.submit(
+                self.clients[idx].train,
+                serverModel,
+                criterion=criterion,
+                E=E[idx],
+                B=B,
+                learning_rate=learning_rate,
+                momentum=momentum,
+                seed=seed,
+                staged=self.take(idx, E[idx], B, seed),
+            )
+            for idx, seed in zip(selected, seeds)
+        ]
+        return [future.result() for future in futures]
+
+    def close(self):
+        super().close()
+        self.pool.shutdown()
+        torch.set_num_threads(self.num_threads)
+
+
+# clients held by each persistent worker process
+worker_clients = None
+
+
+def init_worker(clients, num_threads):
+    global worker_clients
+    worker_clients = clients
+    torch.set_num_threads(num_threads)
+
+
+def train_worker(args):
+    idx, serverModel, criterion, E, B, learning_rate, momentum, seed = args
+    return worker_clients[idx].train(
+        serverModel,
+        criterion=criterion,
+        E=E,
+        B=B,
+        learning_rate=learning_rate,
+        momentum=momentum,
+        seed=seed,
+    )
+
+
+class ProcessExecutor(SequentialExecutor):
+    """
+    trains the selected clients on a pool of persistent worker processes (CPU only)
+    client data is moved to shared memory once and every worker maps the same pages,
+    each round only the server model and the trained client states are transferred
+    the criterion has to be picklable
+    workers read their own minibatches, so nothing is staged (prefetch is ignored)
+    """
+
+    def __init__(self, clients, num_workers, start_method="spawn"):
+        super().__init__(clients)
+        for client in clients:
+            # a lazy store is memory-mapped from its file by every worker instead
+            if not client.store.lazy:
+                client.store.data.share_memory_()
+                client.store.targets.share_memory_()
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        context = mp.get_context(start_method)
+        self.pool = context.Pool(
+            num_workers, initializer=init_worker, initargs=(clients, num_threads)
+        )
+
+    @timed("executor.train")
+    def train(
+        self, selected, serverModel, criterion, E, B, learning_rate, momentum, seeds
+    ):
+        tasks = [
+            (idx, serverModel, criterion, E[idx], B, learning_rate, momentum, seed)
+            for idx, seed in zip(selected, seeds)
+        ]
+        return self.pool.map(train_worker, tasks)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class GradientScaled(torch.nn.Module):
+    """
+    wraps model so that its outputs keep their values but the gradient through the
+    output of sample s is scaled by scale[s] (set before every call)
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.scale = None
+
+    def forward(self, data):
+        scores = self.model(data)
+        scale = self.scale.view((-1,) + (1,) * (scores.dim() - 1))
+        return scores * scale + scores.detach() * (1 - scale)
+
+
+class VmapExecutor(SequentialExecutor):
+    """
+    trains all selected clients together as one stacked model
+    parameters get a leading client dimension and every SGD step of every client is
+    a single gradient call vmapped over the clients (torch.func), each client's loss
+    is one batched forward pass over its minibatch, followed by a vectorized momentum
+    update
+    minibatches are padded to the largest client batch and the gradient through the
+    outputs of the samples is scaled by batch_size / client batch size for real and 0
+    for padded samples, so the gradient is that of the mean over the real samples
+    clients with fewer epochs than the others stop updating (masked)
+    the criterion has to be a mean over samples plus terms that only depend on the
+    model, as with fed_avg_loss and fed_prox_loss, and the model must treat samples
+    independently (no batch normalization)
+    results agree with sequential training up to floating point rounding (summation
+    order differs)
+    """
+
+    @timed("executor.train")
+    def train(
+        self, selected, serverModel, criterion, E, B, learning_rate, momentum, seeds
+    ):
+        clients = [self.clients[idx] for idx in selected]
+        epochs = torch.tensor([E[idx] for idx in selected], device=clients[0].device)
+        staged = [self.take(idx, E[idx], B, seed) for idx, seed in zip(selected, seeds)]
+        generators = [
+            client.generator(seed) if client_staged is None else client_staged[1]
+            for client, seed, client_staged in zip(clients, seeds, staged)
+        ]
+        batch_sizes = [client.batch_size(B) for client in clients]
+        batch_size = max(batch_sizes)
+        # mask[i, s] is 1 for real samples of client i and 0 for padding
+        mask = torch.zeros((len(clients), batch_size), device=clients[0].device)
+        for i, size in enumerate(batch_sizes):
+            mask[i, :size] = 1
+
+        # gradient scale of every sample, padded samples do not contribute
+        scale = mask * batch_size / mask.sum(dim=1, keepdim=True)
+
+        model = deepcopy(serverModel).to(clients[0].device)
+        scaled_model = GradientScaled(model)
+        module = CriterionModule(scaled_model, criterion)
+        params = {
+            "model.model."
+            + key: value.detach().expand(len(clients), *value.shape).clone()
+            for key, value in model.named_parameters()
+        }
+        buffers = {"model.model." + key: value for key, value in model.named_buffers()}
+        momentum_buffers = {
+            key: torch.zeros_like(value) for key, value in params.items()
+        }
+
+        def batch_loss(client_params, data, targets, sample_scale):
+            scaled_model.scale = sample_scale
+            state = {**client_params, **buffers}
+            return functional_call(module, state, (data, targets))
+
+        batch_grad = vmap(grad(batch_loss))
+
+        for epoch in range(int(epochs.max())):
+            data, targets = self.epoch_batches(
+                clients, generators, staged, epoch, E, selected, B, batch_size
+            )
+            # clients that have finished their epochs keep their parameters
+            active = (epoch < epochs).to(mask.dtype)
+            for batch in range(B):
+                gradients = batch_grad(params, data[:, batch], targets[:, batch], scale)
+                for key, param in params.items():
+                    shape = (-1,) + (1,) * (param.dim() - 1)
+                    step = active.view(shape)
+                    buffer = momentum_buffers[key]
+                    buffer.copy_(
+                        torch.where(
+                            step > 0, momentum * buffer + gradients[key], buffer
+                        )
+                    )
+                    param.sub_(learning_rate * step * buffer)
+
+        client_states = []
+        for i, client in enumerate(clients):
+            client_model = deepcopy(model)
+            client_state = client_model.state_dict(keep_vars=True)
+            for key, value in params.items():
+                client_state[key[len("model.model.") :]].data = value[i].clone()
+            if client.keep_model:
+                client.model = deepcopy(client_model)
+            if client.noise_level > 0:
+                client_model = client.add_noise(
+                    client_model, client.noise_level, generators[i]
+                )
+            client_states.append(client_model.state_dict())
+        return client_states
+
+    def epoch_batches(
+        self, clients, generators, staged, epoch, E, selected, B, batch_size
+    ):
+        """
+        staged - (batches, generator) of every client, None for clients not staged
+
+        returns (num_clients, B, batch_size, ...) data and targets for one epoch
+        client batches are drawn exactly as in Client.train and padded to batch_size
+        """
+        data = []
+        targets = []
+        for client, generator, client_staged, idx in zip(
+            clients, generators, staged, selected
+        ):
+            if client_staged is not None and epoch < E[idx]:
+                batches = client_staged[0][epoch * B : (epoch + 1) * B]
+                client_data = torch.stack([batch[0] for batch in batches])
+                client_targets = torch.stack([batch[1] for batch in batches])
+                padding = batch_size - client_data.shape[1]
+                if padding > 0:
+                    # padded samples are masked out, repeat the first sample
+                    client_data = torch.cat(
+                        [
+                            client_data,
+                            client_data[:, :1].expand(
+                                -1, padding, *client_data.shape[2:]
+                            ),
+                        ],
+                        dim=1,
+                    )
+                    client_targets = torch.cat(
+                        [client_targets, client_targets[:, :1].expand(-1, padding)],
+                        dim=1,
+                    )
+                data.append(client_data)
+                targets.append(client_targets)
+                continue
+            indices = torch.zeros(
+                (B, batch_size), dtype=torch.long, device=client.device
+            )
+            if epoch < E[idx]:
+                batch_indices = client.split_indices(B, generator)
+                indices[:, : batch_indices.shape[1]] = batch_indices
+            client_data, client_targets = client.get_subset(indices)
+            data.append(client_data)
+            targets.append(client_targets)
+        return torch.stack(data), torch.stack(targets)
+
+
+def make_executor(backend, clients, num_workers=1, prefetch=0):
+    """
+    backend - one of ["sequential", "thread", "process", "vmap"]
+    num_workers - number of worker threads / processes
+    prefetch - maximum number of clients staged ahead of training (0 to disable)
+
+    returns the client execution backend used by the run loops in algorithms.py
+    """
+    if backend == "sequential" or backend is None:
+        return SequentialExecutor(clients, prefetch)
+    elif backend == "thread":
+        return ThreadExecutor(clients, num_workers, prefetch)
+    elif backend == "process":
+        return ProcessExecutor(clients, num_workers)
+    elif backend == "vmap":
+        return VmapExecutor(clients, prefetch)
+    raise Exception("Invalid executor backend")
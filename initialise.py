@@ -2,10 +2,15 @@ import torch
 import torch.nn as nn
 import numpy as np
 
+import hashlib
+import os
+from functools import partial
+from os.path import exists
+
 from data_preprocess import (
-    load_mnist_flat,
-    load_fmnist_flat,
-    load_cifar10,
+    client_store,
+    DatasetStore,
+    load_dataset,
     NIIDClientSplit,
     synthetic_samples,
 )
@@ -14,12 +19,159 @@ from model import NN, CNN
 
 from client import Client
 from server import Server
+from utils import dict_hash
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# client partitions and per-client assignments, one .npz file per configuration
+PARTITION_CACHE = "processed_data/partitions/"
+RNG_STATE_KEYS = [
+    "numpy_keys",
+    "numpy_pos",
+    "numpy_has_gauss",
+    "numpy_cached_gaussian",
+    "torch_state",
+]
+
+
+def cached_partition(config, build, restore_rng=True):
+    """
+    config - dict that identifies the partition (hashed with utils.dict_hash)
+    build - function returning a dict of numpy arrays, drawn from the global RNGs
+    restore_rng - restore the RNG states saved after build when loading from the cache
+
+    returns the arrays saved for config, calling build and saving its result on first
+    use. the numpy and torch RNG states after build are saved with the arrays, so that
+    (with restore_rng) code that follows behaves as if build had run
+    """
+    path = os.path.join(PARTITION_CACHE, dict_hash(config) + ".npz")
+    if exists(path):
+        with np.load(path) as saved:
+            arrays = dict(saved)
+        rng_state = {key: arrays.pop(key) for key in RNG_STATE_KEYS}
+        if not restore_rng:
+            return arrays
+        np.random.set_state(
+            (
+                "MT19937",
+                rng_state["numpy_keys"],
+                int(rng_state["numpy_pos"]),
+                int(rng_state["numpy_has_gauss"]),
+                float(rng_state["numpy_cached_gaussian"]),
+            )
+        )
+        torch.set_rng_state(torch.from_numpy(rng_state["torch_state"]))
+        return arrays
+
+    arrays = build()
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    os.makedirs(PARTITION_CACHE, exist_ok=True)
+    # write to a temporary file first so that a partial file is never loaded
+    with open(path + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            **arrays,
+            numpy_keys=keys,
+            numpy_pos=pos,
+            numpy_has_gauss=has_gauss,
+            numpy_cached_gaussian=cached_gaussian,
+            torch_state=torch.get_rng_state().numpy(),
+        )
+    os.replace(path + ".tmp", path)
+    return arrays
+
+
+def split_clients(train_dataset, num_clients, alpha):
+    """
+    returns the Dirichlet partition of train_dataset and the update noise fraction of
+    every client (noise level = update_noise_level * noise_fractions[i])
+    """
+    offsets, indices = NIIDClientSplit(train_dataset, num_clients, alpha)
+    perms = np.random.permutation(list(range(num_clients)))
+    return {
+        "offsets": offsets,
+        "indices": indices,
+        "noise_fractions": perms / num_clients,
+    }
+
+
+def niid_clients(
+    dataset, train_dataset, num_clients, random_seed, alpha, noise, lazy=False
+):
+    """
+    returns the clients of a Dirichlet split of train_dataset
+    the split is loaded from the partition cache when this configuration was built before
+    lazy - keep client data memory-mapped (in the partition cache) instead of in memory
+    """
+    partition_config = {
+        "dataset": dataset,
+        "num_clients": num_clients,
+        "random_seed": random_seed,
+        "alpha": alpha,
+        # identifies the preprocessed train set (its order is random)
+        "targets": hashlib.md5(train_dataset.targets.numpy().tobytes()).hexdigest(),
+    }
+    partition = cached_partition(
+        partition_config, partial(split_clients, train_dataset, num_clients, alpha)
+    )
+    if lazy:
+        path = os.path.join(PARTITION_CACHE, dict_hash(partition_config) + "_data.bin")
+    else:
+        path = None
+    store = client_store(
+        train_dataset, (partition["offsets"], partition["indices"]), device, path
+    )
+    clients = []
+    for i in range(num_clients):
+        clients.append(
+            Client(
+                store,
+                store.offsets[i],
+                store.lengths[i],
+                device,
+                noise_level=noise * partition["noise_fractions"][i],
+            )
+        )
+    return clients
+
+
+def client_epochs(num_clients, systems_heterogenity, epochs, seed):
+    """
+    returns the number of local epochs of every client, a systems_heterogenity
+    fraction of (slow) clients gets a random number of epochs from 1 to epochs
+    the assignment is saved in the partition cache
+    """
+    if systems_heterogenity == 0:
+        return epochs
+
+    def build():
+        np.random.seed(seed)
+        num_slow = int(np.floor(systems_heterogenity * num_clients))
+        slow_clients = np.random.choice(a=num_clients, size=num_slow, replace=False)
+        E = [epochs for i in range(num_clients)]
+        for i in slow_clients:
+            E[i] = np.random.choice(a=range(1, epochs + 1), size=1)[0]
+        return {"E": np.array(E)}
+
+    epochs_config = {
+        "num_clients": num_clients,
+        "systems_heterogenity": systems_heterogenity,
+        "epochs": epochs,
+        "seed": seed,
+    }
+    # build only reseeds numpy, the torch RNG state saved with it is unrelated
+    E = cached_partition(epochs_config, build, restore_rng=False)["E"]
+    return [int(E_i) for E_i in E]
+
 
 def initNetworkData(
-    dataset, num_clients, random_seed, alpha, beta=0, update_noise_level=None
+    dataset,
+    num_clients,
+    random_seed,
+    alpha,
+    beta=0,
+    update_noise_level=None,
+    lazy=False,
 ):
     """
     choose dataset from ["synthetic", "mnist", "cifar10"]
@@ -27,14 +179,13 @@ def initNetworkData(
     random_seed - random seed (to ensure consistent client and server data split)
     alpha - Dirichlet parameter (for mnist, cifar10) / Variance (for synthetic)
     beta - Variance parameter (for synthetic only, not needed for mnist, cifar10)
+    lazy - read client minibatches on demand from a memory-mapped file (not for synthetic)
     """
     if dataset not in ["synthetic", "mnist", "cifar10", "fmnist"]:
         raise Exception("Invalid dataset")
 
     elif dataset == "synthetic":
         clients = []
-        test_val_data = []
-        test_val_targets = []
 
         torch.manual_seed(random_seed)
         np.random.seed(random_seed)
@@ -50,59 +201,50 @@ def initNetworkData(
         )
         total_train_datapoints = 60000
         num_datapoints = total_train_datapoints * client_datapoint_fractions
+        num_datapoints = num_datapoints.astype(int)
+        train, test_val = synthetic_samples(alpha, beta, num_datapoints)
+        store = DatasetStore(train["data"], train["targets"], num_datapoints, device)
         for i in range(num_clients):
-            N_i = int(num_datapoints[i])
-            train_i, test_val_i = synthetic_samples(alpha, beta, N_i)
             clients.append(
                 Client(
-                    train_i["data"],
-                    train_i["targets"],
+                    store,
+                    store.offsets[i],
+                    store.lengths[i],
                     device,
                     noise_level=update_noise_level * (i / num_clients),
                 )
             )
-            test_val_data.extend(test_val_i["data"])
-            test_val_targets.extend(test_val_i["targets"])
 
         serverModel = nn.Sequential(nn.Linear(60, 10))
         # compute total number of datapoints in test_val_data
-        test_val_length = len(test_val_data)
+        test_val_length = len(test_val["data"])
         # split these 50:50 between test and val sets
-        test_val_indices = list(range(test_val_length))
-        np.random.shuffle(test_val_indices)
+        test_val_indices = np.random.permutation(test_val_length)
         test_indices = test_val_indices[: int(test_val_length / 2)]
         val_indices = test_val_indices[int(test_val_length / 2) :]
-        test_val_data = torch.stack(test_val_data)
-        test_val_targets = torch.stack(test_val_targets)
-        val_data = test_val_data[val_indices]
-        val_targets = test_val_targets[val_indices]
-        test_data = test_val_data[test_indices]
-        test_targets = test_val_targets[test_indices]
+        val_data = test_val["data"][val_indices]
+        val_targets = test_val["targets"][val_indices]
+        test_data = test_val["data"][test_indices]
+        test_targets = test_val["targets"][test_indices]
         server = Server(
             serverModel, val_data, val_targets, test_data, test_targets, device
         )
 
     elif dataset in ["mnist", "fmnist"]:
-        if dataset == "mnist":
-            train_dataset, val_dataset, test_dataset = load_mnist_flat()
-        else:
-            train_dataset, val_dataset, test_dataset = load_fmnist_flat()
+        train_dataset, val_dataset, test_dataset = load_dataset(dataset, "flat")
 
         torch.manual_seed(random_seed)
         np.random.seed(random_seed)
 
-        client_indices = NIIDClientSplit(train_dataset, num_clients, alpha)
-        clients = []
-        perms = np.random.permutation(list(range(num_clients)))
-        for i in range(num_clients):
-            clients.append(
-                Client(
-                    train_dataset.data[client_indices[i]],
-                    train_dataset.targets[client_indices[i]],
-                    device,
-                    noise_level=update_noise_level * (perms[i] / num_clients),
-                )
-            )
+        clients = niid_clients(
+            dataset,
+            train_dataset,
+            num_clients,
+            random_seed,
+            alpha,
+            update_noise_level,
+            lazy,
+        )
 
         serverModel = NN(input_dim=784, output_dim=10)
         server = Server(
@@ -115,23 +257,20 @@ def initNetworkData(
         )
 
     elif dataset == "cifar10":
-        train_dataset, val_dataset, test_dataset = load_cifar10()
+        train_dataset, val_dataset, test_dataset = load_dataset(dataset, "image")
 
         torch.manual_seed(random_seed)
         np.random.seed(random_seed)
 
-        client_indices = NIIDClientSplit(train_dataset, num_clients, alpha)
-        clients = []
-        perms = np.random.permutation(list(range(num_clients)))
-        for i in range(num_clients):
-            clients.append(
-                Client(
-                    train_dataset.data[client_indices[i]],
-                    train_dataset.targets[client_indices[i]],
-                    device,
-                    noise_level=update_noise_level * (perms[i] / num_clients),
-                )
-            )
+        clients = niid_clients(
+            dataset,
+            train_dataset,
+            num_clients,
+            random_seed,
+            alpha,
+            update_noise_level,
+            lazy,
+        )
         in_channels = 3
         output_dim = 10
         input_h = 32
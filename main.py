@@ -7,7 +7,7 @@ import numpy as np
 from copy import deepcopy
 
 
-from initialise import initNetworkData
+from initialise import client_epochs, initNetworkData
 from algorithms import (
     fed_avg_run,
     fed_prox_run,
@@ -17,11 +17,13 @@ from algorithms import (
     power_of_choice_run,
     centralised_run,
 )
+from profiling import profiler
+from sinks import RESULTS_PATH, make_sink
 from utils import dict_hash
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def execute_run(clients, server, algorithm, parameters, config_global, seed, wandb_logging=True):
+def execute_run(clients, server, algorithm, parameters, config_global, seed, wandb_logging=True, sink=None):
 
     E = config_global["E"]
     B = config_global["batches"]
@@ -29,6 +31,11 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
     lr = config_global["lr"]
     momentum = config_global["momentum"]
     select_fraction = config_global["select_fraction"]
+    executor = config_global.get("executor", "sequential")
+    num_workers = config_global.get("num_workers", 1)
+    eval_every = config_global.get("eval_every", 1)
+    prefetch = config_global.get("prefetch", 0)
+    async_metrics = config_global.get("async_metrics", False)
 
     test_acc_arr = []
     train_acc_arr = []
@@ -39,10 +46,12 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
     selections_arr = []
 
     if algorithm == "centralised":
+        wandb_config = deepcopy(config_global)
+        wandb_config["algorithm"] = algorithm
+        wandb_config["seed"] = seed
+        if sink is not None:
+            sink.tag(**wandb_config)
         if wandb_logging:
-            wandb_config = deepcopy(config_global)
-            wandb_config["algorithm"] = algorithm
-            wandb_config["seed"] = seed
             wandb.init(project=GLOBAL_PROJECT_NAME, config=wandb_config)
         (
             test_acc,
@@ -62,6 +71,7 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
             learning_rate=lr,
             momentum=momentum,
             logging=wandb_logging,
+            sink=sink,
         )
         test_acc_arr.append(test_acc)
         train_acc_arr.append(train_acc)
@@ -71,10 +81,12 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
         selections_arr.append(selections)
 
     elif algorithm == "fedavg":
+        wandb_config = deepcopy(config_global)
+        wandb_config["algorithm"] = algorithm
+        wandb_config["seed"] = seed
+        if sink is not None:
+            sink.tag(**wandb_config)
         if wandb_logging:
-            wandb_config = deepcopy(config_global)
-            wandb_config["algorithm"] = algorithm
-            wandb_config["seed"] = seed
             wandb.init(project=GLOBAL_PROJECT_NAME, config=wandb_config)
         (
             test_acc,
@@ -94,6 +106,11 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
             learning_rate=lr,
             momentum=momentum,
             logging=wandb_logging,
+            sink=sink,
+            executor=executor,
+            num_workers=num_workers,
+            eval_every=eval_every,
+            prefetch=prefetch,
         )
         test_acc_arr.append(test_acc)
         train_acc_arr.append(train_acc)
@@ -104,11 +121,13 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
     elif algorithm == "fedprox":
         mu_vals = parameters["mu"]
         for mu in mu_vals:
+            wandb_config = deepcopy(config_global)
+            wandb_config["algorithm"] = algorithm
+            wandb_config["seed"] = seed
+            wandb_config["mu"] = mu
+            if sink is not None:
+                sink.tag(**wandb_config)
             if wandb_logging:
-                wandb_config = deepcopy(config_global)
-                wandb_config["algorithm"] = algorithm
-                wandb_config["seed"] = seed
-                wandb_config["mu"] = mu
                 wandb.init(project=GLOBAL_PROJECT_NAME, config=wandb_config)
             (
                 test_acc,
@@ -129,6 +148,11 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
                 learning_rate=lr,
                 momentum=momentum,
                 logging=wandb_logging,
+                sink=sink,
+                executor=executor,
+                num_workers=num_workers,
+                eval_every=eval_every,
+                prefetch=prefetch,
             )
             test_acc_arr.append(test_acc)
             train_acc_arr.append(train_acc)
@@ -142,12 +166,14 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
             beta = 1 - alpha
             # temperature = 1
             # alpha_init = 1/clients.length
+            wandb_config = deepcopy(config_global)
+            wandb_config["algorithm"] = algorithm
+            wandb_config["seed"] = seed
+            wandb_config["algo_alpha"] = alpha
+            wandb_config["algo_beta"] = beta
+            if sink is not None:
+                sink.tag(**wandb_config)
             if wandb_logging:
-                wandb_config = deepcopy(config_global)
-                wandb_config["algorithm"] = algorithm
-                wandb_config["seed"] = seed
-                wandb_config["algo_alpha"] = alpha
-                wandb_config["algo_beta"] = beta
                 wandb.init(project=GLOBAL_PROJECT_NAME, config=wandb_config)
             (
                 test_acc,
@@ -170,6 +196,11 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
                 learning_rate=lr,
                 momentum=momentum,
                 logging=wandb_logging,
+                sink=sink,
+                executor=executor,
+                num_workers=num_workers,
+                eval_every=eval_every,
+                prefetch=prefetch,
                 temperature=1,
                 alpha_init=1/len(clients),
             )
@@ -183,11 +214,13 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
     elif algorithm == "ucb":
         beta_vals = parameters["beta"]
         for beta in beta_vals:
+            wandb_config = deepcopy(config_global)
+            wandb_config["algorithm"] = algorithm
+            wandb_config["seed"] = seed
+            wandb_config["algo_beta"] = beta
+            if sink is not None:
+                sink.tag(**wandb_config)
             if wandb_logging:
-                wandb_config = deepcopy(config_global)
-                wandb_config["algorithm"] = algorithm
-                wandb_config["seed"] = seed
-                wandb_config["algo_beta"] = beta
                 wandb.init(project=GLOBAL_PROJECT_NAME, config=wandb_config)
             (
                 test_acc,
@@ -212,6 +245,12 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
                 learning_rate=lr,
                 momentum=momentum,
                 logging=wandb_logging,
+                sink=sink,
+                executor=executor,
+                num_workers=num_workers,
+                eval_every=eval_every,
+                prefetch=prefetch,
+                async_metrics=async_metrics,
             )
             test_acc_arr.append(test_acc)
             train_acc_arr.append(train_acc)
@@ -223,11 +262,13 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
     elif algorithm == "greedyshap":
         shap_memory_vals = parameters["memory"]
         for shap_memory in shap_memory_vals:
+            wandb_config = deepcopy(config_global)
+            wandb_config["algorithm"] = algorithm
+            wandb_config["seed"] = seed
+            wandb_config["memory"] = shap_memory
+            if sink is not None:
+                sink.tag(**wandb_config)
             if wandb_logging:
-                wandb_config = deepcopy(config_global)
-                wandb_config["algorithm"] = algorithm
-                wandb_config["seed"] = seed
-                wandb_config["memory"] = shap_memory
                 wandb.init(project=GLOBAL_PROJECT_NAME, config=wandb_config)
             (
                 test_acc,
@@ -251,6 +292,12 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
                 learning_rate=lr,
                 momentum=momentum,
                 logging=wandb_logging,
+                sink=sink,
+                executor=executor,
+                num_workers=num_workers,
+                eval_every=eval_every,
+                prefetch=prefetch,
+                async_metrics=async_metrics,
                 shap_memory=shap_memory,
             )
             test_acc_arr.append(test_acc)
@@ -263,11 +310,13 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
     elif algorithm == "poc":
         decay_factor_vals = parameters["decay_factor"]
         for decay_factor in decay_factor_vals:
+            wandb_config = deepcopy(config_global)
+            wandb_config["algorithm"] = algorithm
+            wandb_config["seed"] = seed
+            wandb_config["decay_factor"] = decay_factor
+            if sink is not None:
+                sink.tag(**wandb_config)
             if wandb_logging:
-                wandb_config = deepcopy(config_global)
-                wandb_config["algorithm"] = algorithm
-                wandb_config["seed"] = seed
-                wandb_config["decay_factor"] = decay_factor
                 wandb.init(project=GLOBAL_PROJECT_NAME, config=wandb_config)
             (
                 test_acc,
@@ -288,6 +337,11 @@ def execute_run(clients, server, algorithm, parameters, config_global, seed, wan
                 learning_rate=lr,
                 momentum=momentum,
                 logging=wandb_logging,
+                sink=sink,
+                executor=executor,
+                num_workers=num_workers,
+                eval_every=eval_every,
+                prefetch=prefetch,
             )
             test_acc_arr.append(test_acc)
             train_acc_arr.append(train_acc)
@@ -340,7 +394,8 @@ if __name__ == "__main__":
             "dataset_alpha": dataset_alpha_item,
             "dataset_beta": dataset_alpha_item, # active only for synthetic
             "noise": noise_item,
-            "systems_heterogenity": systems_heterogenity_item
+            "systems_heterogenity": systems_heterogenity_item,
+            "lazy": False, # read client minibatches on demand from a memory-mapped file
         }
 
         algo_config_global = {
@@ -350,6 +405,14 @@ if __name__ == "__main__":
             "T":T,
             "lr": 0.01,
             "momentum":0.5,
+            "executor":"sequential", # client training backend from ["sequential", "thread", "process", "vmap"]
+            "num_workers":1,
+            "eval_every":1, # compute train accuracy and loss every k rounds
+            "prefetch":0, # clients whose minibatches are staged in the background ahead of training
+            "async_metrics":False, # evaluate and log round t of greedyfed/ucb while round t + 1 trains
+            "sink":"results", # also write every round to sink_path offline, from [None, "results", "jsonl", "parquet"]
+            "sink_path":RESULTS_PATH, # directory (results, parquet) or file (jsonl), plotting.py reads the results store
+            "profile":None, # JSON lines file for per-round timers and counters (None to disable)
         }
 
         algo_config_specific = {
@@ -367,20 +430,15 @@ if __name__ == "__main__":
         # path = './local_logs/'
         systems_heterogenity = dataset_config["systems_heterogenity"]
         global_config = {**dataset_config, **algo_config_global}
+        if algo_config_global["profile"] is not None:
+            profiler.enable(algo_config_global["profile"])
+        metrics_sink = make_sink(algo_config_global["sink"], algo_config_global["sink_path"])
         for seed in range(num_seeds):
             data_seed = seed
-            if systems_heterogenity > 0:
-                np.random.seed(seed)
-                num_clients = dataset_config["num_clients"]
-                num_slow = int(np.floor(systems_heterogenity * num_clients))
-                slow_clients = np.random.choice(a=num_clients,size=num_slow,replace=False)
-                E_base = deepcopy(algo_config_global["epochs"])
-                E = [E_base for i in range(num_clients)]
-                for i in slow_clients:
-                    E[i] = np.random.choice(a=range(1,E_base+1), size=1)[0]
-                global_config["E"] = E
-            else:
-                global_config["E"] = global_config["epochs"]
+            # per-client epochs and client partitions are reused from processed_data/partitions/
+            global_config["E"] = client_epochs(
+                dataset_config["num_clients"], systems_heterogenity, algo_config_global["epochs"], seed
+            )
             clients, server = initNetworkData( 
                     dataset=dataset_config["dataset"],
                     num_clients=dataset_config["num_clients"],
@@ -388,12 +446,14 @@ if __name__ == "__main__":
                     alpha=dataset_config["dataset_alpha"],
                     beta=dataset_config["dataset_beta"],
                     update_noise_level=dataset_config["noise"],
+                    lazy=dataset_config["lazy"],
                 )
             for algorithm, parameters in algo_config_specific.items():
-                clients_copy = deepcopy(clients)
-                server_copy = deepcopy(server)
-                metrics = execute_run(clients=clients_copy, server=server_copy, algorithm=algorithm, parameters=parameters, config_global=global_config, seed=seed)
+                # every run works on its own RunContext, clients and server are shared
+                metrics = execute_run(clients=clients, server=server, algorithm=algorithm, parameters=parameters, config_global=global_config, seed=seed, sink=metrics_sink)
                 # save_to_excel(path=path, metrics=metrics, global_config=global_config, algorithm=algorithm, parameters=parameters)
+        if metrics_sink is not None:
+            metrics_sink.close()
 
         wandb.init(project="FL-RUN-COMPLETED", name=f"finishing-{dataset_config['dataset']}")
         wandb.alert(title=f"finishing-{dataset_config['dataset']}", text="Finishing")
@@ -1,10 +1,9 @@
 import numpy as np
 from scipy import stats
+from scipy.signal import lfilter
 import pandas as pd
 import wandb
 
-from math import isnan
-import pickle
 import os
 import pprint
 from copy import deepcopy
@@ -13,6 +12,9 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib import rc
 
+import pyarrow.dataset as ds
+
+from sinks import RESULTS_PATH, make_sink, read_parquet
 from utils import dict_hash
 
 import warnings
@@ -20,7 +22,6 @@ warnings.filterwarnings("ignore")
 
 rc("mathtext", default="regular")
 
-result_path_parent = "results/"
 dataset = "mnist"
 print(dataset)
 if dataset in ["fmnist","mnist"]:
@@ -45,15 +46,30 @@ project_name = GLOBAL_PROJECT_NAME
 download_again = False
 print(f"download status = {download_again}")
 # entity = "your_entity"  # Optional if the project is in your default entity
-# Fetch run data from wandb
-result_path = os.path.join(result_path_parent, f"{dataset}-runs.pkl")
-if not os.path.exists(result_path_parent):
-    os.makedirs(result_path_parent)
-if os.path.exists(result_path) and download_again == False:
-    with open(result_path, "rb") as f:
-        runs = pickle.load(f)
-else:
+results_path = RESULTS_PATH  # results store written by main.py (sinks.py)
+result_columns = [
+    "run_id",
+    "run_start",
+    "round",
+    "test_accuracy",
+    "algorithm",
+    "seed",
+    "memory",
+    "mu",
+    "algo_beta",
+    "dataset_alpha",
+    "noise",
+    "systems_heterogenity",
+]
+config_columns = ["algorithm", "seed", "memory","mu","dataset_alpha", "noise", "systems_heterogenity"]
+
+def import_wandb_runs(project_name, path=results_path):
+    """
+    copies the runs of a W&B project into the results store (every round with the run
+    config), so that runs which were only logged to W&B can be tabulated offline
+    """
     wandb.login()
+    sink = make_sink("results", path)
     runs = wandb.Api().runs(
         f"{project_name}",
         # filters={
@@ -63,189 +79,180 @@ else:
         #     "config.systems_heterogenity": {"$in": [0, 0.5, 0.9]},
         # },
     )
-    with open(result_path, "wb") as f:
-        pickle.dump(runs, f)
-
-result_df_path = os.path.join(result_path_parent, f"{dataset}-runs-df.pkl")
-if os.path.exists(result_df_path) and download_again == False:
-    with open(result_df_path, "rb") as f:
-        result_df_original = pickle.load(f)
-else:
-    completed_runs = []
     print(len(runs))
     for run in runs:
-        config = run.config
-
-        if (
-            len(config) > 0
-            and config["select_fraction"] == select_fraction_main
-        ):
-            run_data = run.history(
-                keys=[
-                    "test_accuracy",
-                    "train_accuracy",
-                    "train_loss",
-                    "val_loss",
-                    "test_loss",
-                    "_timestamp"
-                ]
-            )
-            if len(run_data) < T_main:
-                continue
-            run_config = pd.DataFrame.from_dict([config])
-            merged_df = (
-                run_data.assign(key=1)
-                .merge(run_config.assign(key=1), on="key")
-                .drop("key", axis=1)
-            )
-            completed_runs.append(merged_df)
-            print(len(completed_runs))
-
-    result_df_original = pd.concat(completed_runs, ignore_index=True)
-    with open(result_df_path, "wb") as f:
-        pickle.dump(result_df_original, f)
+        if len(run.config) == 0:
+            continue
+        run_data = run.history(
+            keys=[
+                "test_accuracy",
+                "train_accuracy",
+                "train_loss",
+                "val_loss",
+                "test_loss",
+                "_timestamp"
+            ]
+        )
+        if len(run_data) == 0:
+            continue
+        sink.tag(**run.config, run_id=run.id, run_start=float(run_data["_timestamp"].min()))
+        run_data = run_data.drop(columns="_timestamp").rename(columns={"_step": "round"})
+        for row in run_data.to_dict("records"):
+            sink.log(row)
+        # one run per file, the columns of a run have the same type in every file
+        sink.flush()
+    sink.close()
+
+def load_results(filter=None):
+    """
+    filter - pyarrow.dataset expression on the run config, pushed down to the results
+    store (with the dataset, select fraction and rounds) so only matching data is read
+
+    returns the first T_main rounds of the completed runs, of runs with the same config
+    only the latest one
+    """
+    expression = (
+        (ds.field("dataset") == dataset)
+        & (ds.field("select_fraction") == select_fraction_main)
+        & (ds.field("round") < T_main)
+    )
+    if filter is not None:
+        expression = expression & filter
+    result_df = read_parquet(results_path, columns=result_columns, filter=expression)
+    result_df = result_df.drop_duplicates(["run_id", "round"], keep="last")
+    # drop incomplete runs
+    num_rounds = result_df.groupby("run_id")["round"].transform("nunique")
+    result_df = result_df[num_rounds == T_main]
+    # keep only the latest run if all parameters are same
+    latest = result_df.groupby(config_columns, dropna=False)["run_start"].transform("max")
+    result_df = result_df[result_df["run_start"] == latest]
+    # runs in the order of their config, every run is T_main consecutive rows
+    result_df = result_df.sort_values(config_columns + ["run_id", "round"])
+    return result_df.reset_index(drop=True)
+
+# ucb runs with beta = 0.01 are left out of all results (algo_beta is null for the other algorithms)
+ucb_filter = ds.field("algo_beta").is_null() | (ds.field("algo_beta") != 0.01)
+
+if download_again == True:
+    import_wandb_runs(project_name)
 algo_list = ["greedyshap","ucb","sfedavg","fedavg","fedprox","poc","centralised"]
 algo_list_formal = ["GreedyFed","UCB","S-FedAvg","FedAvg","FedProx","Power-Of-Choice","Centralized"]
-def format_results(T_results, smoothed_df):
-    T_results = T_results - 1
-    resultsgroup = smoothed_df[smoothed_df["_step"] == T_results].groupby(["algorithm", "memory","mu"], dropna = False)
-    accuracy_mean = resultsgroup.mean()["test_accuracy"]
-    accuracy_std = resultsgroup.std()["test_accuracy"]
-    best_idxs = accuracy_mean.groupby("algorithm").idxmax()
-    accuracy_mean = accuracy_mean[best_idxs]
-    accuracy_std = accuracy_std[best_idxs]
-    # Create a custom categorical data type
-    algo_cat = pd.CategoricalDtype(categories=algo_list, ordered=True)
-    df = accuracy_mean
-    # Apply the custom data type to the "algorithm" column
-    df.index = df.index.set_levels(df.index.levels[0].astype(algo_cat), level='algorithm')
-    accuracy_mean = list(accuracy_mean.sort_index(level="algorithm"))
-    df = accuracy_std
-    # Apply the custom data type to the "algorithm" column
-    df.index = df.index.set_levels(df.index.levels[0].astype(algo_cat), level='algorithm')
-    accuracy_std = list(accuracy_std.sort_index(level="algorithm"))
-    result_list = []
-    for idx, algorithm in enumerate(algo_list):
-        # print(f"{algorithm} ${100*accuracy_mean[idx]:.2f}"+" \pm "+f"{100*accuracy_std[idx]:.2f}$")
-        result_list.append(f"${100*accuracy_mean[idx]:.2f} \pm {100*accuracy_std[idx]:.2f}$")
-    return result_list
-def smoothen_df(alpha, result_df):
-    smoothed_df = pd.DataFrame()
-    # Smooth the data for each unique combination of 'algorithm' and 'algo_seed' separately using EWMA
-
-    for (algorithm, seed, memory, mu, dataset_alpha, noise, systems_heterogenity), group in result_df.groupby(
-        ["algorithm", "seed", "memory","mu","dataset_alpha", "noise", "systems_heterogenity"], dropna = False
-    ):
-        # keep only the latest run if all parameters are same
-        if (group["_timestamp"].head(T_main).values > group["_timestamp"].tail(T_main).values)[0]:
-            algorithm_df = group.head(T_main)
-        else:
-            algorithm_df = group.tail(T_main)
-        # Sort the unique step values for interpolation
-        sorted_steps = np.sort(algorithm_df["_step"].unique())
-
-        # Perform EWMA smoothing on the accuracy
-        smoothed_accuracy = algorithm_df["test_accuracy"].ewm(alpha=alpha).mean()
-
-        algorithm_smoothed_df = pd.DataFrame(
-            {
-                "_step": sorted_steps,
-                "test_accuracy": smoothed_accuracy,
-                "algorithm": algorithm,
-                "seed": seed,
-                "memory": memory,
-                "mu":mu,
-                "dataset_alpha":dataset_alpha,
-                "noise":noise,
-                "systems_heterogenity":systems_heterogenity,
-            }
-        )
-        smoothed_df = pd.concat([smoothed_df, algorithm_smoothed_df])
-    return smoothed_df
+def best_results(runs, accuracy, columns=()):
+    """
+    runs - configs of the runs (one row per run)
+    accuracy - accuracy of every run
+    columns - run columns whose values are compared separately (table columns)
+
+    returns mean and std of the accuracy of the best config (memory, mu) of every
+    algorithm, chosen with one grouped reduction over all algorithms and columns
+    """
+    columns = list(columns)
+    keys = columns + ["algorithm", "memory", "mu"]
+    results = runs.assign(test_accuracy=accuracy).groupby(keys, dropna=False)["test_accuracy"].agg(["mean", "std"])
+    return results.loc[results["mean"].groupby(level=columns + ["algorithm"]).idxmax()]
+def format_results(T_results, runs, smoothed, by=None, values=None):
+    """
+    T_results - rounds (one table column each), or the round of all columns if by is set
+    runs, smoothed - configs and smoothed accuracy of the runs (smoothen_df)
+    by - run column whose values (in the order of the table columns) split the runs
+    into table columns
+
+    returns one row of "$mean \pm std$" entries per algorithm in algo_list
+    """
+    T_results = list(np.atleast_1d(T_results))
+    if by is None:
+        table_runs = runs.loc[runs.index.repeat(len(T_results))]
+        table_runs["column"] = np.tile(T_results, len(runs))
+        accuracy = smoothed[:, np.array(T_results) - 1].ravel()
+        values = T_results
+    else:
+        mask = runs[by].isin(values).to_numpy()
+        table_runs = runs[mask].assign(column=runs.loc[mask, by])
+        accuracy = smoothed[mask, T_results[0] - 1]
+    best = best_results(table_runs, accuracy, ["column"]).droplevel(["memory", "mu"])
+    entries = "$" + (100 * best["mean"]).map("{:.2f}".format) + r" \pm " + (100 * best["std"]).map("{:.2f}".format) + "$"
+    table = entries.unstack("column").reindex(index=algo_list, columns=values)
+    return table.fillna("-").values.tolist()
+def ewma(values, alpha):
+    """
+    values - runs x rounds array
+
+    returns the EWMA of every run along the rounds, equal to pandas ewm(alpha=alpha).mean()
+    (nan values are skipped)
+    """
+    observed = ~np.isnan(values)
+    decay = [1, alpha - 1]
+    weights = lfilter([1], decay, observed.astype(float), axis=1)
+    with np.errstate(invalid="ignore"):
+        smoothed = lfilter([1], decay, np.where(observed, values, 0), axis=1) / weights
+    # with alpha = 1 a skipped round keeps the last value
+    last = np.maximum.accumulate(np.where(weights > 0, np.arange(values.shape[1]), 0), axis=1)
+    return np.take_along_axis(smoothed, last, axis=1)
 
-def generate_timing_results(result_df_original, smoothing=0, T = [150, 250, 350]):
+def smoothen_df(alpha, result_df):
+    """
+    result_df - rounds of the runs (load_results), one row per run and round in any order
+
+    returns the configs of the runs (one row per run, in order of first appearance) and
+    their test accuracy smoothed with EWMA as a runs x rounds array (T_main rounds, a
+    missing round is nan and skipped)
+    """
+    runs = result_df.drop_duplicates("run_id")
+    # pivot raises on a repeated (run_id, round)
+    accuracy = result_df.pivot(index="run_id", columns="round", values="test_accuracy")
+    accuracy = accuracy.reindex(index=runs["run_id"], columns=range(T_main))
+    runs = runs[config_columns].reset_index(drop=True)
+    return runs, ewma(accuracy.to_numpy(dtype=float), alpha)
+
+def generate_timing_results(smoothing=0, T = [150, 250, 350]):
     noise = 0
     dataset_alpha = 1e-4
     systems_heterogenity = 0
 
     df_filter_global = (
-        (result_df_original["noise"] == noise)
+        (ds.field("noise") == noise)
 
-        & (result_df_original["dataset_alpha"] == dataset_alpha)
-        & (result_df_original["systems_heterogenity"] == systems_heterogenity)
-        & (result_df_original["algo_beta"] != 0.01)
+        & (ds.field("dataset_alpha") == dataset_alpha)
+        & (ds.field("systems_heterogenity") == systems_heterogenity)
+        & ucb_filter
     )
-    result_df = result_df_original.copy(deep=True)
-    result_df = result_df[df_filter_global]
-    smoothed_df = smoothen_df(1 - smoothing, result_df)
+    result_df = load_results(df_filter_global)
+    runs, smoothed = smoothen_df(1 - smoothing, result_df)
 
     # Timing constraints data MNIST
-    results_1 = format_results(T_results=T[0], smoothed_df=smoothed_df)
-    results_2 = format_results(T_results=T[1], smoothed_df=smoothed_df)
-    results_3 = format_results(T_results=T[2], smoothed_df=smoothed_df)
-    for algo, a, b ,c in zip(algo_list_formal, results_1, results_2, results_3):
+    results = format_results(T, runs, smoothed)
+    for algo, (a, b ,c) in zip(algo_list_formal, results):
         print(f"& {algo} & {a} & {b} & {c} \\\\")
 
-def checknanequality(x, y):
-    if x == y:
-        return True
-    elif isinstance(x, float) and isnan(x) and isinstance(y, float) and isnan(y):
-        return True
-    else:
-        return False
-def generate_timing_plots(result_df_original, smoothing=0, T = [150, 250, 350]):
+def generate_timing_plots(smoothing=0, T = [150, 250, 350]):
     noise = 0
     dataset_alpha = 1e-4
     systems_heterogenity = 0
 
     df_filter_global = (
-        (result_df_original["noise"] == noise)
+        (ds.field("noise") == noise)
 
-        & (result_df_original["dataset_alpha"] == dataset_alpha)
-        & (result_df_original["systems_heterogenity"] == systems_heterogenity)
-        & (result_df_original["algo_beta"] != 0.01)
+        & (ds.field("dataset_alpha") == dataset_alpha)
+        & (ds.field("systems_heterogenity") == systems_heterogenity)
+        & ucb_filter
+    )
+    result_df = load_results(df_filter_global)
+    runs, accuracy = smoothen_df(1, result_df)
+
+    # runs of the best config of every algorithm at the last round
+    best = best_results(runs, accuracy[:, T_main - 1])
+    mask = pd.MultiIndex.from_frame(runs[["algorithm", "memory","mu"]]).isin(best.index)
+    smoothed = ewma(accuracy[mask], 1 - smoothing)
+    smoothed_df_new = pd.DataFrame(
+        {
+            "round": np.tile(np.arange(T_main), mask.sum()),
+            "test_accuracy": smoothed.ravel(),
+            "algorithm": np.repeat(runs["algorithm"].to_numpy()[mask], T_main),
+        }
     )
-    result_df = result_df_original.copy(deep=True)
-    result_df = result_df[df_filter_global]
-    smoothed_df = smoothen_df(1, result_df)
-
-    T_results = T_main - 1
-    resultsgroup = smoothed_df[smoothed_df["_step"]==T_results].groupby(["algorithm", "memory","mu"], dropna = False)
-    accuracy_mean = resultsgroup.mean()["test_accuracy"]
-    best_idxs = accuracy_mean.groupby("algorithm").idxmax()
-
-    smoothed_df_new = pd.DataFrame()
-    # Smooth the data for each unique combination of 'algorithm' and 'algo_seed' separately using EWMA
-
-    for (algorithm, seed, memory, mu, dataset_alpha, noise, systems_heterogenity), group in smoothed_df.groupby(
-        ["algorithm", "seed", "memory","mu","dataset_alpha", "noise", "systems_heterogenity"], dropna = False
-    ):
-        algorithm_df = group
-        # Sort the unique step values for interpolation
-        sorted_steps = np.sort(algorithm_df["_step"].unique())
-
-        # Perform EWMA smoothing on the accuracy
-        smoothed_accuracy = algorithm_df["test_accuracy"].ewm(alpha=1-smoothing).mean()
-
-        algorithm_smoothed_df = pd.DataFrame(
-            {
-                "_step": sorted_steps,
-                "test_accuracy": smoothed_accuracy,
-                "algorithm": algorithm,
-                "seed": seed,
-                "memory": memory,
-                "mu":mu,
-                "dataset_alpha":dataset_alpha,
-                "noise":noise,
-                "systems_heterogenity":systems_heterogenity,
-            }
-        )
-
-        if (checknanequality(memory, best_idxs[algorithm][1])) and checknanequality(mu,best_idxs[algorithm][2]):
-            smoothed_df_new = pd.concat([smoothed_df_new, algorithm_smoothed_df])
 
     g = sns.lineplot(
-        data=smoothed_df_new, x="_step", y="test_accuracy", hue="algorithm", palette="tab10", errorbar="sd"
+        data=smoothed_df_new, x="round", y="test_accuracy", hue="algorithm", palette="tab10", errorbar="sd"
     )
     sns.despine()
     plt.ylabel("Test Accuracy")
@@ -278,79 +285,70 @@ def generate_timing_plots(result_df_original, smoothing=0, T = [150, 250, 350]):
 
 
 
-def generate_datahet_results(result_df_original, smoothing=0):
+def generate_datahet_results(smoothing=0):
     noise = 0
     systems_heterogenity = 0
     T = T_main
 
     df_filter_global = (
-        (result_df_original["noise"] == noise)
-        & (result_df_original["systems_heterogenity"] == systems_heterogenity)
-        & (result_df_original["algo_beta"] != 0.01)
+        (ds.field("noise") == noise)
+        & (ds.field("systems_heterogenity") == systems_heterogenity)
+        & ucb_filter
     )
-    result_df = result_df_original.copy(deep=True)
-    result_df = result_df[df_filter_global]
-    smoothed_df = smoothen_df(1 - smoothing, result_df)
+    result_df = load_results(df_filter_global)
+    runs, smoothed = smoothen_df(1 - smoothing, result_df)
 
     # Timing constraints data MNIST
-    results_1 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["dataset_alpha"]==1e-4])
-    results_2 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["dataset_alpha"]==1e-1])
-    results_3 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["dataset_alpha"]==1e1])
-    for algo, a, b ,c in zip(algo_list_formal, results_1, results_2, results_3):
+    results = format_results(T, runs, smoothed, by="dataset_alpha", values=[1e-4, 1e-1, 1e1])
+    for algo, (a, b ,c) in zip(algo_list_formal, results):
         print(f"& {algo} & {a} & {b} & {c} \\\\")
 
-def generate_systems_results(result_df_original, smoothing=0):
+def generate_systems_results(smoothing=0):
     noise = 0
     dataset_alpha = 1e-4
     T = T_main
 
     df_filter_global = (
-        (result_df_original["noise"] == noise)
-        & (result_df_original["dataset_alpha"] == dataset_alpha)
-        & (result_df_original["algo_beta"] != 0.01)
+        (ds.field("noise") == noise)
+        & (ds.field("dataset_alpha") == dataset_alpha)
+        & ucb_filter
     )
-    result_df = result_df_original.copy(deep=True)
-    result_df = result_df[df_filter_global]
+    result_df = load_results(df_filter_global)
 
-    smoothed_df = smoothen_df(1 - smoothing, result_df)
+    runs, smoothed = smoothen_df(1 - smoothing, result_df)
 
     # Timing constraints data MNIST
-    results_1 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["systems_heterogenity"]==0])
-    results_2 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["systems_heterogenity"]==0.5])
-    results_3 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["systems_heterogenity"]==0.9])
-    for algo, a, b ,c in zip(algo_list_formal, results_1, results_2, results_3):
+    results = format_results(T, runs, smoothed, by="systems_heterogenity", values=[0, 0.5, 0.9])
+    for algo, (a, b ,c) in zip(algo_list_formal, results):
         print(f"& {algo} & {a} & {b} & {c} \\\\")
 
-def generate_noise_results(result_df_original, smoothing=0):
+def generate_noise_results(smoothing=0):
     systems_heterogenity = 0
     dataset_alpha = 1e-4
     T = T_main
 
     df_filter_global = (
-        (result_df_original["systems_heterogenity"] == systems_heterogenity)
-        & (result_df_original["dataset_alpha"] == dataset_alpha)
-        & (result_df_original["algo_beta"] != 0.01)
+        (ds.field("systems_heterogenity") == systems_heterogenity)
+        & (ds.field("dataset_alpha") == dataset_alpha)
+        & ucb_filter
     )
-    result_df = result_df_original.copy(deep=True)
-    result_df = result_df[df_filter_global]
+    result_df = load_results(df_filter_global)
 
-    smoothed_df = smoothen_df(1 - smoothing, result_df)
+    runs, smoothed = smoothen_df(1 - smoothing, result_df)
 
     # Timing constraints data MNIST
-    results_1 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["noise"]==0])
-    results_2 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["noise"]==0.05])
-    results_3 = format_results(T_results=T, smoothed_df=smoothed_df[smoothed_df["noise"]==0.1])
-    for algo, a, b ,c in zip(algo_list_formal, results_1, results_2, results_3):
+    results = format_results(T, runs, smoothed, by="noise", values=[0, 0.05, 0.1])
+    for algo, (a, b ,c) in zip(algo_list_formal, results):
         print(f"& {algo} & {a} & {b} & {c} \\\\")
 
 # generate LaTeX tables from raw run data
 print("data")
-generate_datahet_results(result_df_original)
+generate_datahet_results()
 print("timing")
-generate_timing_results(result_df_original, T=T_array)
+generate_timing_results(T=T_array)
 print("systems")
-generate_systems_results(result_df_original)
+generate_systems_results()
 print("noise")
-generate_noise_results(result_df_original)
+generate_noise_results()
 print("plots")
-generate_timing_plots(result_df_original, T=T_array)
\ No newline at end of file
+generate_timing_plots(T=T_array)
\ No newline at end of file
@@ -0,0 +1,140 @@
+import torch
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+
+class Profiler:
+    """
+    named wall-clock timers and counters of the hot paths (client training,
+    aggregation, validation losses, Shapley estimation, metrics), collected per round
+    everything is a no-op while the profiler is disabled (the default)
+    timers are summed over calls, so concurrent calls (thread executor) can add up to
+    more than the round time, calls made inside worker processes are not recorded
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.synchronize = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self, path=None, synchronize=False):
+        """
+        path - JSON lines file that every round record is appended to (None to only
+        return the records)
+        synchronize - wait for pending CUDA work before reading a timer
+        """
+        self.enabled = True
+        self.path = path
+        self.synchronize = synchronize and torch.cuda.is_available()
+        if path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+        self.path = None
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.round_start = perf_counter()
+
+    @contextmanager
+    def timer(self, name):
+        """
+        times the enclosed block under name
+        """
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.add_time(name, perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, value=1):
+        """
+        adds value to the counter name
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_bytes(self, name, *tensors):
+        """
+        adds the size in bytes of tensors to the counter name
+        """
+        if not self.enabled:
+            return
+        self.count(
+            name, sum(tensor.nelement() * tensor.element_size() for tensor in tensors)
+        )
+
+    def end_round(self, t, **fields):
+        """
+        t - round number
+        fields - additional entries of the record (algorithm, seed, ...)
+
+        returns the record of the timers and counters since the last call (None while
+        disabled) and appends it to the JSON lines file
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            record = {
+                "round": t,
+                **fields,
+                "round_time": perf_counter() - self.round_start,
+                "timers": {
+                    name: {"time": self.times[name], "calls": self.calls[name]}
+                    for name in self.times
+                },
+                "counters": dict(self.counters),
+            }
+            self.times = {}
+            self.calls = {}
+            self.counters = {}
+            self.round_start = perf_counter()
+        if self.path is not None:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+        return record
+
+
+# profiler used by all instrumented functions
+profiler = Profiler()
+
+
+def timed(name):
+    """
+    decorator that times every call of the decorated function under name
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -2,15 +2,103 @@ import torch
 import torch.optim as optim
 import numpy as np
 
+from collections import OrderedDict
 from copy import deepcopy
-from itertools import chain, combinations
 from math import comb
 
+from aggregation import (
+    FlatUpdates,
+    PermutationPrefixes,
+    flatten_state,
+    gray_code_last,
+    gray_code_subsets,
+    stacked_losses,
+)
+from profiling import profiler, timed
 from utils import convergenceTest
 
 
+def coalition_weights(weights, subset):
+    """
+    returns the weight vector with every client outside subset set to zero
+    """
+    subset = np.asarray(subset, dtype=int)
+    coalition = np.zeros(len(weights))
+    coalition[subset] = weights[subset]
+    return coalition
+
+
+def subset_mask(subset):
+    """
+    returns the bitmask of a subset of clients (bit i set if client i is in subset)
+    """
+    return sum(1 << int(i) for i in set(subset))
+
+
+class UtilityCache:
+    """
+    LRU cache of coalition utilities keyed by the bitmask of the coalition
+    entries are only valid for one round (one set of client updates and server model)
+    """
+
+    def __init__(self, maxsize):
+        """
+        maxsize - maximum number of cached utilities (0 disables caching)
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.key = None
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, key):
+        """
+        starts a new shapley estimate, entries are kept if key (the round) is unchanged
+        """
+        if key != self.key:
+            self.entries.clear()
+            self.key = key
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.key = None
+
+    def get(self, mask):
+        if mask in self.entries:
+            self.entries.move_to_end(mask)
+            self.hits += 1
+            return self.entries[mask]
+        self.misses += 1
+        return None
+
+    def put(self, mask, value):
+        if not self.maxsize:
+            return
+        self.entries[mask] = value
+        self.entries.move_to_end(mask)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+
 class Server:
-    def __init__(self, model, val_data, val_targets, test_data, test_targets, device):
+    def __init__(
+        self,
+        model,
+        val_data,
+        val_targets,
+        test_data,
+        test_targets,
+        device,
+        coalition_batch_size=16,
+        coalition_cache_size=2**16,
+        eval_chunk_size=4096,
+    ):
         self.model = deepcopy(model).to(device)
         self.val_data = val_data.to(device=device)
         self.val_targets = val_targets.to(device=device)
@@ -22,41 +110,328 @@ class Server:
         # to keep track of the number of model validation loss evaluations for shapley algorithms
         self.model_evaluations = 0
 
-    def aggregate(self, client_states, weights=None):
+        # preallocated flat parameter buffer and model reused by aggregate_
+        self.aggregate_buffer = None
+        self.aggregate_model = None
+
+        # number of coalition models evaluated per vectorized forward pass
+        # (None evaluates one aggregated model at a time)
+        self.coalition_batch_size = coalition_batch_size
+        self.coalition_buffer = None
+
+        # coalition utilities shared by all shapley estimators within a round, a round
+        # (generation) ends with every aggregate
+        self.utility_cache = UtilityCache(coalition_cache_size)
+        self.generation = 0
+
+        # number of samples per forward pass in evaluate (None for the whole set)
+        self.eval_chunk_size = eval_chunk_size
+
+    def __deepcopy__(self, memo):
+        """
+        copies share the (read-only) validation and test data, the model and the
+        per-run state (counters, buffers, coalition cache) are copied
+        """
+        for tensor in [
+            self.val_data,
+            self.val_targets,
+            self.test_data,
+            self.test_targets,
+        ]:
+            memo[id(tensor)] = tensor
+        server = Server.__new__(Server)
+        memo[id(self)] = server
+        server.__dict__.update(deepcopy(self.__dict__, memo))
+        return server
+
+    def flat_updates(self, client_states):
         """
         client_states - list of client states
+
+        returns the client states stacked as rows of one flat parameter matrix
+        """
+        if isinstance(client_states, FlatUpdates):
+            return client_states
+        return FlatUpdates(client_states, self.model.state_dict(), self.device)
+
+    @timed("server.aggregate")
+    def aggregate(self, client_states, weights=None):
+        """
+        client_states - list of client states (or FlatUpdates)
         weights - weights for averaging (uniform by default)
 
         updates server model by performing weighted averaging
         """
-        model = self.aggregate_(client_states, weights)
-        self.model.load_state_dict(model.state_dict())
-
+        updates = self.flat_updates(client_states)
+        flat = self.aggregate_flat(updates, weights)
+        self.model.load_state_dict(updates.unflatten(flat))
+        # cached coalition utilities refer to the previous server model and updates
+        self.generation += 1
+        self.utility_cache.clear()
+
+    @timed("server.aggregate_")
     def aggregate_(self, client_states, weights=None):
         """
         does not modify the server model
-        only returns the updated model
+        only returns the updated model (a new model that the caller may keep)
+        """
+        updates = self.flat_updates(client_states)
+        flat = self.aggregate_flat(updates, weights)
+        model = deepcopy(self.model)
+        model.load_state_dict(updates.unflatten(flat))
+        return model
+
+    def aggregate_view(self, updates, weights=None):
+        """
+        updates - FlatUpdates
+        weights - weights for averaging (uniform by default)
+
+        like aggregate_ without copying: the returned model is one reused model whose
+        parameters are views into the preallocated aggregation buffer, so it is
+        overwritten by the next aggregate/aggregate_view call (only for evaluating
+        coalitions one at a time)
         """
-        if len(client_states) == 0:
-            return deepcopy(self.model).to(device=self.device)
+        flat = self.aggregate_flat(updates, weights)
+        if self.aggregate_model is None:
+            self.aggregate_model = deepcopy(self.model)
+        return updates.bind(self.aggregate_model, flat)
+
+    def aggregate_flat(self, updates, weights=None):
+        """
+        updates - FlatUpdates
+        weights - weights for averaging (uniform by default), zero weight excludes a client
+
+        returns the weighted average as a flat parameter vector in a preallocated buffer
+        an empty coalition returns the current server model
+        """
+        if (
+            self.aggregate_buffer is None
+            or self.aggregate_buffer.numel() != updates.num_params
+        ):
+            self.aggregate_buffer = torch.empty(
+                updates.num_params, dtype=updates.dtype, device=self.device
+            )
         if weights is None:
             # uniform weights by default
-            weights = [1 / len(client_states)] * len(client_states)
-        weights = np.array(weights)
+            weights = [1] * len(updates)
+        weights = np.array(weights, dtype=float)
         wtsum = np.sum(weights)
+        if len(updates) == 0 or wtsum == 0:
+            return flatten_state(
+                self.model.state_dict(), updates.keys, out=self.aggregate_buffer
+            )
         weights = weights / wtsum  # normalize weights
-        # initialise model parameters to zero
-        model_state = deepcopy(self.model).state_dict()
-        for key in model_state.keys():
-            model_state[key] -= model_state[key]
-        # find updated model - weighted averaging
-        for idx, client_state in enumerate(client_states):
-            for key in model_state.keys():
-                model_state[key] += weights[idx] * client_state[key]
-        model = deepcopy(self.model).to(device=self.device)
-        model.load_state_dict(model_state)
-        return model
+        return updates.combine(
+            updates.weight_tensor(weights), out=self.aggregate_buffer
+        )
+
+    def bind_cache(self, criterion, weights):
+        """
+        starts a shapley estimate, keeping the cached coalition utilities if they were
+        computed with the same weights and criterion since the last aggregate
+
+        the client updates are not part of the key: all estimates between two
+        aggregate calls must be of the same client updates (one round), estimating
+        other updates without aggregating needs utility_cache.clear() first
+        the criterion is compared by identity, closures or partials with different
+        captured state (e.g. FedProx mu) never share utilities, fed_avg_criterion()
+        returns the same function every time
+        """
+        self.utility_cache.bind((self.generation, weights.tobytes(), criterion))
+
+    def cache_hit_rate(self):
+        """
+        fraction of coalition utilities served from the cache in the last shapley estimate
+        """
+        return self.utility_cache.hit_rate()
 
+    def cached_utilities(self, masks, values):
+        """
+        masks - bitmasks of the requested coalitions
+        values - array filled with the cached utilities
+
+        returns {mask: rows} for the coalitions that still have to be evaluated
+        """
+        missing = {}
+        for row, mask in enumerate(masks):
+            if mask in missing:
+                # repeated coalition within the request, evaluated once
+                missing[mask].append(row)
+                self.utility_cache.hits += 1
+                continue
+            value = self.utility_cache.get(mask)
+            if value is None:
+                missing[mask] = [row]
+            else:
+                values[row] = value
+        return missing
+
+    def cache_utilities(self, missing, missing_values, values):
+        """
+        stores the utilities of the missing coalitions and fills them into values
+        """
+        for (mask, rows), value in zip(missing.items(), missing_values):
+            self.utility_cache.put(mask, value)
+            values[rows] = value
+
+    def coalition_values(self, criterion, updates, coalitions):
+        """
+        criterion - loss function (model, data, targets)
+        updates - FlatUpdates
+        coalitions - (K, num_clients) array of averaging weights, zero weight excludes a client
+
+        returns the utilities (1 - validation loss) of the K aggregated models
+        """
+        coalitions = np.atleast_2d(np.asarray(coalitions, dtype=float))
+        masks = [subset_mask(np.flatnonzero(coalition)) for coalition in coalitions]
+        values = np.empty(len(coalitions))
+        missing = self.cached_utilities(masks, values)
+        if len(missing) > 0:
+            rows = [mask_rows[0] for mask_rows in missing.values()]
+            missing_values = self.evaluate_coalitions(
+                criterion, updates, coalitions[rows]
+            )
+            self.cache_utilities(missing, missing_values, values)
+        return values
+
+    def evaluate_coalitions(self, criterion, updates, coalitions):
+        """
+        coalitions - (K, num_clients) array of averaging weights, zero weight excludes a client
+
+        returns the utilities (1 - validation loss) of the K aggregated models
+        batched mode materialises coalition_batch_size models per vectorized forward pass
+        """
+        num_coalitions = len(coalitions)
+        if not self.coalition_batch_size:
+            return np.array(
+                [
+                    1
+                    - self.val_loss(self.aggregate_view(updates, coalition), criterion)
+                    for coalition in coalitions
+                ]
+            )
+        wtsum = np.sum(coalitions, axis=1, keepdims=True)
+        empty = wtsum[:, 0] == 0
+        coalitions = coalitions / np.where(wtsum == 0, 1, wtsum)  # normalize weights
+        if np.any(empty):
+            # an empty coalition leaves the server model unchanged
+            server_params = flatten_state(self.model.state_dict(), updates.keys)
+
+        values = np.empty(num_coalitions)
+        batch_size = self.coalition_batch_size
+        for start in range(0, num_coalitions, batch_size):
+            stop = min(start + batch_size, num_coalitions)
+            if self.coalition_buffer is None or self.coalition_buffer.shape != (
+                stop - start,
+                updates.num_params,
+            ):
+                self.coalition_buffer = torch.empty(
+                    (stop - start, updates.num_params),
+                    dtype=updates.dtype,
+                    device=self.device,
+                )
+            params = updates.combine(
+                updates.weight_tensor(coalitions[start:stop]),
+                out=self.coalition_buffer,
+            )
+            for row in np.flatnonzero(empty[start:stop]):
+                params[row] = server_params
+            values[start:stop] = self.params_values(criterion, updates, params)
+        return values
+
+    def params_values(self, criterion, updates, params):
+        """
+        params - (K, num_params) flat parameters of K models in the layout of updates
+
+        returns the utilities (1 - validation loss) of the K models
+        evaluated coalition_batch_size models at a time (one at a time if None)
+        """
+        values = np.empty(len(params))
+        if not self.coalition_batch_size:
+            if self.aggregate_model is None:
+                self.aggregate_model = deepcopy(self.model)
+            for row in range(len(params)):
+                model_row = updates.bind(self.aggregate_model, params[row])
+                values[row] = 1 - self.val_loss(model_row, criterion)
+            return values
+        batch_size = self.coalition_batch_size
+        for start in range(0, len(params), batch_size):
+            stop = min(start + batch_size, len(params))
+            values[start:stop] = 1 - self.val_losses(
+                params[start:stop], criterion, updates
+            )
+        return values
+
+    def cached_params_values(self, criterion, updates, masks, params):
+        """
+        masks - bitmasks of the coalitions
+        params - (K, num_params) flat parameters of the K coalition models
+
+        returns the utilities of the K coalitions, only uncached ones are evaluated
+        """
+        values = np.empty(len(masks))
+        missing = self.cached_utilities(masks, values)
+        if len(missing) > 0:
+            rows = [mask_rows[0] for mask_rows in missing.values()]
+            missing_values = self.params_values(criterion, updates, params[rows])
+            self.cache_utilities(missing, missing_values, values)
+        return values
+
+    def prefix_values(
+        self, criterion, updates, weights, permutations, v_init, v_final, threshold
+    ):
+        """
+        permutations - (K, num_clients) array of client permutations
+        v_init, v_final - utilities of the empty and of the grand coalition
+        threshold - truncation threshold of permutation_walk
+
+        returns the (K, num_clients) array whose entry [p, j] is the utility of
+        permutations[p][: j + 1] as used by permutation_walk: once a utility is within
+        threshold of v_final the permutation is truncated and keeps it
+        prefixes are evaluated one position at a time for the permutations that are not
+        truncated yet, so truncated prefixes are never evaluated (or counted)
+        """
+        permutations = np.asarray(permutations, dtype=int)
+        num_permutations, num_clients = permutations.shape
+        prefixes = PermutationPrefixes(updates, weights, permutations)
+        masks = [0] * num_permutations
+        values = np.empty((num_permutations, num_clients))
+        current = np.full(num_permutations, v_init)
+        for j in range(num_clients):
+            masks = [mask | (1 << int(i)) for mask, i in zip(masks, permutations[:, j])]
+            values[:, j] = current
+            active = np.flatnonzero(np.abs(v_final - current) >= threshold)
+            if len(active) > 0:
+                params = prefixes.step(j, active)
+                values[active, j] = self.cached_params_values(
+                    criterion, updates, [masks[p] for p in active], params
+                )
+            current = values[:, j]
+        return values
+
+    def permutation_walk(
+        self, shapley_values, t, client_permutation, v_init, v_final, threshold, value
+    ):
+        """
+        shapley_values - running shapley value averages (updated in place)
+        value - value(j) returns the utility of client_permutation[: j + 1]
+
+        adds the marginal utility of every client along the permutation as the t-th sample
+        truncates once the utility is within threshold of v_final
+        """
+        v_j = v_init
+        for j in range(len(client_permutation)):
+            if np.abs(v_final - v_j) < threshold:
+                v_jplus1 = v_j
+            else:
+                v_jplus1 = value(j)
+
+            phi_old = shapley_values[client_permutation[j]][-1]
+            phi_new = ((t - 1) * phi_old + (v_jplus1 - v_j)) / t
+            shapley_values[client_permutation[j]].append(phi_new)
+            v_j = v_jplus1
+
+    @timed("server.shapley_values_mc")
     def shapley_values_mc(self, criterion, client_states, weights=None):
         """
         client_states - list of client states
@@ -71,8 +446,10 @@ class Server:
         weights = np.array(weights)
         wtsum = np.sum(weights)
         weights = weights / wtsum  # normalize weights
+        self.bind_cache(criterion, weights)
 
         num_clients = len(client_states)
+        updates = self.flat_updates(client_states)
         T = 50
 
         shapley_values = [[0] for i in range(num_clients)]
@@ -93,24 +470,21 @@ class Server:
             t = 0
             converged = False
             remaining_clients = [i for i in range(num_clients) if i != idx]
-            while t < T:
+            # sample all subsets first so that their utilities are evaluated together
+            coalitions = []
+            for _ in range(T):
                 subset_size = np.random.choice(list(range(num_clients - 1)), size=1)[0]
                 subset = np.random.choice(
                     remaining_clients, size=subset_size, replace=False
                 )
-                client_states_subset = [client_states[i] for i in subset]
-                weights_subset = [weights[i] for i in subset]
-                model_subset = self.aggregate_(client_states_subset, weights_subset)
-                loss_subset = self.val_loss(model_subset, criterion)
-                value_subset = 1 - loss_subset
-
-                client_states_subset.append(client_states[idx])
-                weights_subset.append(weights[idx])
-                model_subset_with_idx = self.aggregate_(
-                    client_states_subset, weights_subset
-                )
-                loss_subset_with_idx = self.val_loss(model_subset_with_idx, criterion)
-                value_subset_with_idx = 1 - loss_subset_with_idx
+                weights_subset = coalition_weights(weights, subset)
+                coalitions.append(weights_subset.copy())
+                weights_subset[idx] = weights[idx]
+                coalitions.append(weights_subset)
+            values = self.coalition_values(criterion, updates, coalitions)
+            while t < T:
+                value_subset = values[2 * t]
+                value_subset_with_idx = values[2 * t + 1]
 
                 utility_gain = value_subset_with_idx - value_subset
                 prev_avg = shapley_values[idx][-1]
@@ -124,6 +498,7 @@ class Server:
         final_shapley_values = [shapley_values[i][-1] for i in range(num_clients)]
         return final_shapley_values
 
+    @timed("server.shapley_values_tmc")
     def shapley_values_tmc(self, criterion, client_states, weights=None):
         """
         client_states - list of client states
@@ -138,8 +513,10 @@ class Server:
         weights = np.array(weights)
         wtsum = np.sum(weights)
         weights = weights / wtsum  # normalize weights
+        self.bind_cache(criterion, weights)
 
         num_clients = len(client_states)
+        updates = self.flat_updates(client_states)
 
         shapley_values = [[0] for i in range(num_clients)]
         converged = False
@@ -147,27 +524,31 @@ class Server:
         T = 50 * num_clients
         t = 0
         threshold = 1e-4
-        v_init = 1 - self.val_loss(self.model, criterion)  # initial server model loss
-        model_final = self.aggregate_(client_states, weights)
-        v_final = 1 - self.val_loss(model_final, criterion)  # final server model loss
+        # initial and final server model utilities (empty and grand coalition)
+        v_init, v_final = self.coalition_values(
+            criterion, updates, [np.zeros(num_clients), weights]
+        )
         while not converged and (t < T):
             t += 1
             client_permutation = np.random.permutation(num_clients)
-            v_j = v_init
-            for j in range(num_clients):
-                if np.abs(v_final - v_j) < threshold:
-                    v_jplus1 = v_j
-                else:
-                    subset = client_permutation[: (j + 1)]
-                    client_states_subset = [client_states[i] for i in subset]
-                    weights_subset = [weights[i] for i in subset]
-                    model_subset = self.aggregate_(client_states_subset, weights_subset)
-                    v_jplus1 = 1 - self.val_loss(model_subset, criterion)
-
-                phi_old = shapley_values[client_permutation[j]][-1]
-                phi_new = ((t - 1) * phi_old + (v_jplus1 - v_j)) / t
-                shapley_values[client_permutation[j]].append(phi_new)
-                v_j = v_jplus1
+            values = self.prefix_values(
+                criterion,
+                updates,
+                weights,
+                [client_permutation],
+                v_init,
+                v_final,
+                threshold,
+            )
+            self.permutation_walk(
+                shapley_values,
+                t,
+                client_permutation,
+                v_init,
+                v_final,
+                threshold,
+                lambda j: values[0, j],
+            )
 
             flag = True
             shapley_avg = np.mean(shapley_values, axis=0)
@@ -180,6 +561,7 @@ class Server:
         final_shapley_values = [shapley_values[i][-1] for i in range(num_clients)]
         return final_shapley_values
 
+    @timed("server.shapley_values_gtg")
     def shapley_values_gtg(self, criterion, client_states, weights=None):
         """
         client_states - list of client states
@@ -194,8 +576,10 @@ class Server:
         weights = np.array(weights)
         wtsum = np.sum(weights)
         weights = weights / wtsum  # normalize weights
+        self.bind_cache(criterion, weights)
 
         num_clients = len(client_states)
+        updates = self.flat_updates(client_states)
 
         shapley_values = [[0] for i in range(num_clients)]
         converged = False
@@ -203,9 +587,10 @@ class Server:
         T = 50 * num_clients
         t = 0
         threshold = 1e-4
-        v_init = 1 - self.val_loss(self.model, criterion)  # initial server model loss
-        model_final = self.aggregate_(client_states, weights)
-        v_final = 1 - self.val_loss(model_final, criterion)  # final server model loss
+        # initial and final server model utilities (empty and grand coalition)
+        v_init, v_final = self.coalition_values(
+            criterion, updates, [np.zeros(num_clients), weights]
+        )
         if np.abs(v_final - v_init) < threshold:
             # between round truncation
             print(
@@ -216,8 +601,9 @@ class Server:
             return [epsilon for i in range(num_clients)]
 
         while not converged and (t < T):
+            # one permutation starting with each client, evaluated together
+            client_permutations = []
             for client_idx in range(num_clients):
-                t += 1
                 client_permutation = np.concatenate(
                     (
                         np.array([client_idx]),
@@ -226,23 +612,27 @@ class Server:
                         ),
                     )
                 ).astype(int)
-                v_j = v_init
-                for j in range(num_clients):
-                    if np.abs(v_final - v_j) < threshold:
-                        v_jplus1 = v_j
-                    else:
-                        subset = client_permutation[: (j + 1)]
-                        client_states_subset = [client_states[i] for i in subset]
-                        weights_subset = [weights[i] for i in subset]
-                        model_subset = self.aggregate_(
-                            client_states_subset, weights_subset
-                        )
-                        v_jplus1 = 1 - self.val_loss(model_subset, criterion)
-
-                    phi_old = shapley_values[client_permutation[j]][-1]
-                    phi_new = ((t - 1) * phi_old + (v_jplus1 - v_j)) / t
-                    shapley_values[client_permutation[j]].append(phi_new)
-                    v_j = v_jplus1
+                client_permutations.append(client_permutation)
+            values = self.prefix_values(
+                criterion,
+                updates,
+                weights,
+                client_permutations,
+                v_init,
+                v_final,
+                threshold,
+            )
+            for client_idx in range(num_clients):
+                t += 1
+                self.permutation_walk(
+                    shapley_values,
+                    t,
+                    client_permutations[client_idx],
+                    v_init,
+                    v_final,
+                    threshold,
+                    lambda j: values[client_idx, j],
+                )
 
             flag = True
             shapley_avg = np.mean(shapley_values, axis=0)
@@ -255,6 +645,7 @@ class Server:
         final_shapley_values = [shapley_values[i][-1] for i in range(num_clients)]
         return final_shapley_values
 
+    @timed("server.shapley_values_true")
     def shapley_values_true(self, criterion, client_states, weights=None):
         """
         client_states - list of client states
@@ -264,75 +655,142 @@ class Server:
         """
         self.model_evaluations = 0
 
-        def powerset(iterable):
-            "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
-            s = list(iterable)
-            return list(
-                chain.from_iterable(combinations(s, r) for r in range(len(s) + 1))
-            )
-
         if weights is None:
             # uniform weights by default
             weights = [1 / len(client_states)] * len(client_states)
         weights = np.array(weights)
         wtsum = np.sum(weights)
         weights = weights / wtsum  # normalize weights
+        self.bind_cache(criterion, weights)
 
         num_clients = len(client_states)
-        client_subsets = powerset(range(num_clients))
-        subset_utilities = {i: 0 for i in client_subsets}
-        shapley_values = [[0] for i in range(num_clients)]
-
-        for subset in client_subsets:
-            client_states_subset = [client_states[i] for i in subset]
-            weights_subset = [weights[i] for i in subset]
-            model_subset = self.aggregate_(client_states_subset, weights_subset)
-            loss_subset = self.val_loss(model_subset, criterion)
-            subset_utilities[subset] = 1 - loss_subset
-
-        for subset in client_subsets:
-            for idx in range(num_clients):
-                L = len(subset)  # subset size
-                if idx in subset:
-                    nck = comb(num_clients - 1, L - 1)
-                    prev_val = shapley_values[idx][-1]
-                    new_val = prev_val + subset_utilities[subset] / (num_clients * nck)
-                    shapley_values[idx].append(new_val)
-                else:
-                    nck = comb(num_clients - 1, L)
-                    prev_val = shapley_values[idx][-1]
-                    new_val = prev_val - subset_utilities[subset] / (num_clients * nck)
-                    shapley_values[idx].append(new_val)
-
-        final_shapley_values = [shapley_values[i][-1] for i in range(num_clients)]
+        updates = self.flat_updates(client_states)
+        num_subsets = 2**num_clients
+        # utility of every subset indexed by its bitmask (bit i set if client i is in it)
+        subset_utilities = np.empty(num_subsets)
+
+        # with more subsets than cache entries every entry would be evicted before it
+        # is reused, so the cache is bypassed
+        use_cache = num_subsets <= self.utility_cache.maxsize
+
+        batch_size = self.coalition_batch_size or 1
+        params = torch.empty(
+            (batch_size, updates.num_params), dtype=updates.dtype, device=self.device
+        )
+        server_params = flatten_state(self.model.state_dict(), updates.keys)
+        batch_masks = []
+        for mask, average in gray_code_subsets(updates, weights):
+            utility = self.utility_cache.get(mask) if use_cache else None
+            if utility is not None:
+                subset_utilities[mask] = utility
+            elif average is None:
+                # the empty subset leaves the server model unchanged
+                params[len(batch_masks)] = server_params
+                batch_masks.append(mask)
+            else:
+                params[len(batch_masks)] = average
+                batch_masks.append(mask)
+            if len(batch_masks) == batch_size or (
+                mask == gray_code_last(num_clients) and len(batch_masks) > 0
+            ):
+                subset_utilities[batch_masks] = self.params_values(
+                    criterion, updates, params[: len(batch_masks)]
+                )
+                if use_cache:
+                    for batch_mask in batch_masks:
+                        self.utility_cache.put(batch_mask, subset_utilities[batch_mask])
+                batch_masks = []
+
+        # phi_i = sum_S u(S) / (N C(N-1, |S|-1)) over S containing i
+        #       - sum_S u(S) / (N C(N-1, |S|)) over S not containing i
+        masks = np.arange(num_subsets)
+        client_bits = [(masks >> idx) & 1 == 1 for idx in range(num_clients)]
+        subset_sizes = np.sum(client_bits, axis=0)
+        size_range = np.arange(num_clients + 1)
+        # the empty set never contains i and the full set always does (unused entries = 1)
+        nck_with = np.array(
+            [comb(num_clients - 1, L - 1) if L > 0 else 1 for L in size_range]
+        )
+        nck_without = np.array(
+            [comb(num_clients - 1, L) if L < num_clients else 1 for L in size_range]
+        )
+        utility_with = subset_utilities / (num_clients * nck_with[subset_sizes])
+        utility_without = subset_utilities / (num_clients * nck_without[subset_sizes])
+
+        final_shapley_values = [
+            np.sum(utility_with[bits]) - np.sum(utility_without[~bits])
+            for bits in client_bits
+        ]
         return final_shapley_values
 
-    def test_loss(self, criterion):
+    @timed("server.evaluate")
+    def evaluate(self, criterion, model=None):
         """
-        criterion - loss function (model, data, targets)
+        criterion - loss function (model, data, targets), mean over the samples
+        model - model to evaluate instead of the server model, e.g. a copy evaluated on
+        another thread while the server goes on (not counted in model_evaluations)
 
-        computes loss on test set with the server model
+        returns (test accuracy, test loss, validation loss) of the server model,
+        accuracy and loss share one forward pass over the test set and all three are
+        copied to the host at once
         """
-        self.model.eval()
+        counted = model is None
+        if model is None:
+            model = self.model
+        model.eval()
         with torch.no_grad():
-            loss = criterion(self.model, self.test_data, self.test_targets)
-        self.model.train()
-        return float(loss.cpu())
-
-    def accuracy(self):
-        """
-        test accuracy
+            test_correct, test_loss = self.evaluate_set(
+                self.test_data, self.test_targets, criterion, model
+            )
+            _, val_loss = self.evaluate_set(
+                self.val_data, self.val_targets, criterion, model
+            )
+        model.train()
+        if counted:
+            self.model_evaluations += 1
+            profiler.count("server.model_evaluations")
+        metrics = torch.stack(
+            [
+                test_correct / self.length,
+                test_loss / self.length,
+                val_loss / len(self.val_data),
+            ]
+        ).tolist()
+        return tuple(metrics)
+
+    def evaluate_set(self, data, targets, criterion, model=None):
         """
-        self.model.eval()
-        with torch.no_grad():
-            scores = self.model(self.test_data)
-            _, predictions = scores.max(1)
-            num_correct = torch.sum(predictions == self.test_targets)
-            total = self.length
-            accuracy = num_correct / total
-        self.model.train()
-        return float(accuracy.cpu())
+        criterion - loss function (model, data, targets), mean over the samples
 
+        returns the number of correct predictions and the summed loss of model (the
+        server model by default) on (data, targets), evaluated in chunks of
+        eval_chunk_size, the predictions come from the scores of the criterion's
+        forward pass
+        """
+        if model is None:
+            model = self.model
+        chunk_size = self.eval_chunk_size or len(data)
+        num_correct = torch.zeros((), device=self.device)
+        loss = torch.zeros((), device=self.device)
+        outputs = []
+        hook = model.register_forward_hook(
+            lambda module, args, output: outputs.append(output)
+        )
+        try:
+            for start in range(0, len(data), chunk_size):
+                chunk_targets = targets[start : start + chunk_size]
+                chunk_loss = criterion(
+                    model, data[start : start + chunk_size], chunk_targets
+                )
+                _, predictions = outputs.pop().max(1)
+                outputs.clear()
+                num_correct += torch.sum(predictions == chunk_targets)
+                loss += chunk_loss * len(chunk_targets)
+        finally:
+            hook.remove()
+        return num_correct, loss
+
+    @timed("server.val_loss")
     def val_loss(self, model, criterion):
         """
         model
@@ -345,4 +803,23 @@ class Server:
             loss = criterion(model, self.val_data, self.val_targets)
         model.train()
         self.model_evaluations += 1
+        profiler.count("server.model_evaluations")
         return float(loss.cpu())
+
+    @timed("server.val_losses")
+    def val_losses(self, params, criterion, updates):
+        """
+        params - (K, num_params) flat parameters of K models in the layout of updates
+        criterion - loss function (model, data, targets)
+
+        computes the validation loss of all K models in one vectorized forward pass
+        """
+        self.model.eval()
+        with torch.no_grad():
+            losses = stacked_losses(
+                self.model, criterion, updates, params, self.val_data, self.val_targets
+            )
+        self.model.train()
+        self.model_evaluations += len(params)
+        profiler.count("server.model_evaluations", len(params))
+        return losses.cpu().numpy()
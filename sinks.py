@@ -0,0 +1,356 @@
+import numpy as np
+import wandb
+
+import json
+import os
+import queue
+import threading
+import uuid
+from glob import glob
+from time import monotonic, time
+
+from profiling import profiler
+
+# results store written by the run loops and read by plotting.py
+RESULTS_PATH = "results/store"
+RESULTS_PARTITIONS = ["dataset", "algorithm"]
+
+# names of the scalar W&B keys that per-client arrays are expanded into
+WANDB_ARRAY_KEYS = {
+    "shapley_values": "shapley_value_{}",
+    "shapley_values_curr": "shapley_value_{}_curr",
+    "selections": "selection_{}",
+}
+
+
+def to_python(value):
+    """
+    converts numpy arrays and scalars in a record to lists and python numbers
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class MetricsSink:
+    """
+    base class of the metrics sinks, log() only queues a record and a background
+    thread hands the records to write() in batches of up to batch_size records, at the
+    latest flush_interval seconds after the first record of a batch
+    per-client values are logged as one array per key (e.g. "shapley_values")
+    """
+
+    def __init__(self, batch_size=64, flush_interval=5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.tags = {}
+        self.queue = queue.Queue()
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def tag(self, **tags):
+        """
+        sets the entries (run configuration) added to every following record, together
+        with a new run_id and the run_start time unless they are given
+        """
+        self.tags = {"run_id": uuid.uuid4().hex, "run_start": time(), **tags}
+
+    def log(self, record):
+        """
+        queues record (a dict) for writing, does not block
+        """
+        self.raise_error()
+        self.queue.put({**self.tags, **record})
+
+    def flush(self):
+        """
+        blocks until every queued record is written
+        """
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        self.raise_error()
+
+    def close(self):
+        """
+        writes the queued records and stops the background thread
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.finish()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def worker(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False  # the oldest record waited flush_interval seconds
+            if isinstance(item, dict):
+                batch.append(item)
+                if deadline is None:
+                    deadline = monotonic() + self.flush_interval
+                if len(batch) < self.batch_size:
+                    continue
+            if batch:
+                try:
+                    with profiler.timer("sink.write"):
+                        self.write(batch)
+                except Exception as error:
+                    self.error = error
+                batch = []
+                deadline = None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    def write(self, records):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+
+class JSONLSink(MetricsSink):
+    """
+    appends every record as one line of JSON to path (arrays as JSON lists)
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        super().__init__(**kwargs)
+
+    def write(self, records):
+        lines = [
+            json.dumps({key: to_python(value) for key, value in record.items()})
+            for record in records
+        ]
+        with open(self.path, "a") as file:
+            file.write("\n".join(lines) + "\n")
+
+
+class ParquetSink(MetricsSink):
+    """
+    writes every batch of records as one Parquet file in the directory path, so that
+    records with different columns (runs of different algorithms) can share it
+    with partition_by the files go to hive-style subdirectories (e.g.
+    dataset=mnist/algorithm=fedavg/) and the partition columns are stored in the path
+    arrays are stored as list columns, read the directory back with read_parquet
+    (needs pyarrow)
+    """
+
+    def __init__(self, path, partition_by=None, **kwargs):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("ParquetSink needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.partition_by = list(partition_by or [])
+        self.prefix = uuid.uuid4().hex
+        self.num_parts = 0
+        os.makedirs(path, exist_ok=True)
+        super().__init__(**kwargs)
+
+    def tag(self, **tags):
+        """
+        tags that are not scalars (e.g. per-client epochs) are stored as JSON strings,
+        so that a tag column has the same type in every run
+        """
+        super().tag(
+            **{
+                key: json.dumps(to_python(value)) if np.ndim(value) > 0 else value
+                for key, value in tags.items()
+            }
+        )
+
+    def write(self, records):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        partitions = {}
+        for record in records:
+            directory = os.path.join(
+                self.path,
+                *[f"{key}={record.get(key)}" for key in self.partition_by],
+            )
+            partitions.setdefault(directory, []).append(
+                {
+                    key: to_python(value)
+                    for key, value in record.items()
+                    if key not in self.partition_by
+                }
+            )
+        for directory, rows in partitions.items():
+            os.makedirs(directory, exist_ok=True)
+            part = os.path.join(
+                directory, f"{self.prefix}-{self.num_parts:05d}.parquet"
+            )
+            pq.write_table(pa.Table.from_pylist(rows), part)
+            self.num_parts += 1
+
+
+def read_parquet(path, columns=None, filter=None):
+    """
+    path - directory written by ParquetSink
+    columns - columns to read (all by default), columns that no file has are read as
+    nulls
+    filter - pyarrow.dataset expression, e.g. pyarrow.dataset.field("round") < 100
+
+    returns the records as a pandas DataFrame, the files are read with the union of
+    their schemas (runs of different algorithms log different columns)
+    the filter is pushed down, partitions that do not match it are skipped and only
+    the row groups whose statistics can match are read
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    files = sorted(glob(os.path.join(path, "**", "*.parquet"), recursive=True))
+    if len(files) == 0:
+        raise FileNotFoundError(f"no Parquet files in {path}")
+    partitions = []
+    for file in files:
+        for part in os.path.relpath(os.path.dirname(file), path).split(os.sep):
+            if "=" in part and part.split("=")[0] not in partitions:
+                partitions.append(part.split("=")[0])
+    # most files of a directory share their schema
+    schemas = list(dict.fromkeys(pq.read_schema(file) for file in files))
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, set()).add(field.type)
+    # a tag that is a scalar in some runs and JSON in others (E) is read as a string
+    mixed = {
+        name for name in types if len(types[name]) > 1 and pa.string() in types[name]
+    }
+    schemas = [
+        pa.schema(
+            [
+                field.with_type(pa.string()) if field.name in mixed else field
+                for field in schema
+            ]
+        )
+        for schema in schemas
+    ]
+    schema = pa.unify_schemas(schemas, promote_options="permissive")
+    partitioning = pa.schema([(name, pa.string()) for name in partitions])
+    for field in partitioning:
+        schema = schema.append(field)
+    for name in columns or []:
+        if name not in schema.names:
+            schema = schema.append(pa.field(name, pa.null()))
+    dataset = ds.dataset(
+        files,
+        schema=schema,
+        format="parquet",
+        partitioning=ds.partitioning(partitioning, flavor="hive"),
+        partition_base_dir=path,
+    )
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+class WandbSink(MetricsSink):
+    """
+    logs every record to the current W&B run (wandb.init is left to the caller)
+    with expand_arrays the per-client arrays are logged as the scalar keys of earlier
+    runs (shapley_value_{i}, selection_{i}, ...) so existing dashboards keep working
+    the round number is logged as the W&B step, since the records are written from
+    the background thread, tags are not logged (W&B keeps its own config)
+    the sink must be closed before wandb.finish(), records written later are lost
+    """
+
+    def __init__(self, expand_arrays=True, **kwargs):
+        self.expand_arrays = expand_arrays
+        super().__init__(**kwargs)
+
+    def log(self, record):
+        self.raise_error()
+        self.queue.put(record)
+
+    def write(self, records):
+        for record in records:
+            record = dict(record)
+            step = record.pop("round", None)
+            wandb.log(self.expand(record) if self.expand_arrays else record, step=step)
+
+    def expand(self, record):
+        expanded = {}
+        for key, value in record.items():
+            if isinstance(value, np.ndarray) and value.ndim == 1:
+                name = WANDB_ARRAY_KEYS.get(key, key + "_{}")
+                for i, item in enumerate(value.tolist()):
+                    expanded[name.format(i)] = item
+            else:
+                expanded[key] = value
+        return expanded
+
+
+class SinkGroup:
+    """
+    the sinks of one run: logs every record to all of them, close() closes the sinks
+    created for the run (owned) and only flushes sinks shared with other runs
+    """
+
+    def __init__(self, shared=(), owned=()):
+        self.shared = [sink for sink in shared if sink is not None]
+        self.owned = list(owned)
+
+    def log(self, record):
+        for sink in self.shared + self.owned:
+            sink.log(record)
+
+    def close(self):
+        """
+        call before wandb.finish(), the W&B sink writes to the current W&B run
+        """
+        for sink in self.shared:
+            sink.flush()
+        for sink in self.owned:
+            sink.close()
+
+
+def make_sink(backend, path=None, **kwargs):
+    """
+    backend - one of ["results", "jsonl", "parquet", "wandb"] (None for no sink)
+    path - file (jsonl) or directory (results, parquet) the records are written to
+    "results" is the results store read by plotting.py, Parquet files partitioned by
+    dataset and algorithm (needs pyarrow, raises ImportError before any run starts)
+    """
+    if backend is None:
+        return None
+    elif backend == "results":
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(
+                "the results store needs pyarrow (pip install pyarrow), or set "
+                '"sink" to "jsonl" or None'
+            )
+        # about one file per run, every run is flushed when it ends
+        kwargs = {"batch_size": 1024, "flush_interval": 60.0, **kwargs}
+        return ParquetSink(path or RESULTS_PATH, RESULTS_PARTITIONS, **kwargs)
+    elif backend == "jsonl":
+        return JSONLSink(path, **kwargs)
+    elif backend == "parquet":
+        return ParquetSink(path, **kwargs)
+    elif backend == "wandb":
+        return WandbSink(**kwargs)
+    raise Exception("Invalid metrics sink")
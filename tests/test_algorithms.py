@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import torch
+
+from algorithms import greedy_shap_run, ucb_run
+from client import Client
+from data_preprocess import DatasetStore
+from model import NN
+from server import Server
+
+
+def make_network(num_clients=10):
+    torch.manual_seed(0)
+    lengths = [40 + 10 * i for i in range(num_clients)]
+    data = torch.randn(sum(lengths) + 400, 20)
+    targets = torch.randint(0, 5, (sum(lengths) + 400,))
+    store = DatasetStore(data[:-400], targets[:-400], lengths, "cpu")
+    clients = [
+        Client(store, store.offsets[i], store.lengths[i], "cpu")
+        for i in range(num_clients)
+    ]
+    server = Server(
+        NN(20, 5),
+        data[-400:-200],
+        targets[-400:-200],
+        data[-200:],
+        targets[-200:],
+        "cpu",
+    )
+    return clients, server
+
+
+@pytest.mark.parametrize("algorithm", ["greedyshap", "ucb"])
+def test_async_metrics_keep_selections(algorithm):
+    clients, server = make_network()
+    results = {}
+    for async_metrics in [False, True]:
+        kwargs = dict(E=1, B=2, random_seed=1, async_metrics=async_metrics)
+        if algorithm == "greedyshap":
+            results[async_metrics] = greedy_shap_run(
+                clients, server, 0.2, 8, shap_memory=0.5, **kwargs
+            )
+        else:
+            results[async_metrics] = ucb_run(clients, server, 0.2, 8, 0.1, **kwargs)
+    # test_acc, train_acc, train_loss, val_loss, test_loss, selections and shapley
+    # values of every round (the first 5 rounds select round robin, the rest by SV)
+    for synchronous, asynchronous in zip(results[False][:7], results[True][:7]):
+        np.testing.assert_array_equal(asynchronous, synchronous)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from client import Client, ClientMetrics
+from data_preprocess import DatasetStore
+from model import NN
+
+
+def make_clients(lengths):
+    torch.manual_seed(0)
+    data = torch.randn(sum(lengths), 20)
+    targets = torch.randint(0, 5, (sum(lengths),))
+    store = DatasetStore(data, targets, lengths, "cpu")
+    return [
+        Client(store, store.offsets[i], store.lengths[i], "cpu")
+        for i in range(len(lengths))
+    ]
+
+
+def client_metrics(model, client):
+    """
+    accuracy and cross-entropy loss of model on the data of one client
+    """
+    with torch.no_grad():
+        scores = model(client.data)
+    accuracy = (scores.argmax(1) == client.targets).float().mean()
+    return float(accuracy), float(F.cross_entropy(scores, client.targets))
+
+
+@pytest.mark.parametrize("chunk_size", [None, 4096, 50, 7])
+@pytest.mark.parametrize("indices", [None, [4, 1, 3]])
+def test_chunked_metrics_match_per_client(chunk_size, indices):
+    clients = make_clients([30, 47, 64, 81, 12])
+    torch.manual_seed(1)
+    model = NN(20, 5)
+    accuracies, losses = ClientMetrics(clients, chunk_size).evaluate(model, indices)
+    selected = range(len(clients)) if indices is None else indices
+    expected = np.array([client_metrics(model, clients[idx]) for idx in selected])
+    np.testing.assert_allclose(accuracies, expected[:, 0], atol=1e-6)
+    np.testing.assert_allclose(losses, expected[:, 1], atol=1e-5)
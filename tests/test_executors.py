@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from algorithms import fed_avg_criterion, fed_prox_criterion
+from client import Client
+from data_preprocess import DatasetStore
+from executors import make_executor
+from model import NN
+
+
+def make_clients(lengths, noise_levels):
+    torch.manual_seed(0)
+    data = torch.randn(sum(lengths), 20)
+    targets = torch.randint(0, 5, (sum(lengths),))
+    store = DatasetStore(data, targets, lengths, "cpu")
+    return [
+        Client(store, store.offsets[i], store.lengths[i], "cpu", noise_level)
+        for i, noise_level in enumerate(noise_levels)
+    ]
+
+
+@pytest.mark.parametrize("criterion", ["fedavg", "fedprox"])
+def test_vmap_matches_sequential(criterion):
+    # different client sizes (padded batches), epochs (masked steps) and noise
+    clients = make_clients([30, 47, 64, 81], [0, 0.01, 0, 0])
+    torch.manual_seed(1)
+    model = NN(20, 5)
+    if criterion == "fedavg":
+        loss = fed_avg_criterion()
+    else:
+        loss = fed_prox_criterion(model, 0.1)
+    selected = [0, 1, 2, 3]
+    E = [1, 2, 3, 2]
+    seeds = [10, 11, 12, 13]
+    states = {}
+    for backend in ["sequential", "vmap"]:
+        executor = make_executor(backend, clients)
+        states[backend] = executor.train(selected, model, loss, E, 3, 0.05, 0.5, seeds)
+        executor.close()
+    for sequential, vmapped in zip(states["sequential"], states["vmap"]):
+        assert sequential.keys() == vmapped.keys()
+        for key in sequential:
+            # equal up to floating point rounding (summation order differs)
+            torch.testing.assert_close(vmapped[key], sequential[key], rtol=0, atol=1e-5)
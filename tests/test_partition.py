@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+import torch
+from torch.distributions.dirichlet import Dirichlet
+
+from functools import partial
+
+import initialise
+from data_preprocess import NIIDClientSplit
+from initialise import cached_partition, client_epochs, split_clients
+
+
+class Targets:
+    def __init__(self, targets):
+        self.targets = targets
+
+
+def reference_split(train_data, num_clients, alpha):
+    """
+    the label bucketing and per-client slicing of NIIDClientSplit before it was
+    vectorized, returns {client: list of indices}
+    """
+    unique_targets, target_counts_global = train_data.targets.unique(return_counts=True)
+    num_targets = len(unique_targets)
+    target_indices = {int(key): [] for key in unique_targets}
+    for idx, target in enumerate(train_data.targets):
+        target_indices[int(target)].append(idx)
+
+    target_distribution = Dirichlet(torch.Tensor([alpha]).repeat(num_targets))
+    counter = 0
+    while True:
+        counter += 1
+        client_datapoint_fractions = np.random.uniform(0, 1, num_clients) ** (1 / 3)
+        client_datapoint_fractions = client_datapoint_fractions / np.sum(
+            client_datapoint_fractions
+        )
+        client_proportions = target_distribution.sample([num_clients])
+        client_datapoint_fractions = torch.Tensor(client_datapoint_fractions)
+        target_fractions = client_proportions * torch.t(
+            client_datapoint_fractions.repeat(num_targets, 1)
+        )
+        target_fractions = target_fractions.sum(0)
+        D = torch.min(target_counts_global / target_fractions)
+        datapoints_allocated = torch.floor(D * client_datapoint_fractions).int()
+        if torch.min(datapoints_allocated) > 30 or counter > 200:
+            if counter > 200:
+                raise Warning("Unable to allocate sufficient datapoints to each client")
+            break
+
+    client_num_datapoints = torch.floor(
+        client_proportions * torch.t(datapoints_allocated.repeat(num_targets, 1))
+    ).int()
+    client_num_datapoints_sum = torch.cumsum(client_num_datapoints, axis=0)
+    for key in target_indices.keys():
+        np.random.shuffle(target_indices[key])
+
+    client_indices = {i: [] for i in range(num_clients)}
+    for i in range(num_clients):
+        for j in range(num_targets):
+            lsplit = client_num_datapoints_sum[i - 1][j]
+            usplit = client_num_datapoints_sum[i][j]
+            if i > 0:
+                client_indices[i].extend(target_indices[j][lsplit:usplit])
+            else:
+                client_indices[i].extend(target_indices[j][0:usplit])
+    return client_indices
+
+
+@pytest.mark.parametrize("num_clients, alpha", [(10, 1e-1), (30, 1.0), (50, 1e1)])
+def test_vectorized_split_matches_reference(num_clients, alpha):
+    generator = torch.Generator().manual_seed(0)
+    train_data = Targets(torch.randint(0, 10, (20000,), generator=generator))
+
+    np.random.seed(3)
+    torch.manual_seed(3)
+    expected = reference_split(train_data, num_clients, alpha)
+    expected_draws = np.random.rand(), torch.rand(1)
+
+    np.random.seed(3)
+    torch.manual_seed(3)
+    offsets, indices = NIIDClientSplit(train_data, num_clients, alpha)
+    for i in range(num_clients):
+        assert indices[offsets[i] : offsets[i + 1]].tolist() == expected[i]
+    # the global RNGs are left in the same state
+    assert (np.random.rand(), torch.rand(1)) == expected_draws
+
+
+def test_cached_partition_matches_fresh_split(tmp_path, monkeypatch):
+    monkeypatch.setattr(initialise, "PARTITION_CACHE", str(tmp_path))
+    generator = torch.Generator().manual_seed(0)
+    train_data = Targets(torch.randint(0, 10, (20000,), generator=generator))
+    build = partial(split_clients, train_data, 30, 1.0)
+    config = {"num_clients": 30, "alpha": 1.0}
+
+    np.random.seed(3)
+    torch.manual_seed(3)
+    expected = build()
+    expected_draws = np.random.rand(), torch.rand(1)
+
+    # the first call builds and saves the partition, the second loads it
+    for _ in range(2):
+        np.random.seed(3)
+        torch.manual_seed(3)
+        partition = cached_partition(config, build)
+        assert partition.keys() == expected.keys()
+        for key in expected:
+            np.testing.assert_array_equal(partition[key], expected[key])
+        # later draws (server model initialisation) are as after a fresh split
+        assert (np.random.rand(), torch.rand(1)) == expected_draws
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+
+def test_cached_client_epochs(tmp_path, monkeypatch):
+    monkeypatch.setattr(initialise, "PARTITION_CACHE", str(tmp_path))
+    E = client_epochs(100, 0.5, 5, seed=1)
+    assert client_epochs(100, 0.5, 5, seed=1) == E
+    assert sum(E_i < 5 for E_i in E) > 0
+    assert client_epochs(100, 0, 5, seed=1) == 5
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.signal import lfilter
+
+import ast
+import os
+import warnings
+
+CONFIG_COLUMNS = ["algorithm", "seed"]
+T_MAIN = 6
+
+
+def plotting_functions(*names):
+    """
+    returns the named functions of plotting.py, which runs its analysis when imported
+    """
+    path = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plotting.py"
+    )
+    with open(path) as file, warnings.catch_warnings():
+        # the LaTeX strings of the tables contain invalid escape sequences
+        warnings.simplefilter("ignore")
+        tree = ast.parse(file.read())
+    functions = [
+        node
+        for node in tree.body
+        if isinstance(node, ast.FunctionDef) and node.name in names
+    ]
+    namespace = {
+        "np": np,
+        "pd": pd,
+        "lfilter": lfilter,
+        "config_columns": CONFIG_COLUMNS,
+        "T_main": T_MAIN,
+    }
+    exec(compile(ast.Module(functions, type_ignores=[]), path, "exec"), namespace)
+    return namespace
+
+
+@pytest.mark.parametrize("alpha", [0.1, 0.5, 1.0])
+def test_ewma_matches_pandas(alpha):
+    ewma = plotting_functions("ewma")["ewma"]
+    values = np.random.default_rng(0).random((5, 40))
+    # skipped rounds, also at the start of a run
+    values[0, :3] = np.nan
+    values[1, 10:15] = np.nan
+    values[2, -1] = np.nan
+    expected = pd.DataFrame(values.T).ewm(alpha=alpha).mean().to_numpy().T
+    np.testing.assert_allclose(ewma(values, alpha), expected, rtol=1e-12)
+
+
+def test_smoothen_df_is_independent_of_row_order():
+    functions = plotting_functions("ewma", "smoothen_df")
+    smoothen_df = functions["smoothen_df"]
+    result_df = pd.DataFrame(
+        {
+            "run_id": np.repeat(["a", "b", "c"], T_MAIN),
+            "algorithm": np.repeat(["fedavg", "fedavg", "ucb"], T_MAIN),
+            "seed": np.repeat([0, 1, 0], T_MAIN),
+            "round": np.tile(np.arange(T_MAIN), 3),
+            "test_accuracy": np.random.default_rng(0).random(3 * T_MAIN),
+        }
+    )
+    runs, smoothed = smoothen_df(0.5, result_df)
+    expected = functions["ewma"](
+        result_df["test_accuracy"].to_numpy().reshape(3, T_MAIN), 0.5
+    )
+    pd.testing.assert_frame_equal(
+        runs, result_df[CONFIG_COLUMNS].iloc[::T_MAIN].reset_index(drop=True)
+    )
+    np.testing.assert_allclose(smoothed, expected)
+
+    shuffled = result_df.sample(frac=1, random_state=0)
+    shuffled_runs, shuffled_smoothed = smoothen_df(0.5, shuffled)
+    order = [list(shuffled["run_id"].unique()).index(run) for run in "abc"]
+    pd.testing.assert_frame_equal(
+        shuffled_runs.iloc[order].reset_index(drop=True), runs
+    )
+    np.testing.assert_allclose(shuffled_smoothed[order], smoothed)
+
+    # a missing round is skipped (without smoothing the last value is kept), a
+    # repeated round is an error
+    _, missing = smoothen_df(1.0, result_df.drop(index=2))
+    assert missing[0, 2] == result_df["test_accuracy"][1]
+    with pytest.raises(ValueError):
+        smoothen_df(0.5, pd.concat([result_df, result_df.iloc[:1]]))
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+import torch
+
+from itertools import combinations
+from math import factorial
+
+from algorithms import fed_avg_criterion
+from model import NN
+from server import Server
+
+ESTIMATORS = ["mc", "tmc", "gtg", "true"]
+
+
+def make_server(coalition_batch_size):
+    torch.manual_seed(0)
+    data = torch.randn(200, 20)
+    targets = torch.randint(0, 5, (200,))
+    return Server(NN(20, 5), data, targets, data, targets, "cpu", coalition_batch_size)
+
+
+def client_states(server, num_clients, scale=0.1):
+    """
+    returns num_clients states around the server model and their weights
+    """
+    torch.manual_seed(1)
+    states = []
+    for _ in range(num_clients):
+        state = {
+            key: value + scale * torch.randn_like(value)
+            for key, value in server.model.state_dict().items()
+        }
+        states.append(state)
+    return states, list(range(1, num_clients + 1))
+
+
+# with near identical updates the permutation walks of TMC and GTG truncate early
+@pytest.mark.parametrize("scale", [0.1, 1e-4])
+@pytest.mark.parametrize("estimator", ESTIMATORS)
+def test_batched_matches_sequential(estimator, scale):
+    values = {}
+    evaluations = {}
+    for coalition_batch_size in [16, None]:
+        server = make_server(coalition_batch_size)
+        states, weights = client_states(server, 5, scale)
+        np.random.seed(0)
+        values[coalition_batch_size] = getattr(server, "shapley_values_" + estimator)(
+            fed_avg_criterion(), states, weights
+        )
+        evaluations[coalition_batch_size] = server.model_evaluations
+    np.testing.assert_allclose(values[16], values[None], atol=1e-5)
+    assert evaluations[16] == evaluations[None]
+
+
+def shapley_definition(server, states, weights):
+    """
+    exact shapley values from the definition, every subset aggregated on its own
+    u(S) = 1 - validation loss of the aggregate of S (the server model for S empty)
+    """
+    num_clients = len(states)
+    weights = np.array(weights) / np.sum(weights)
+
+    def utility(subset):
+        if len(subset) == 0:
+            model = server.model
+        else:
+            model = server.aggregate_(
+                [states[i] for i in subset], [weights[i] for i in subset]
+            )
+        return 1 - server.val_loss(model, fed_avg_criterion())
+
+    values = np.zeros(num_clients)
+    for i in range(num_clients):
+        others = [j for j in range(num_clients) if j != i]
+        for size in range(num_clients):
+            for subset in combinations(others, size):
+                factor = factorial(size) * factorial(num_clients - size - 1)
+                marginal = utility(subset + (i,)) - utility(subset)
+                values[i] += factor / factorial(num_clients) * marginal
+    return values
+
+
+@pytest.mark.parametrize("coalition_batch_size", [16, None])
+@pytest.mark.parametrize("num_clients", [1, 4])
+def test_gray_code_matches_definition(coalition_batch_size, num_clients):
+    server = make_server(coalition_batch_size)
+    states, weights = client_states(server, num_clients)
+    expected = shapley_definition(server, states, weights)
+    values = server.shapley_values_true(fed_avg_criterion(), states, weights)
+    np.testing.assert_allclose(values, expected, atol=1e-5)
+    # one evaluation per subset
+    assert server.model_evaluations == 2**num_clients
+
+
+def scaled_criterion(scale):
+    def loss(model, data, targets):
+        return scale * fed_avg_criterion()(model, data, targets)
+
+    return loss
+
+
+def test_cache_is_keyed_on_the_criterion_object():
+    server = make_server(16)
+    states, weights = client_states(server, 4)
+    server.shapley_values_true(fed_avg_criterion(), states, weights)
+    # the same criterion in the same round reuses every utility
+    server.shapley_values_true(fed_avg_criterion(), states, weights)
+    assert server.cache_hit_rate() == 1
+    # closures of one function with different captured state do not
+    for scale in [1.0, 2.0]:
+        criterion = scaled_criterion(scale)
+        values = server.shapley_values_true(criterion, states, weights)
+        assert server.cache_hit_rate() == 0
+        expected = make_server(16).shapley_values_true(criterion, states, weights)
+        np.testing.assert_allclose(values, expected, atol=1e-5)
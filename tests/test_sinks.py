@@ -0,0 +1,13 @@
+import sys
+
+import pytest
+
+from sinks import make_sink
+
+
+def test_results_store_without_pyarrow(tmp_path, monkeypatch):
+    # an import of a module set to None raises ImportError
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    with pytest.raises(ImportError):
+        make_sink("results", str(tmp_path / "store"))
+    assert not (tmp_path / "store").exists()
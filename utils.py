@@ -1,6 +1,9 @@
 import torch
 import numpy as np
 
+import queue
+import threading
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
@@ -22,6 +25,14 @@ def convergenceTest(values):
         ) < 0.01
 
 
+def client_seed(random_seed, t, idx):
+    """
+    seed for training client idx in round t of a run started with random_seed
+    does not depend on the order (or process) in which clients are trained
+    """
+    return int(np.random.SeedSequence([random_seed, t, idx]).generate_state(1)[0])
+
+
 def topk(values, k):
     # returns indices of top-k values with ties broken at random
     values = np.array(values)
@@ -43,3 +54,67 @@ def dict_hash(dictionary: Dict[str, Any]) -> str:
     encoded = json.dumps(dictionary, sort_keys=True).encode()
     dhash.update(encoded)
     return dhash.hexdigest()
+
+
+def concatenate(tensors):
+    """
+    torch.cat along the first dimension, without copying when the tensors are
+    back-to-back views of one storage (e.g. client data in a DatasetStore)
+    """
+    first = tensors[0]
+    address = first.data_ptr()
+    for tensor in tensors:
+        if (
+            not tensor.is_contiguous()
+            or tensor.untyped_storage().data_ptr() != first.untyped_storage().data_ptr()
+            or tensor.data_ptr() != address
+        ):
+            return torch.cat(tensors)
+        address += tensor.numel() * tensor.element_size()
+    length = sum(len(tensor) for tensor in tensors)
+    return first.as_strided((length,) + first.shape[1:], first.stride())
+
+
+def prefetch(function, items, size):
+    """
+    yields function(item) for every item, computed ahead by a background thread that
+    keeps at most size results waiting in a bounded queue
+    exceptions raised by function are re-raised in the consuming thread
+    """
+    results = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(result):
+        # gives up when the consumer has stopped, so the thread never blocks forever
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in items:
+                if not put((function(item), None)):
+                    return
+        except Exception as error:
+            put((None, error))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is done:
+                return
+            yield result
+    finally:
+        stop.set()
+        thread.join()